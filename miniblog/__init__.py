@@ -1,29 +1,58 @@
-from miniblog.models import DBSession, Base, userfinder, get_session, cache
+from dogpile.cache.region import register_backend
+from miniblog.caching import refresh_in_background
+from miniblog.database import make_engine, make_replica_engine
+from miniblog.models import DBSession, Base, userfinder, cache, \
+    render_cache, bump_content_generation, cache_configured, \
+    configure_session_serializer
+from miniblog.search import create_search_index
+from miniblog.sessions import make_session_factory, start_session_sweeper
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
-from sqlalchemy import engine_from_config
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
 
 
+register_backend('miniblog.json_dbm', 'miniblog.caching', 'JSONDBMBackend')
+register_backend('miniblog.tiered', 'miniblog.caching', 'TieredBackend')
+
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
-    engine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession.configure(bind=engine)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine, replica=make_replica_engine(settings))
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
-    cache.configure_from_config(settings, 'dogpile.cache.')
+    create_search_index(engine)
+    if not cache_configured():
+        cache.configure_from_config(settings, 'dogpile.cache.')
+    if asbool(settings.get('cache.background_refresh', False)):
+        cache.async_creation_runner = refresh_in_background
+    render_cache.configure(
+        int(settings.get('render_cache.size', 500)),
+        int(settings.get('render_cache.expiration_time', 86400)))
+    configure_session_serializer(
+        settings.get('session.serializer', 'json'),
+        asbool(settings.get('session.allow_pickle', False)))
+    start_session_sweeper(settings)
+    # Templates may have changed since the last start, so pages cached or
+    # validated by browsers before must not be used anymore.
+    bump_content_generation()
     authn_policy = AuthTktAuthenticationPolicy(settings['auth_secret'],
                                                hashalg='sha512',
                                                callback=userfinder)
     authz_policy = ACLAuthorizationPolicy()
     config = Configurator(settings=settings,
                           root_factory='miniblog.models.RootFactory',
-                          session_factory=get_session,
+                          session_factory=make_session_factory(settings),
                           )
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(authz_policy)
+    config.add_tween('miniblog.querylog.query_budget_tween_factory',
+                     under=INGRESS)
+    config.add_tween('miniblog.database.replica_tween_factory',
+                     under=INGRESS)
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
     config.add_route('home_paged', '/page/{page}')
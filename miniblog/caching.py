@@ -0,0 +1,377 @@
+from calendar import timegm
+from dogpile.cache import make_region
+from dogpile.cache.api import CacheBackend, NO_VALUE, CachedValue
+from dogpile.cache.backends.file import DBMBackend
+from functools import wraps
+from hashlib import sha1
+from miniblog.models import DBSession, cache, content_generation, \
+    bump_content_generation, GENERATION_KEY
+from pyramid.httpexceptions import HTTPNotModified
+from pyramid.response import Response
+from pyramid.security import authenticated_userid
+from pyramid.settings import asbool
+from repoze.lru import ExpiringLRUCache
+from time import time, sleep
+import json
+import logging
+import os
+import threading
+import transaction
+
+
+log = logging.getLogger(__name__)
+
+
+class JSONDBMBackend(DBMBackend):
+    """A :class:`dogpile.cache.backends.file.DBMBackend` that stores values
+    as compact JSON instead of pickles.
+
+    Values are smaller, faster to load and loading them can't execute code.
+    Everything cached by miniblog is made of strings, numbers, lists and
+    dicts (see :func:`miniblog.models.cache_records`), tuples come back as
+    lists. It is registered as ``miniblog.json_dbm`` and takes the same
+    arguments as ``dogpile.cache.dbm``:
+
+    .. code-block:: ini
+
+        dogpile.cache.backend = miniblog.json_dbm
+        dogpile.cache.arguments.filename = %(here)s/cache/cache.dbm
+    """
+
+    def get(self, key):
+        with self._dbm_file(False) as dbm:
+            try:
+                value = dbm[key]
+            except KeyError:
+                return NO_VALUE
+        payload, metadata = json.loads(value)
+        return CachedValue(payload, metadata)
+
+    def set(self, key, value):
+        value = json.dumps([value.payload, value.metadata],
+                           separators=(',', ':'))
+        with self._dbm_file(True) as dbm:
+            dbm[key] = value
+
+    def delete_expired(self, expiration_time, batch_size=500, pause=0,
+                       now=None):
+        """Delete the values created more than ``expiration_time`` seconds
+        ago, e.g. abandoned sessions (see
+        :meth:`miniblog.sessions.RegionStore.sweep`). The file is locked
+        for ``batch_size`` values at a time, ``pause`` seconds in between.
+
+        Returns:
+            The number of deleted values."""
+        cutoff = (now or time()) - expiration_time
+        with self._dbm_file(False) as dbm:
+            keys = dbm.keys()
+        deleted = 0
+        for start in range(0, len(keys), batch_size):
+            if start and pause:
+                sleep(pause)
+            with self._dbm_file(True) as dbm:
+                for key in keys[start:start + batch_size]:
+                    try:
+                        payload, metadata = json.loads(dbm[key])
+                    except KeyError:
+                        continue
+                    if metadata['ct'] < cutoff:
+                        del dbm[key]
+                        deleted += 1
+        return deleted
+
+
+class TieredBackend(CacheBackend):
+    """A cache backend that keeps a bounded in-process memory tier in front
+    of another (shared) backend, e.g. :class:`JSONDBMBackend`.
+
+    Values found in memory are returned without file locking or
+    deserialization. Each value stays in memory for at most ``memory_ttl``
+    seconds. Writes go to both tiers. To keep the processes coherent, writing
+    one of the ``marker_keys`` (by default the :data:`content generation
+    <miniblog.models.GENERATION_KEY>`) replaces the small ``marker`` file.
+    Every lookup compares the marker with a single ``stat`` call and drops
+    the memory tier if another process replaced it. It is registered as
+    ``miniblog.tiered``:
+
+    .. code-block:: ini
+
+        dogpile.cache.backend = miniblog.tiered
+        dogpile.cache.arguments.memory_size = 1000
+        dogpile.cache.arguments.memory_ttl = 30
+        dogpile.cache.arguments.marker = %(here)s/cache/cache.marker
+        dogpile.cache.arguments.backend = miniblog.json_dbm
+        dogpile.cache.arguments.backend.filename = %(here)s/cache/cache.dbm
+
+    All ``backend.*`` arguments are passed on to the shared backend.
+
+    .. note::
+
+        The dogpile lock is a thread lock local to the process, so two
+        processes may create the same value at once.
+    """
+
+    def __init__(self, arguments):
+        backend_arguments = dict((key[len('backend.'):], value)
+                                 for key, value in arguments.items()
+                                 if key.startswith('backend.'))
+        self.backend = make_region().configure(
+            arguments['backend'], arguments=backend_arguments).backend
+        self.key_mangler = self.backend.key_mangler
+        self.memory = ExpiringLRUCache(int(arguments.get('memory_size', 1000)),
+                                       int(arguments.get('memory_ttl', 30)))
+        self.marker = os.path.abspath(arguments['marker'])
+        self.marker_keys = set(key.strip() for key in
+                               arguments.get('marker_keys', GENERATION_KEY)
+                               .split(','))
+        self._marker_state = None
+        if not os.path.exists(self.marker):
+            self._replace_marker()
+        self._check_marker()
+
+    def _replace_marker(self):
+        """Atomically replace the marker file so other processes notice."""
+        tmp = '%s.%d.%d' % (self.marker, os.getpid(),
+                            threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            f.write(repr(time()))
+        os.rename(tmp, self.marker)
+
+    def _check_marker(self):
+        """Drop the memory tier if the marker was replaced since the last
+        check."""
+        stat = os.stat(self.marker)
+        state = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if state != self._marker_state:
+            if self._marker_state is not None:
+                log.debug("Cache marker changed, dropping memory tier")
+            self.memory.clear()
+            self._marker_state = state
+
+    def get(self, key):
+        self._check_marker()
+        value = self.memory.get(key, NO_VALUE)
+        if value is NO_VALUE:
+            value = self.backend.get(key)
+            if value is not NO_VALUE:
+                self.memory.put(key, value)
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+        if key in self.marker_keys:
+            self._replace_marker()
+            self._check_marker()
+        self.memory.put(key, value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self.memory.invalidate(key)
+        if key in self.marker_keys:
+            self._replace_marker()
+
+
+def refresh_in_background(region, key, creator, mutex):
+    """An ``async_creation_runner`` for the :data:`cache
+    <miniblog.models.cache>` region that creates a new value in a background
+    thread.
+
+    Once a value has expired, requests keep getting the old one without
+    waiting while this thread creates the new value. The thread has its own
+    database session and transaction, both are discarded afterwards. It is
+    turned on by the ``cache.background_refresh`` setting."""
+    def refresh():
+        try:
+            region.set(key, creator())
+        except Exception:
+            log.exception("Refreshing cache key %s failed" % key)
+        finally:
+            transaction.abort()
+            DBSession.remove()
+            mutex.release()
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def invalidate_content():
+    """Start a new content generation once the current transaction is
+    committed.
+
+    Changes to entries and categories made through the ORM already do this
+    on their own (see :func:`miniblog.models.track_content_changes`). This
+    is for changes that bypass it, e.g. bulk updates of the rendered html.
+    If the transaction is aborted, nothing is invalidated."""
+    def bump(success):
+        if success:
+            bump_content_generation()
+    transaction.get().addAfterCommitHook(bump)
+
+
+def has_flash(request):
+    """Whether the visitor has pending flash messages.
+
+    Visitors without a session cookie can't have any, so the session is only
+    loaded if there is a cookie."""
+    cookie_name = request.registry.settings.get('session.cookie_name',
+                                                'session')
+    return cookie_name in request.cookies and \
+        bool(request.session.peek_flash())
+
+
+def page_cacheable(request):
+    """Whether the response for ``request`` may be served from and stored
+    in the page cache.
+
+    Only ``GET`` and ``HEAD`` requests of anonymous visitors are cached. A
+    visitor with pending flash messages always gets a fresh page as the
+    messages are part of it."""
+    if not asbool(request.registry.settings.get('page_cache.enabled', True)):
+        return False
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if authenticated_userid(request) is not None:
+        return False
+    return not has_flash(request)
+
+
+def page_validators(request):
+    """Return a tuple (``etag``, ``last_modified``) for the page requested.
+
+    Both are derived from the :func:`content generation
+    <miniblog.models.content_generation>` only, so they are known before any
+    database query is made. ``last_modified`` is the Unix timestamp of the
+    last change, but it is moved forward every ``page_cache.expiration_time``
+    seconds (default: 300) so relative dates on a page shown by a browser
+    don't get older than they would from the page cache. The ``etag`` also
+    depends on the logged in user as they see different pages."""
+    settings = request.registry.settings
+    interval = int(settings.get('page_cache.expiration_time', 300))
+    generation = content_generation()
+    now = time()
+    last_modified = int(max(float(generation), now - now % interval))
+    etag = "%s|%s|%s" % (generation, last_modified,
+                         authenticated_userid(request) or '')
+    return sha1(etag.encode('utf-8')).hexdigest(), last_modified
+
+
+def conditional_get(view):
+    """A view decorator that adds ``ETag`` and ``Last-Modified`` headers to
+    public pages and answers requests with matching validators with ``304
+    Not Modified`` without calling the view at all.
+
+    Usage (together with :func:`cache_page` it has to come first):
+
+    .. code-block:: python
+
+        @view_config(route_name='...', renderer='...',
+                     decorator=(conditional_get, cache_page))
+        def public_page(self):
+            ...
+
+    See :func:`page_validators` for how the validators are made. Requests
+    other than ``GET`` and ``HEAD`` and visitors with pending flash messages
+    are passed through unchanged.
+    """
+    @wraps(view)
+    def conditional_view(context, request):
+        if request.method not in ('GET', 'HEAD') or has_flash(request):
+            return view(context, request)
+        etag, last_modified = page_validators(request)
+        if request.if_none_match:
+            not_modified = etag in request.if_none_match
+        elif request.if_modified_since:
+            not_modified = timegm(request.if_modified_since.utctimetuple()) \
+                >= last_modified
+        else:
+            not_modified = False
+        if not_modified:
+            response = HTTPNotModified()
+        else:
+            response = view(context, request)
+            if response.status_int != 200:
+                return response
+        response.etag = etag
+        response.last_modified = last_modified
+        response.vary = ('Cookie',)
+        return response
+    return conditional_view
+
+
+def page_key(request):
+    """Return the page cache key for ``request``.
+
+    It is made from the content generation, the application url, the name
+    of the matched route, its matchdict and the (sorted) query string."""
+    route = request.matched_route.name if request.matched_route else ''
+    parts = [content_generation(), request.application_url, route]
+    parts.extend(u"%s=%s" % item
+                 for item in sorted((request.matchdict or {}).items()))
+    parts.append(u"?")
+    parts.extend(u"%s=%s" % item for item in sorted(request.GET.items()))
+    key = u"\n".join(unicode(part) for part in parts)
+    return 'page:%s' % sha1(key.encode('utf-8')).hexdigest()
+
+
+def cache_fragment(request, name, creator):
+    """Return a part of a page that is the same for all visitors from the
+    cache, using ``creator`` to make it if needed.
+
+    The fragment is cached under ``name``, the application url and the
+    content generation, so it is dropped on every change. It
+    also expires after ``fragment_cache.expiration_time`` seconds (default:
+    60) as fragments may contain relative dates.
+
+    Args:
+        ``request``: The current request.
+
+        ``name``: A name that is unique for the fragment.
+
+        ``creator``: A function without arguments that returns the
+        fragment, usually a rendered template.
+    """
+    settings = request.registry.settings
+    expiration_time = int(settings.get('fragment_cache.expiration_time', 60))
+    key = u"\n".join([content_generation(), request.application_url, name])
+    key = 'fragment:%s' % sha1(key.encode('utf-8')).hexdigest()
+    return cache.get_or_create(key, creator, expiration_time)
+
+
+def cache_page(view):
+    """A view decorator that caches the complete response of a public page.
+
+    Usage:
+
+    .. code-block:: python
+
+        @view_config(route_name='...', renderer='...', decorator=cache_page)
+        def public_page(self):
+            ...
+
+    Only responses with status ``200`` are stored, together with their
+    content type. Pages expire after ``page_cache.expiration_time`` seconds
+    (default: 300) so relative dates don't get too old and are dropped
+    immediately by a new :func:`content generation
+    <miniblog.models.content_generation>`. Setting
+    ``page_cache.enabled`` to ``false`` turns the cache off.
+    """
+    @wraps(view)
+    def cached_view(context, request):
+        if not page_cacheable(request):
+            return view(context, request)
+        settings = request.registry.settings
+        expiration_time = int(settings.get('page_cache.expiration_time', 300))
+        key = page_key(request)
+        cached = cache.get(key, expiration_time=expiration_time)
+        if cached is not NO_VALUE:
+            content_type, charset, text = cached
+            log.debug("Serving %s from page cache" % request.path)
+            return Response(text=text, content_type=content_type,
+                            charset=charset)
+        response = view(context, request)
+        if response.status_int == 200:
+            cache.set(key, (response.content_type, response.charset,
+                            response.text))
+        return response
+    return cached_view
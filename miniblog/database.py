@@ -0,0 +1,259 @@
+from itertools import chain
+from sqlalchemy import engine_from_config
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session as SASession
+from sqlalchemy.pool import QueuePool, NullPool, StaticPool, \
+    SingletonThreadPool
+from sqlalchemy.sql.expression import UpdateBase
+from time import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('busy_timeout', '5000'),
+    ('synchronous', 'normal'),
+    ('cache_size', '-16000'),
+    ('mmap_size', '268435456'),
+]
+"""The pragmas set on every new SQLite connection by :func:`make_engine`
+with their defaults, in the order they are set. Each one can be changed
+with a ``sqlite.<name>`` setting:
+
+``journal_mode``: ``wal`` lets readers continue while another connection
+writes, the other modes block them.
+
+``busy_timeout``: Milliseconds a connection waits for a lock held by
+another one before it fails with "database is locked".
+
+``synchronous``: ``normal`` is safe with ``wal`` and syncs much less
+often than ``full``.
+
+``cache_size``: Pages or, if negative, kibibytes of page cache for each
+connection.
+
+``mmap_size``: Bytes of the database file read through memory mapping.
+
+An empty value leaves the SQLite default."""
+
+PRAGMA_CHOICES = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra', '0', '1', '2', '3'),
+}
+"""Valid values of the pragmas in :data:`SQLITE_PRAGMAS` that are not
+integers."""
+
+POOL_CLASSES = {
+    'queue': QueuePool,
+    'null': NullPool,
+    'static': StaticPool,
+    'singleton': SingletonThreadPool,
+}
+"""Pool classes that can be chosen by the ``sqlite.pool`` setting."""
+
+
+def sqlite_pragmas(settings):
+    """Return a list of tuples (``name``, ``value``) of the pragmas to set
+    for each SQLite connection, see :data:`SQLITE_PRAGMAS`.
+
+    Raises :exc:`ValueError` for an invalid value, so a typo in the
+    settings stops the application from starting."""
+    pragmas = []
+    for name, default in SQLITE_PRAGMAS:
+        value = str(settings.get('sqlite.%s' % name, default)).strip().lower()
+        if not value:
+            continue
+        choices = PRAGMA_CHOICES.get(name)
+        if choices is None:
+            value = str(int(value))
+        elif value not in choices:
+            raise ValueError("Invalid value %r for sqlite.%s, use one of %s"
+                             % (value, name, ', '.join(choices)))
+        pragmas.append((name, value))
+    return pragmas
+
+
+def make_engine(settings, prefix='sqlalchemy.'):
+    """Create the database engine from the ``settings`` starting with
+    ``prefix`` like :func:`sqlalchemy.engine_from_config`.
+
+    For SQLite databases it also sets the :data:`pragmas <SQLITE_PRAGMAS>`
+    on every new connection and uses the pool class named by the
+    ``sqlite.pool`` setting (see :data:`POOL_CLASSES`). Database files
+    default to ``queue``: A few connections (``sqlalchemy.pool_size``,
+    default: 5) are kept open and shared by the threads, so the pragmas and
+    the page cache are not lost after each request. In-memory databases
+    default to ``singleton`` as every connection would get its own database
+    otherwise.
+
+    Usage:
+
+    .. code-block:: ini
+
+        sqlalchemy.url = sqlite:///%(here)s/miniblog.sqlite
+        sqlalchemy.pool_size = 10
+        sqlite.pool = queue
+        sqlite.journal_mode = wal
+        sqlite.busy_timeout = 5000
+    """
+    url = make_url(settings[prefix + 'url'])
+    if url.drivername.split('+')[0] != 'sqlite':
+        return engine_from_config(settings, prefix)
+    memory = url.database in (None, '', ':memory:')
+    pool = settings.get('sqlite.pool', 'singleton' if memory else 'queue')
+    kw = {'poolclass': POOL_CLASSES[pool]}
+    if pool != 'singleton':
+        # pooled connections are used by one thread at a time, but not
+        # always by the one that opened them
+        kw['connect_args'] = {'check_same_thread': False}
+    engine = engine_from_config(settings, prefix, **kw)
+    pragmas = sqlite_pragmas(settings)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    listen(engine, 'connect', set_pragmas)
+    log.debug("SQLite engine with %s and pragmas %s"
+              % (kw['poolclass'].__name__, pragmas))
+    return engine
+
+
+def make_replica_engine(settings):
+    """Create the engine of the read replica from the settings starting with
+    ``replica.sqlalchemy.`` (see :func:`make_engine`).
+
+    Returns:
+        The engine or ``None`` if ``replica.sqlalchemy.url`` is not set."""
+    if not settings.get('replica.sqlalchemy.url'):
+        return None
+    return make_engine(settings, 'replica.sqlalchemy.')
+
+
+class RoutingSession(SASession):
+    """A database session that reads from a replica and writes to the
+    primary database it is bound to.
+
+    Everything goes to the primary if there is no ``replica``. Otherwise
+    these go to the primary and all other statements to the replica:
+
+    * Flushes and ``INSERT``, ``UPDATE`` and ``DELETE`` statements.
+    * Everything after a write until the transaction ends, so a request
+      reads what it just wrote.
+    * Classes with ``always_primary = True``, e.g. the web sessions that
+      are written on almost every request.
+    * Everything while :attr:`use_primary` is set, see
+      :func:`replica_tween_factory`.
+
+    Args:
+        ``replica``: The engine of the read replica or ``None``. Like
+        ``bind`` it is usually passed to :meth:`configure
+        <sqlalchemy.orm.scoping.scoped_session.configure>`.
+
+    Attrs:
+        ``use_primary``: Read from the primary as well.
+
+        ``wrote``: Whether the current transaction wrote to the primary.
+
+        ``changed``: Whether anything but ``always_primary`` classes was
+        written since it was last reset. Never reset by the session itself.
+    """
+
+    def __init__(self, replica=None, **kw):
+        super(RoutingSession, self).__init__(**kw)
+        self.replica = replica
+        self.use_primary = False
+        self.wrote = False
+        self.changed = False
+
+    def get_bind(self, mapper=None, clause=None):
+        primary = super(RoutingSession, self).get_bind(mapper, clause)
+        if self.replica is None:
+            return primary
+        # mapper is a class if passed to Session.execute()
+        always_primary = getattr(getattr(mapper, 'class_', mapper),
+                                 'always_primary', False)
+        if isinstance(clause, UpdateBase):
+            self.wrote = True
+            if not always_primary:
+                self.changed = True
+            return primary
+        if self.use_primary or self.wrote or self._flushing or \
+                always_primary:
+            return primary
+        return self.replica
+
+
+def track_primary_writes(session, flush_context):
+    """Remember that a :class:`RoutingSession` wrote, see its ``wrote``
+    and ``changed`` attributes. Listens to the ``after_flush`` event."""
+    session.wrote = True
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if not getattr(instance, 'always_primary', False):
+            session.changed = True
+            return
+
+
+def forget_primary_writes(session):
+    """Read from the replica again once a transaction has ended."""
+    session.wrote = False
+
+listen(RoutingSession, 'after_flush', track_primary_writes)
+listen(RoutingSession, 'after_commit', forget_primary_writes)
+listen(RoutingSession, 'after_rollback', forget_primary_writes)
+
+
+def replica_tween_factory(handler, registry):
+    """A tween that decides which requests read from the primary database
+    instead of the replica (see :class:`RoutingSession`).
+
+    Requests other than ``GET`` and ``HEAD`` use the primary. So does every
+    request for ``replica.sticky_seconds`` (default: 10) after one that
+    changed content, by way of a cookie: The replica may not have caught up
+    yet, and a user should always see their own changes.
+
+    For the same time after a new :func:`content generation
+    <miniblog.models.content_generation>` (its value is the time it was
+    started) all requests use the primary. Pages and fragments rendered
+    then are cached under the new generation, so they must not be made from
+    a replica that still has the old data.
+
+    .. code-block:: ini
+
+        replica.sqlalchemy.url = postgresql://replica.example.com/miniblog
+        replica.sticky_seconds = 10
+    """
+    from miniblog.models import DBSession, content_generation, \
+        cache_configured
+    settings = registry.settings
+    if not settings.get('replica.sqlalchemy.url'):
+        return handler
+    sticky_seconds = int(settings.get('replica.sticky_seconds', 10))
+    cookie_name = settings.get('replica.cookie_name', 'use_primary')
+
+    def recently_changed():
+        return sticky_seconds > 0 and cache_configured() and \
+            float(content_generation()) + sticky_seconds > time()
+
+    def replica_tween(request):
+        session = DBSession()
+        try:
+            until = float(request.cookies.get(cookie_name) or 0)
+        except ValueError:
+            until = 0
+        session.use_primary = request.method not in ('GET', 'HEAD') or \
+            until > time() or recently_changed()
+        session.changed = False
+        try:
+            response = handler(request)
+        finally:
+            session.use_primary = False
+        if session.changed and sticky_seconds > 0:
+            response.set_cookie(cookie_name, '%.3f' % (time() + sticky_seconds),
+                                max_age=sticky_seconds, httponly=True)
+        return response
+    return replica_tween
@@ -1,31 +1,92 @@
+from collections import namedtuple
 from datetime import datetime
 from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.util import function_key_generator
 from functools import wraps
-from hashlib import sha512
+from hashlib import sha512, sha1
+from itertools import chain
+from miniblog.database import RoutingSession
 from pyramid.interfaces import ISession
 from pyramid.security import Allow, Everyone
-from sqlalchemy import Column, Integer, Text, DateTime, PickleType
+from repoze.lru import LRUCache
+from sqlalchemy import Column, Integer, Text, DateTime, LargeBinary, func, \
+    select
 from sqlalchemy.event import listen
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.orm import Session as SASession, scoped_session, sessionmaker, \
-    relationship
+    relationship, defer, joinedload
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from sqlalchemy.orm.exc import NoResultFound, DetachedInstanceError
-from sqlalchemy.schema import ForeignKey
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.schema import ForeignKey, Index
 from sqlalchemy.sql.expression import desc
-from time import time
+from sqlalchemy.types import TypeDecorator
+from time import time, mktime
 from zope.interface import implements
-from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import ZopeTransactionExtension, mark_changed
+import cPickle as pickle
 import hmac
+import json
 import logging
 import os
 import re
+import weakref
 
 
 log = logging.getLogger(__name__)
-DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
+DBSession = scoped_session(sessionmaker(class_=RoutingSession,
+                                        extension=ZopeTransactionExtension()))
 Base = declarative_base()
-cache = make_region()
+GENERATION_KEY = 'content_generation'
+
+
+def content_generation():
+    """Return the current content generation.
+
+    The generation is a token stored in the :data:`cache` region that
+    changes whenever an :class:`Entry` or :class:`Category` is changed (see
+    :func:`track_content_changes`). Everything cached that depends on the
+    content embeds it in its key, so a new generation drops all of it at
+    once."""
+    generation = cache.get(GENERATION_KEY, ignore_expiration=True)
+    if generation is NO_VALUE:
+        generation = repr(time())
+        cache.set(GENERATION_KEY, generation)
+    return str(generation)
+
+
+def bump_content_generation():
+    """Start a new content generation right away. Does nothing if the
+    :data:`cache` region is not configured."""
+    if cache_configured():
+        cache.set(GENERATION_KEY, repr(time()))
+
+
+def cache_configured():
+    """Whether the :data:`cache` region has been configured yet."""
+    return 'backend' in cache.__dict__
+
+
+def generation_key_generator(namespace, fn):
+    """Key generator for the :data:`cache` region that prefixes the keys of
+    :meth:`cache_on_arguments
+    <dogpile.cache.region.CacheRegion.cache_on_arguments>` with the
+    :func:`content_generation`."""
+    generate_key = function_key_generator(namespace, fn)
+    def generate_generation_key(*args, **kwargs):
+        return "%s|%s" % (content_generation(),
+                          generate_key(*args, **kwargs))
+    return generate_generation_key
+
+
+cache = make_region(function_key_generator=generation_key_generator)
+
+RENDER_VERSION = 1
+"""Version of the markdown rendering. Increase it whenever the output of
+:func:`render_markdown` changes (e.g. a Markdown upgrade or different
+escaping rules) so stored HTML of entries is regenerated."""
 
 
 def pretty_date(time=None):
@@ -82,13 +143,63 @@ def pretty_date(time=None):
         return "{0} years ago".format(now.year - time.year)
 
 
-@cache.cache_on_arguments()
+def timestamp(dt):
+    """Return the :class:`datetime.datetime` ``dt`` as a (local) Unix
+    timestamp, keeping the microseconds."""
+    return mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class CategoryRecord(namedtuple('CategoryRecord', 'name')):
+    """A read-only record of a :class:`Category` as returned by
+    :func:`get_categories`."""
+    __slots__ = ()
+
+
+class RecentPost(namedtuple('RecentPost', 'id title entry_time')):
+    """A read-only record of an :class:`Entry` as returned by
+    :func:`get_recent_posts`. It only holds what the list of recent posts
+    needs, ``entry_time`` is a Unix timestamp."""
+    __slots__ = ()
+
+    @property
+    def pretty_date(self):
+        """Return a date string according to the :func:pretty_date function."""
+        return pretty_date(self.entry_time)
+
+
+def cache_records(record, **kw):
+    """Cache the rows returned by the decorated function and return them as
+    instances of ``record``.
+
+    The decorated function has to return a list of plain tuples. Only these
+    are stored in the :data:`cache` region, so cached values are small, need
+    no ORM to be loaded and can be stored by a compact serializer such as
+    :class:`miniblog.caching.JSONDBMBackend`. Keyword arguments are passed
+    to :meth:`cache_on_arguments
+    <dogpile.cache.region.CacheRegion.cache_on_arguments>` and the
+    ``invalidate`` and ``set`` functions it adds are kept.
+    """
+    def decorator(fn):
+        cached = cache.cache_on_arguments(**kw)(fn)
+        @wraps(fn)
+        def get_records(*args, **kwargs):
+            return [record(*row) for row in cached(*args, **kwargs)]
+        get_records.invalidate = cached.invalidate
+        get_records.set = cached.set
+        return get_records
+    return decorator
+
+
+@cache_records(CategoryRecord)
 def get_categories():
-    """Get a list of all categories. Uses caching for quicker results."""
-    return DBSession.query(Category.name).all()
+    """Get a list of all categories. Uses caching for quicker results.
+
+    Returns:
+        A list of :class:`CategoryRecord`."""
+    return [tuple(row) for row in DBSession.query(Category.name)]
 
 
-@cache.cache_on_arguments()
+@cache_records(RecentPost)
 def get_recent_posts(count=7):
     """Get a list of recent posts. Uses caching for quicker results.
 
@@ -96,9 +207,107 @@ def get_recent_posts(count=7):
         ``count``: Number of recent posts to retrieve. Default: 7
 
     Returns:
-        A list of :class:`Entry` which are the most recent posts."""
-    return DBSession.query(Entry)\
-        .order_by(desc(Entry.entry_time))[:count]
+        A list of :class:`RecentPost` for the most recent posts."""
+    query = DBSession.query(Entry.id, Entry.title, Entry.entry_time)\
+        .order_by(desc(Entry.entry_time))
+    return [(id_, title, timestamp(entry_time))
+            for id_, title, entry_time in query[:count]]
+
+
+def render_markdown(text):
+    """Render the raw markdown ``text`` of an entry to html.
+
+    The text is escaped first so no raw HTML can be injected by an entry."""
+    import markdown
+    from markupsafe import escape
+    return markdown.markdown(escape(text))
+
+
+class RenderCache(object):
+    """A content addressed cache for :func:`render_markdown`.
+
+    Rendered html is stored under a hash of the markdown text and the
+    :data:`RENDER_VERSION`, so a cached value can never be outdated. Lookups
+    first go to a size bounded in-process LRU cache and then to the shared
+    :data:`cache` region (if it is configured) so all worker processes
+    profit from a rendering done by one of them. Renderings in the shared
+    region expire after ``expiration_time`` seconds, so the drafts of every
+    preview are not kept forever.
+
+    Attrs:
+        ``local``: The in-process :class:`repoze.lru.LRUCache`.
+
+        ``expiration_time``: Seconds a rendering is kept in the shared
+        region.
+
+        ``hits``: Number of lookups answered by the shared region.
+
+        ``misses``: Number of lookups that had to render the text.
+    """
+
+    def __init__(self, size=500, expiration_time=86400):
+        self.configure(size, expiration_time)
+
+    def configure(self, size, expiration_time=86400):
+        """Replace the in-process cache by an empty one holding at most
+        ``size`` renderings and reset the statistics."""
+        self.local = LRUCache(size)
+        self.expiration_time = expiration_time
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        """Return the cache key for the markdown ``text``."""
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return 'render:%d:%s' % (RENDER_VERSION, sha1(text).hexdigest())
+
+    def render(self, text):
+        """Return the html for ``text``, rendering it only if neither cache
+        has it."""
+        key = self.key(text)
+        html = self.local.get(key)
+        if html is None:
+            if cache_configured():
+                rendered = []
+                def creator():
+                    rendered.append(True)
+                    return render_markdown(text)
+                html = cache.get_or_create(key, creator,
+                                           self.expiration_time)
+                if rendered:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            else:
+                self.misses += 1
+                html = render_markdown(text)
+            self.local.put(key, html)
+        return html
+
+    def stats(self):
+        """Return a dictionary with the hit and miss counts of both caches.
+        """
+        return {'local_hits': self.local.hits,
+                'local_misses': self.local.misses,
+                'local_evictions': self.local.evictions,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+render_cache = RenderCache()
+"""The :class:`RenderCache` used by :meth:`Entry.render`. Its size and
+expiration are set by the ``render_cache.size`` and
+``render_cache.expiration_time`` settings."""
+
+
+def make_excerpt(html, paragraphs=2):
+    """Cut down rendered ``html`` to its first ``paragraphs`` paragraphs.
+
+    This is what is shown for an entry on listing pages, see
+    :attr:`Entry.trimmed_text`."""
+    trimmed_paragraphs = re.findall(r'<p>(.*?)<\/p>', html)[:paragraphs]
+    return "".join(map(lambda p: '<p>%s</p>' % p, trimmed_paragraphs))
 
 
 def userfinder(id_, request):
@@ -112,6 +321,10 @@ def userfinder(id_, request):
 class Entry(Base):
     """A single blog entry.
 
+    Entries are listed newest first by ``entry_time`` and ``id``. The table
+    has an index for this order and one for it within a category, so
+    listings and the last entry of a category don't scan the whole table.
+
     Attrs:
         ``id``: ID of the entry, used in URLs for instance.
 
@@ -120,6 +333,16 @@ class Entry(Base):
 
         ``_text``: The raw markdown text. Use ``Entry.text`` instead.
 
+        ``_html``: The html rendered from ``_text``. Use ``Entry.text``
+        instead.
+
+        ``_excerpt``: The first paragraphs of ``_html`` as created by
+        :func:`make_excerpt`. Use ``Entry.trimmed_text`` instead.
+
+        ``render_version``: The :data:`RENDER_VERSION` ``_html`` and
+        ``_excerpt`` were rendered with. If it does not match, both are
+        regenerated.
+
         ``entry_time``: The the entry was made.
 
         ``category_name``: Primary key of :class:`Category` and the name of
@@ -128,9 +351,17 @@ class Entry(Base):
         ``category``: Full access to the associated :class:`Category`.
     """
     __tablename__ = 'entry'
+    __table_args__ = (
+        Index('ix_entry_entry_time_id', 'entry_time', 'id'),
+        Index('ix_entry_category_name_entry_time_id',
+              'category_name', 'entry_time', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     title = Column(Text, unique=True, nullable=False)
     _text = Column('text', Text, nullable=False)
+    _html = Column('html', Text)
+    _excerpt = Column('excerpt', Text)
+    render_version = Column(Integer)
     entry_time = Column(DateTime, nullable=False)
     category_name = Column(Text, ForeignKey('category.name'))
     category = relationship('Category', backref='entries')
@@ -145,22 +376,40 @@ class Entry(Base):
     def text(self):
         """A markdown rendered html string as the article text.
 
-        The markdown text from the database is first escaped and then parsed
-        by markdown. Is a property, thus usage is ``entry.text`` _not_
-        ``entry.text()``"""
-        import markdown
-        from markupsafe import escape
-        return markdown.markdown(escape(self._text))
+        The html is stored alongside the markdown text and only rendered
+        again (see :meth:`render`) if it was made by an outdated
+        :data:`RENDER_VERSION`. Is a property, thus usage is ``entry.text``
+        _not_ ``entry.text()``. Assigning to it sets the markdown text."""
+        if self._html is None or self.render_version != RENDER_VERSION:
+            self.render()
+        return self._html
 
     @text.setter
     def text(self, text):
+        if text == self._text and self._html is not None and \
+                self.render_version == RENDER_VERSION:
+            return
         self._text = text
+        self.render()
+
+    def render(self):
+        """Render the markdown text through :data:`render_cache` and store
+        the result and its excerpt together with the current
+        :data:`RENDER_VERSION`."""
+        self._html = render_cache.render(self._text)
+        self._excerpt = make_excerpt(self._html)
+        self.render_version = RENDER_VERSION
 
     @property
     def trimmed_text(self):
-        """Same as ``Entry.text`` but only the first two paragraphs."""
-        trimmed_paragraphs = re.findall(r'<p>(.*?)<\/p>', self.text)[:2]
-        return "".join(map(lambda p: '<p>%s</p>' % p, trimmed_paragraphs))
+        """Same as ``Entry.text`` but only the first two paragraphs.
+
+        Only the stored excerpt is read so listings can leave the ``text``
+        and ``html`` columns unloaded (see :func:`defer
+        <sqlalchemy.orm.defer>`)."""
+        if self._excerpt is None or self.render_version != RENDER_VERSION:
+            self.render()
+        return self._excerpt
 
 
     @property
@@ -174,12 +423,243 @@ class Category(Base):
 
     Attrs:
         ``name``: The name of the category.
+
+        ``entry_count``: The number of entries in the category.
+
+        ``last_entry_time``: The time of the newest entry in the category or
+        ``None`` if it has none.
+
+    Both statistics are kept up to date by :func:`count_content_changes`
+    whenever entries are written or deleted through the ORM.
     """
     __tablename__ = 'category'
     name = Column(Text, primary_key=True)
+    entry_count = Column(Integer, nullable=False, default=0,
+                         server_default='0')
+    last_entry_time = Column(DateTime)
 
     def __init__(self, name):
         self.name = name
+        self.entry_count = 0
+
+
+LOADING_PROFILES = {
+    'listing': (defer(Entry._text), defer(Entry._html),
+                joinedload(Entry.category)),
+    'detail': (defer(Entry._excerpt), joinedload(Entry.category)),
+}
+"""Named sets of loader options for queries of :class:`Entry`, see
+:func:`query_entries`.
+
+``listing``: For pages that show many entries with their excerpt. The
+markdown text and the html are only loaded when accessed.
+
+``detail``: For a single entry shown or edited in full. Only the excerpt
+is left out.
+
+Both load the category of the entries in the same query."""
+
+
+def query_entries(profile):
+    """Return a query of :class:`Entry` that loads the columns and
+    relationships given by a :data:`profile <LOADING_PROFILES>`, e.g.
+    ``query_entries('listing').filter(...)``."""
+    return DBSession.query(Entry).options(*LOADING_PROFILES[profile])
+
+
+CATEGORY_COUNTER = 'categories'
+"""Name of the :class:`Counter` of all categories."""
+
+
+class Counter(Base):
+    """A denormalized count, e.g. of all categories, so pagers don't have
+    to run ``COUNT(*)`` on every request. The entries of a category are
+    counted in :attr:`Category.entry_count`; the entry listings page by key
+    (see :class:`miniblog.paginate.KeysetPage`) and need no total.
+
+    Counters are updated in the same transaction as the entries and
+    categories they count (see :func:`count_content_changes`). Use
+    :func:`get_count` to read them and :func:`repair_counters` if they ever
+    drift, e.g. after bulk changes that bypass the ORM.
+
+    Attrs:
+        ``name``: :data:`CATEGORY_COUNTER`.
+
+        ``value``: The current count.
+    """
+    __tablename__ = 'counter'
+    name = Column(Text, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+def counted(name):
+    """Return a select statement that counts the rows the counter ``name``
+    stands for, straight from the tables."""
+    table = {CATEGORY_COUNTER: Category.__table__}[name]
+    return select([func.count()]).select_from(table)
+
+
+def get_count(name):
+    """Return the value of the counter ``name`` or ``0`` if there is none.
+    """
+    value = DBSession.query(Counter.value).filter(Counter.name == name)\
+        .scalar()
+    return value or 0
+
+
+def last_entry_time(category_name):
+    """Return a scalar select of the time of the newest entry in a category.
+    ``category_name`` may be a column to correlate it with."""
+    entries = Entry.__table__
+    return select([func.max(entries.c.entry_time)])\
+        .where(entries.c.category_name == category_name)\
+        .as_scalar()
+
+
+def recount_categories():
+    """Return an update statement that sets :attr:`Category.entry_count`
+    and :attr:`Category.last_entry_time` of all categories from the
+    entries."""
+    categories = Category.__table__
+    entry_count = select([func.count()])\
+        .where(Entry.__table__.c.category_name == categories.c.name)\
+        .as_scalar()
+    return categories.update().values(
+        entry_count=entry_count,
+        last_entry_time=last_entry_time(categories.c.name))
+
+
+def repair_counters():
+    """Recount all counters and the statistics of all categories from the
+    tables, e.g. if they drifted after bulk changes. Must be run inside a
+    transaction."""
+    DBSession.query(Counter).delete()
+    DBSession.add(Counter(name=CATEGORY_COUNTER,
+                          value=DBSession.query(Category).count()))
+    DBSession.execute(recount_categories())
+    DBSession.flush()
+    DBSession.expire_all()
+
+
+updated_categories = weakref.WeakKeyDictionary()
+"""Names of the categories whose statistics were updated by
+:func:`count_content_changes` during the current flush of a session."""
+
+
+def count_content_changes(session, flush_context):
+    """Update the :class:`Counter` rows, :attr:`Category.entry_count` and
+    :attr:`Category.last_entry_time` for the entries and categories that
+    were just added, deleted, moved to another category or given another
+    time. Listens to the ``after_flush`` event so the updates are part of
+    the same transaction.
+
+    Counts are changed relatively (``value = value + 1``) so concurrent
+    transactions don't overwrite each other. A counter that does not exist
+    yet is created with the real count. The last entry time of a changed
+    category is looked up again from the index on the entries."""
+    counters = {}
+    categories = {}
+    def change(counts, name, delta):
+        if name is not None:
+            counts[name] = counts.get(name, 0) + delta
+    for instance in session.new:
+        if isinstance(instance, Entry):
+            change(categories, instance.category_name, 1)
+        elif isinstance(instance, Category):
+            change(counters, CATEGORY_COUNTER, 1)
+    for instance in session.deleted:
+        if isinstance(instance, Entry):
+            history = get_history(instance, 'category_name')
+            for name in chain(history.unchanged or (), history.deleted or ()):
+                change(categories, name, -1)
+        elif isinstance(instance, Category):
+            change(counters, CATEGORY_COUNTER, -1)
+    for instance in session.dirty:
+        if isinstance(instance, Entry) and instance not in session.deleted:
+            history = get_history(instance, 'category_name')
+            for name in history.deleted or ():
+                change(categories, name, -1)
+            for name in history.added or ():
+                change(categories, name, 1)
+            if get_history(instance, 'entry_time').has_changes():
+                change(categories, instance.category_name, 0)
+    table = Counter.__table__
+    for name, delta in sorted(counters.items()):
+        if not delta:
+            continue
+        result = session.execute(table.update()
+                                 .where(table.c.name == name)
+                                 .values(value=table.c.value + delta))
+        if not result.rowcount:
+            session.execute(table.insert().values(
+                name=name, value=counted(name).as_scalar()))
+    table = Category.__table__
+    for name, delta in sorted(categories.items()):
+        session.execute(table.update()
+                        .where(table.c.name == name)
+                        .values(entry_count=table.c.entry_count + delta,
+                                last_entry_time=last_entry_time(name)))
+    if categories:
+        updated_categories[session] = list(categories)
+
+
+def expire_category_statistics(session, flush_context):
+    """Expire the statistics of the categories loaded in ``session`` that
+    :func:`count_content_changes` updated, so they are loaded again when
+    accessed. Listens to the ``after_flush_postexec`` event."""
+    for name in updated_categories.pop(session, ()):
+        category = session.identity_map.get(identity_key(Category, name))
+        if category is not None:
+            session.expire(category, ['entry_count', 'last_entry_time'])
+
+
+changed_sessions = weakref.WeakSet()
+"""Database sessions that flushed changes to entries or categories in their
+current transaction."""
+
+
+def track_content_changes(session, flush_context):
+    """Remember ``session`` if it flushed a change to an :class:`Entry` or
+    :class:`Category`. Listens to the ``after_flush`` event."""
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (Entry, Category)):
+            changed_sessions.add(session)
+            return
+
+
+def track_bulk_content_changes(session, query, query_context, result):
+    """Same as :func:`track_content_changes` for :meth:`Query.update
+    <sqlalchemy.orm.query.Query.update>` and :meth:`Query.delete
+    <sqlalchemy.orm.query.Query.delete>`."""
+    entity = query.column_descriptions[0]['type']
+    if isinstance(entity, type) and issubclass(entity, (Entry, Category)):
+        changed_sessions.add(session)
+
+
+def invalidate_content_on_commit(session):
+    """Start a new content generation if the committed transaction changed
+    entries or categories. Listens to the ``after_commit`` event.
+
+    Invalidating only after the commit ensures no other request can cache
+    the old data again under the new generation. With a read replica, that
+    also takes :func:`miniblog.database.replica_tween_factory`, which reads
+    from the primary while the new generation is young."""
+    if session in changed_sessions:
+        changed_sessions.discard(session)
+        bump_content_generation()
+
+
+def forget_content_changes(session):
+    """Forget about changes of a rolled back transaction."""
+    changed_sessions.discard(session)
+
+listen(SASession, 'after_flush', track_content_changes)
+listen(SASession, 'after_flush', count_content_changes)
+listen(SASession, 'after_flush_postexec', expire_category_statistics)
+listen(SASession, 'after_bulk_update', track_bulk_content_changes)
+listen(SASession, 'after_bulk_delete', track_bulk_content_changes)
+listen(SASession, 'after_commit', invalidate_content_on_commit)
+listen(SASession, 'after_rollback', forget_content_changes)
 
 
 class RootFactory(object):
@@ -198,21 +678,26 @@ def mutated_additional_data(func):
     need this decorator to ensure the changes are afterwards propagated
     into the database.
 
-    From an implementation point it just sets the complete dictionary as a
-    new value."""
+    From an implementation point it assigns the complete dictionary to the
+    column if it differs from the stored one (see
+    :meth:`Session.sync_additional_data`). A new session is stored once it
+    has any data (see :meth:`Session.persist`)."""
     func_name = func.__name__
     @wraps(func)
     def handle_mutate(session, *args, **kwargs):
         log.debug("Mutating value on function %s with args %s and kwargs %s"
                   % (func_name, unicode(args), unicode(kwargs)))
         ret = func(session, *args, **kwargs)
-        session._additional_data = session._cache_additional_data
+        session.sync_additional_data()
+        if session._cache_additional_data:
+            session.persist()
         return ret
     return handle_mutate
 
 
 class MutableDict(Mutable, dict):
-    """Make a mutable dict for SQLAlchemy's ``PickleType``.
+    """Make a mutable dict for a column type like :class:`SessionData` or
+    SQLAlchemy's ``PickleType``.
 
     Usage:
 
@@ -220,7 +705,7 @@ class MutableDict(Mutable, dict):
 
         class MyModel(Base):
             my_data = Column('additional_data',
-                             MutableDict.as_mutable(PickleType))
+                             MutableDict.as_mutable(SessionData))
     """
     @classmethod
     def coerce(cls, key, value):
@@ -247,7 +732,139 @@ class MutableDict(Mutable, dict):
         return dict(self)
 
     def __setstate__(self, state):
-        self.update(self)
+        dict.update(self, state)
+
+
+class JSONSerializer(object):
+    """Serializes session data as compact JSON. Keys must be strings,
+    tuples come back as lists and strings as unicode."""
+    name = 'json'
+    prefix = 'j'
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackSerializer(object):
+    """Serializes session data with `msgpack <http://msgpack.org/>`_,
+    smaller and faster than JSON with the same types. It is optional and
+    has to be installed separately (``pip install miniblog[msgpack]``)."""
+    name = 'msgpack'
+    prefix = 'm'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError("The msgpack session serializer needs the "
+                             "msgpack package (0.5.2 or newer)")
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        return self.msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, payload):
+        return self.msgpack.unpackb(payload, raw=False)
+
+
+class PickleSerializer(object):
+    """Serializes session data with :mod:`pickle` as before. Any type can
+    be stored, but loading a pickle can execute code, so only use it if
+    nobody else can write to the database."""
+    name = 'pickle'
+    prefix = 'p'
+
+    def dumps(self, data):
+        return pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, payload):
+        return pickle.loads(payload)
+
+
+SESSION_SERIALIZERS = dict((serializer.name, serializer) for serializer in
+                           (JSONSerializer, MsgpackSerializer,
+                            PickleSerializer))
+"""The serializers for :class:`SessionData` by name, see
+:func:`configure_session_serializer`."""
+
+
+class SessionData(TypeDecorator):
+    """A column type for the data of a :class:`Session`, a dict stored with
+    the configured serializer (see :func:`configure_session_serializer`).
+
+    Each value starts with the ``prefix`` of its serializer, so rows written
+    with another one can still be read. Values without a prefix are pickles
+    written before the serializer could be chosen, they are converted by
+    ``initialize_miniblog_db``. Pickles are only read if
+    :attr:`allow_pickle` is set, loading one can execute code. Values are
+    compared as dicts."""
+    impl = LargeBinary
+
+    serializer = JSONSerializer()
+    """The serializer used for writing."""
+
+    allow_pickle = False
+    """Whether pickles are read, see :func:`configure_session_serializer`.
+    """
+
+    @classmethod
+    def dumps(cls, data):
+        """Return ``data`` serialized with the current serializer."""
+        return cls.serializer.prefix + cls.serializer.dumps(data)
+
+    @classmethod
+    def loads(cls, payload, allow_pickle=None):
+        """Return the dict serialized in ``payload`` by any serializer.
+
+        Raises :exc:`ValueError` for a pickle unless ``allow_pickle`` (by
+        default :attr:`allow_pickle`) is set."""
+        if allow_pickle is None:
+            allow_pickle = cls.allow_pickle
+        payload = str(payload)
+        serializer = cls.serializer
+        if payload[:1] != serializer.prefix:
+            for serializer_class in SESSION_SERIALIZERS.values():
+                if payload[:1] == serializer_class.prefix:
+                    serializer = serializer_class()
+                    break
+            else:
+                # from the PickleType column of older versions
+                serializer = None
+        if not allow_pickle and (serializer is None or
+                                 serializer.name == 'pickle'):
+            raise ValueError("Pickled session data is not allowed, see "
+                             "session.allow_pickle")
+        if serializer is None:
+            return pickle.loads(payload)
+        return serializer.loads(payload[1:])
+
+    def process_bind_param(self, value, dialect):
+        return self.dumps(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return self.loads(value) if value is not None else None
+
+    def compare_values(self, x, y):
+        return x == y
+
+
+def configure_session_serializer(name='json', allow_pickle=False):
+    """Write session data with the serializer ``name`` from
+    :data:`SESSION_SERIALIZERS`, e.g. from the ``session.serializer``
+    setting. Raises :exc:`ValueError` for an unknown or unavailable one.
+
+    Pickles are only read with the ``pickle`` serializer or if
+    ``allow_pickle`` is set (the ``session.allow_pickle`` setting), e.g.
+    until ``initialize_miniblog_db`` converted the sessions of an older
+    version. Otherwise sessions with pickled data are invalid."""
+    if name not in SESSION_SERIALIZERS:
+        raise ValueError("Unknown session serializer %r, use one of %s"
+                         % (name, ', '.join(sorted(SESSION_SERIALIZERS))))
+    SessionData.serializer = SESSION_SERIALIZERS[name]()
+    SessionData.allow_pickle = allow_pickle or name == 'pickle'
 
 
 class Session(Base):
@@ -293,17 +910,27 @@ class Session(Base):
 
         ``new``: Whether this is a new session.
 
+        ``stored``: Whether the session is in the database or will be with
+        the next flush. A new session is only stored when something is
+        written to it (see :meth:`persist`), so visitors that only read
+        pages cause no database writes and get no cookie.
+
         ``cache_*``: These attributes are cache managed. Don't access them
-        directly. Ever.
+        directly. Ever. The cached ``additional_data`` is a copy, so changes
+        to it are only written if there is a net change at the end (see
+        :meth:`sync_additional_data`).
     """
     implements(ISession)
     __tablename__ = 'session'
+    __table_args__ = (
+        Index('ix_session_created', 'created'),
+    )
 
     _id = Column('id', Text, primary_key=True)
     _created = Column('created', DateTime, nullable=False)
     _csrf_token = Column('csrf_token', Text, nullable=False)
     _additional_data = Column('additional_data',
-                              MutableDict.as_mutable(PickleType))
+                              MutableDict.as_mutable(SessionData))
     message_queue = relationship('SessionMessage',
                                  backref='session',
                                  lazy='joined')
@@ -312,17 +939,27 @@ class Session(Base):
     db_names = ['id', 'csrf_token', 'additional_data']
     """List of names that are handled dynamically by a cache"""
 
+    always_primary = True
+    """Sessions are read from and written to the primary database, a replica
+    might not have the latest one (see
+    :class:`miniblog.database.RoutingSession`)."""
+
     _cache_id = None
     _cache_created = None
     _cache_csrf_token = None
     _cache_additional_data = None
+    _stored_additional_data = None
+    _data_assigned = False
 
     defaults = {'additional_data': {}, 'id': '', 'csrf_token': ''}
     """Default values for specific attributes to be returned if the session
     is detached."""
 
+    stored = True
+
     _delete_cookie = False
-    """Whether the cookie should be deleted. Only used by :meth:`invalidate`.
+    """Whether the cookie should be deleted. Set by :meth:`invalidate` and
+    for an invalid cookie.
     """
 
 
@@ -332,7 +969,8 @@ class Session(Base):
         self._created = datetime.now()
         self._cache_created = self._created
         self.new = True
-        self.new_csrf_token()
+        self.stored = False
+        self.csrf_token = os.urandom(20).encode('hex')
         self._additional_data = {}
         self._cache_additional_data = self._additional_data
 
@@ -343,8 +981,7 @@ class Session(Base):
             cache_val = getattr(self, '_cache_%s' % name)
             if cache_val is None:
                 try:
-                    setattr(self, '_cache_%s' % name,
-                            getattr(self, '_%s' % name))
+                    self._set_cache(name, getattr(self, '_%s' % name))
                 except DetachedInstanceError:
                     return self.defaults[name]
                 cache_val = getattr(self, '_cache_%s' % name)
@@ -357,18 +994,55 @@ class Session(Base):
         if name in self.db_names:
             log.debug("Setting %s to %s" % (name, value))
             setattr(self, '_%s' % name, value)
-            setattr(self, '_cache_%s' % name, getattr(self, name))
+            self._set_cache(name, getattr(self, '_%s' % name))
         else:
             return super(Session, self).__setattr__(name, value)
 
+    def _set_cache(self, name, value):
+        """Cache the ``value`` of a column. The data is copied and the
+        stored value kept to compare it with later."""
+        if name == 'additional_data':
+            self._stored_additional_data = value
+            value = dict(value or {})
+        setattr(self, '_cache_%s' % name, value)
+
+    def sync_additional_data(self):
+        """Assign the cached data to the column if it differs from the
+        stored data, otherwise undo an earlier assignment. Setting the same
+        value again or setting a value and removing it again writes
+        nothing."""
+        data = self._cache_additional_data
+        if data is None:
+            return
+        if data != self._stored_additional_data:
+            self._additional_data = dict(data)
+            self._data_assigned = True
+        elif self._data_assigned:
+            set_committed_value(self, '_additional_data',
+                                self._stored_additional_data)
+            self._data_assigned = False
+
+    def persist(self):
+        """Add a new session to the database, so it is stored with the next
+        flush and its cookie is set. Called by everything that writes to the
+        session."""
+        if not self.stored:
+            log.debug("Storing new session with id %s" % self.id)
+            self.stored = True
+            self._delete_cookie = False
+            DBSession.add(self)
+
     def new_csrf_token(self):
         """Generate a new csrf token and store it in the database."""
         token = os.urandom(20).encode('hex')
         self.csrf_token = token
+        self.persist()
         return self.csrf_token
 
     def get_csrf_token(self):
-        """Return the current csrf token."""
+        """Return the current csrf token. The session is stored, the token
+        must still be known when the form is submitted."""
+        self.persist()
         return self.csrf_token
 
     @property
@@ -382,7 +1056,10 @@ class Session(Base):
         client side. The actual deletion is done by :meth:`_set_cookie`
         with a request callback. Here, only the ``_delete_cookie`` value
         is set to ``True``."""
-        DBSession.delete(self)
+        if self in DBSession.new:
+            DBSession.expunge(self)
+        elif self.stored:
+            DBSession.delete(self)
         self._delete_cookie = True
 
     def changed(self):
@@ -406,24 +1083,48 @@ class Session(Base):
         filter(lambda m: m.queue == queue and
                m.message == msg, self.message_queue):
             return
+        self.persist()
         message = SessionMessage(msg, queue)
         self.message_queue.append(message)
 
     def pop_flash(self, queue=''):
         """Retrieve a list of messages for a given queue.
 
-        Messages are removed from the database after they were retrieved.
+        Messages are removed from the database after they were retrieved,
+        all with a single ``DELETE``.
 
         Args:
             ``queue``: A specific queue from which the messages should be
-            fetched. If not specified, the default queue is used."""
-        messages = self.peek_flash(queue)
+            fetched. If not specified, the default queue is used.
+
+        Returns:
+            A list of the message strings, as from
+            :meth:`miniblog.sessions.StoredSession.pop_flash`."""
+        messages = self._queued_messages(queue)
+        if not messages:
+            return []
+        ids = [message.id for message in messages if message.id is not None]
+        if ids:
+            table = SessionMessage.__table__
+            DBSession.execute(table.delete().where(table.c.id.in_(ids)),
+                              mapper=SessionMessage)
+            mark_changed(DBSession())
+        # without history, removing them from the queue writes nothing
+        set_committed_value(self, 'message_queue',
+                            [message for message in self.message_queue
+                             if message not in messages])
         for message in messages:
-            DBSession.delete(message)
-        return messages
+            if message in DBSession:
+                DBSession.expunge(message)
+        return [message.message for message in messages]
 
     def peek_flash(self, queue=''):
         """Same as :meth:`pop_flash` but does not delete elements."""
+        return [message.message for message in
+                self._queued_messages(queue)]
+
+    def _queued_messages(self, queue):
+        """Return the :class:`SessionMessage` objects of ``queue``."""
         return filter(lambda m: m.queue == queue, self.message_queue)
 
 
@@ -487,7 +1188,7 @@ class Session(Base):
         return self.additional_data.__iter__()
 
     def __contains__(self, key):
-        return self._additional_data.__contains__(key)
+        return self.additional_data.__contains__(key)
 
     def _set_cookie(self, request, response):
         """A request callback to set (or delete) a cookie.
@@ -495,8 +1196,13 @@ class Session(Base):
         On an outgoing request a cookie is either set or deleted.
         Largely inspired by
         :meth:`pyramid.session.UnencryptedCookieSessionFactoryConfig._set_cookie`
-        with some added extensions for cookie deletion.
+        with some added extensions for cookie deletion. Only a :attr:`new`
+        session that was :meth:`stored <persist>` gets a cookie, the cookie
+        of an existing one never changes (as with
+        :class:`miniblog.sessions.StoredSession`).
         """
+        if not (self.new and self.stored) and not self._delete_cookie:
+            return False
         if not self._delete_cookie:
             if not self._cookie_on_exception and \
                 getattr(self.request, 'exception', None):
@@ -523,16 +1229,19 @@ class Session(Base):
                 secure=self._cookie_secure,
                 httponly=self._cookie_httponly)
         else:
-            if hasattr(response, 'unset_cookie'):
-                unset = response.unset_cookie
+            # unset_cookie only removes a cookie set on the response, the
+            # client's cookie has to be expired instead
+            if hasattr(response, 'delete_cookie'):
+                unset = response.delete_cookie
             else:
                 def unset(*args, **kwargs):
                     tmp_response = Response()
-                    tmp_response.set_cookie(*args, **kwargs)
+                    tmp_response.delete_cookie(*args, **kwargs)
                     response.headerlist.append(tmp_response.headerlist[-1])
             log.debug("Deleting cookie %s from session id %s"
                       % (self._cookie_name, self.id))
-            unset(self._cookie_name)
+            unset(self._cookie_name, path=self._cookie_path,
+                  domain=self._cookie_domain)
 
     def configure(self, cookie, on_exception, secure, httponly, path, name,
                   max_age, domain):
@@ -566,6 +1275,8 @@ class SessionMessage(Base):
     message = Column('message', Text, nullable=False)
     queue = Column('queue', Text, default='')
 
+    always_primary = True
+
     def __init__(self, msg, queue=''):
         self.message = msg
         self.queue = queue
@@ -612,7 +1323,9 @@ def get_session(request):
         log.debug("The exception message was: %s" % e)
         session, cookie = create_session(secret, request)
         log.debug("Created session with id %s and cookie %s" % (session.id, cookie))
-        DBSession.add(session)
+        # not stored until something is written to it, but a cookie of an
+        # unknown or expired session is deleted so it is not sent again
+        session._delete_cookie = name in request.cookies
     session.configure(cookie, on_exception, secure, httponly, path, name,
                       max_age, domain)
     request.add_response_callback(session._set_cookie)
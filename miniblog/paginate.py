@@ -0,0 +1,119 @@
+from datetime import datetime
+from miniblog.models import Entry
+from sqlalchemy import and_, or_
+from sqlalchemy.sql.expression import desc
+from webhelpers.html import HTML, literal
+
+
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(entry):
+    """Return the cursor for the position of ``entry`` in a listing, e.g.
+    ``20130301120000000000-12``. It is made from the ``entry_time`` and the
+    ``id`` of the entry, so it does not change when entries are added."""
+    return "%s-%d" % (entry.entry_time.strftime(CURSOR_TIME_FORMAT),
+                      entry.id)
+
+
+def parse_cursor(cursor):
+    """Return a tuple (``entry_time``, ``id``) for a cursor made by
+    :func:`make_cursor`. Raises :exc:`ValueError` for invalid cursors."""
+    entry_time, id_ = cursor.split('-')
+    return datetime.strptime(entry_time, CURSOR_TIME_FORMAT), int(id_)
+
+
+class KeysetPage(object):
+    """A page of entries, newest first, that is found by its position
+    instead of an offset.
+
+    A page continues right after (or before) the entry given by a cursor
+    (see :func:`make_cursor`). The database can then seek to it using an
+    index on ``(entry_time, id)`` instead of reading and discarding all
+    entries of the previous pages, so every page costs about the same as
+    the first one. Only one query is needed, no ``COUNT``.
+
+    Usage:
+
+    .. code-block:: python
+
+        url = partial(request.route_url, 'home')
+        page = KeysetPage(DBSession.query(Entry), url,
+                          after=request.GET.get('after'))
+
+    Args:
+        ``query``: A query of :class:`miniblog.models.Entry`, e.g. already
+        filtered for a category. It must not be ordered.
+
+        ``url``: A function that returns the url of the listing. It is
+        called with a ``_query`` argument as in :meth:`route_url
+        <pyramid.request.Request.route_url>`.
+
+        ``items_per_page``: Number of entries on a page.
+
+        ``after``: A cursor, the page shows the entries older than it.
+
+        ``before``: A cursor, the page shows the entries newer than it.
+
+        ``offset``: Only used without a cursor: Skip this many entries.
+        Keeps old urls of numbered pages working.
+
+    Attrs:
+        ``items``: The entries on this page.
+
+        ``has_newer``: Whether there are newer entries.
+
+        ``has_older``: Whether there are older entries.
+    """
+
+    def __init__(self, query, url, items_per_page=5, after=None,
+                 before=None, offset=0):
+        self.url = url
+        if before:
+            entry_time, id_ = parse_cursor(before)
+            items = query\
+                .filter(or_(Entry.entry_time > entry_time,
+                            and_(Entry.entry_time == entry_time,
+                                 Entry.id > id_)))\
+                .order_by(Entry.entry_time, Entry.id)\
+                .limit(items_per_page + 1)\
+                .all()
+            self.has_newer = len(items) > items_per_page
+            self.has_older = True
+            self.items = list(reversed(items[:items_per_page]))
+        else:
+            if after:
+                entry_time, id_ = parse_cursor(after)
+                query = query\
+                    .filter(or_(Entry.entry_time < entry_time,
+                                and_(Entry.entry_time == entry_time,
+                                     Entry.id < id_)))
+                self.has_newer = True
+            else:
+                self.has_newer = offset > 0
+            items = query\
+                .order_by(desc(Entry.entry_time), desc(Entry.id))\
+                .offset(None if after else offset)\
+                .limit(items_per_page + 1)\
+                .all()
+            self.has_older = len(items) > items_per_page
+            self.items = items[:items_per_page]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def pager(self):
+        """Return html links to the newer and the older page."""
+        links = []
+        if self.items and self.has_newer:
+            href = self.url(_query={'before': make_cursor(self.items[0])})
+            links.append(HTML.a(literal('&laquo; Newer posts'), href=href,
+                                class_='pager_link'))
+        if self.items and self.has_older:
+            href = self.url(_query={'after': make_cursor(self.items[-1])})
+            links.append(HTML.a(literal('Older posts &raquo;'), href=href,
+                                class_='pager_link'))
+        return literal(' ').join(links)
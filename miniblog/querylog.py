@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+from pyramid.settings import asbool
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listen
+from time import time
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+active_logs = threading.local()
+"""The :class:`QueryLog` objects recording in the current thread, see
+:func:`record_queries`."""
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more statements than its budget allows, see
+    :func:`query_budget_tween_factory`."""
+
+
+class QueryLog(object):
+    """The SQL statements executed while it was recording.
+
+    Attrs:
+        ``statements``: A list of tuples (``statement``, ``duration``) in the
+        order they were executed. An ``executemany`` is one statement.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        """The number of statements."""
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        """The total time of all statements in seconds."""
+        return sum(duration for statement, duration in self.statements)
+
+    def repeated(self, threshold=3):
+        """Return a list of tuples (``statement``, ``count``) of the
+        statements executed at least ``threshold`` times, most frequent
+        first.
+
+        Parameters are bound separately, so the same statement with other
+        values is counted together. That is the shape of an N+1 problem,
+        e.g. a relationship loaded lazily for each entry of a listing."""
+        counts = {}
+        for statement, duration in self.statements:
+            counts[statement] = counts.get(statement, 0) + 1
+        return sorted(((statement, count) for statement, count
+                       in counts.items() if count >= threshold),
+                      key=lambda item: -item[1])
+
+
+@contextmanager
+def record_queries():
+    """Record all statements executed in the current thread while the
+    context is active, on any engine.
+
+    Usage:
+
+    .. code-block:: python
+
+        with record_queries() as queries:
+            ...
+        print queries.count, queries.duration
+
+    Contexts may be nested, every active one records all statements."""
+    query_log = QueryLog()
+    logs = getattr(active_logs, 'logs', None)
+    if logs is None:
+        logs = active_logs.logs = []
+    logs.append(query_log)
+    try:
+        yield query_log
+    finally:
+        logs.remove(query_log)
+
+
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Remember when a statement started. Listens to the
+    ``before_cursor_execute`` event of all engines."""
+    if getattr(active_logs, 'logs', None):
+        conn.info.setdefault('query_started', []).append(time())
+
+
+def end_statement(conn, cursor, statement, parameters, context,
+                  executemany):
+    """Add a finished statement to all active :class:`QueryLog` objects.
+    Listens to the ``after_cursor_execute`` event of all engines."""
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    duration = time() - started.pop()
+    for query_log in getattr(active_logs, 'logs', ()):
+        query_log.statements.append((statement, duration))
+
+
+def fail_statement(conn, cursor, statement, parameters, context, exception):
+    """Same as :func:`end_statement` for a statement that raised. Listens to
+    the ``dbapi_error`` event of all engines, otherwise the start time would
+    stay on the (pooled) connection and later statements would be timed
+    from it."""
+    end_statement(conn, cursor, statement, parameters, context, False)
+
+listen(Engine, 'before_cursor_execute', start_statement)
+listen(Engine, 'after_cursor_execute', end_statement)
+listen(Engine, 'dbapi_error', fail_statement)
+
+
+def query_budget_tween_factory(handler, registry):
+    """A tween that records the statements of each request (see
+    :func:`record_queries`) and logs their number and time at debug level.
+
+    Statements repeated ``query_budget.repeat`` times (default: 3) are
+    logged as a warning, they are likely an N+1 problem. If a request runs
+    more statements than the ``query_budget.<route name>`` setting (or
+    ``query_budget`` for all routes) allows, a warning is logged as well,
+    with ``query_budget.strict = true`` :exc:`QueryBudgetExceeded` is raised
+    instead, e.g. for tests. Without a budget only repeated statements are
+    checked.
+
+    .. code-block:: ini
+
+        query_budget = 10
+        query_budget.view_categories = 5
+        query_budget.repeat = 3
+        query_budget.strict = false
+    """
+    settings = registry.settings
+    default = int(settings.get('query_budget') or 0)
+    repeat = int(settings.get('query_budget.repeat', 3))
+    strict = asbool(settings.get('query_budget.strict', False))
+
+    def query_budget_tween(request):
+        with record_queries() as queries:
+            response = handler(request)
+        route = request.matched_route.name if request.matched_route else ''
+        log.debug("%s %s: %d statements in %.1fms"
+                  % (request.method, request.path, queries.count,
+                     queries.duration * 1000))
+        for statement, count in queries.repeated(repeat):
+            log.warning("%s %s: Possible N+1 problem, statement executed "
+                        "%d times: %s" % (request.method, request.path,
+                                          count, statement))
+        budget = int(settings.get('query_budget.%s' % route) or default)
+        if budget and queries.count > budget:
+            message = "%s %s: %d statements exceed the budget of %d" \
+                % (request.method, request.path, queries.count, budget)
+            if strict:
+                raise QueryBudgetExceeded(message)
+            log.warning(message)
+        return response
+    return query_budget_tween
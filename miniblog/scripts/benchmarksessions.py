@@ -0,0 +1,180 @@
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, SessionData, \
+    SESSION_SERIALIZERS, configure_session_serializer
+from miniblog.sessions import make_session_factory
+from optparse import OptionParser
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from time import time
+import os
+import shutil
+import sys
+import tempfile
+import transaction
+
+
+usage = """%prog [options]
+
+Compare the session backends (see miniblog.sessions) with requests that
+only look for flash messages (as every page does), that store a draft entry
+and a flash message (a failed submission of the add form) and that load the
+draft and pop the message again. Everything is stored in a temporary
+directory, the sql backend uses an SQLite file there.
+
+With --serializers, compare the size of the session data with a draft and
+the time to write and read it with each serializer of the sql backend.
+(example: "%prog -n 2000 -b sql,cookie")"""
+
+BACKENDS = ['sql', 'memory', 'dbm', 'cookie']
+
+DRAFT = {'title': u'A draft entry',
+         'text': u'Some *markdown* text of a draft.\n\n' * 40,
+         'category': u'',
+         'submit': False,
+         'preview': False}
+"""Form data like the one :meth:`miniblog.views.AdminView.add_entry` keeps
+in the session when a submission fails."""
+
+
+def make_request(registry, factory, cookie=None):
+    request = Request.blank('/')
+    request.registry = registry
+    if cookie:
+        request.headers['Cookie'] = cookie
+    request.session = factory(request)
+    return request
+
+
+def finish_request(request):
+    """Run the response callbacks, commit and return the cookie."""
+    response = Response()
+    request._process_response_callbacks(response)
+    transaction.commit()
+    DBSession.remove()
+    cookie = response.headers.get('Set-Cookie')
+    return cookie.split(';')[0] if cookie else None
+
+
+def look(request):
+    request.session.peek_flash()
+
+
+def write(request):
+    request.session['add_entry_form'] = dict(DRAFT)
+    request.session.flash(u'Field "title" has the following error: '
+                          u'"This field is required."')
+
+
+def read(request):
+    request.session.get('add_entry_form')
+    request.session.pop_flash()
+    del request.session['add_entry_form']
+
+
+def benchmark(backend, count, directory):
+    """Run ``count`` requests of each kind with ``backend``.
+
+    Returns:
+        A list of tuples (``kind``, ``seconds``) and the length of the
+        cookie with a draft in it."""
+    settings = {'session.secret': 'secret',
+                'session.backend': backend,
+                'session.dbm.filename': os.path.join(directory,
+                                                     '%s.dbm' % backend)}
+    config = testing.setUp(settings=settings)
+    factory = make_session_factory(settings)
+    timings = []
+    try:
+        started = time()
+        for i in range(count):
+            request = make_request(config.registry, factory)
+            look(request)
+            finish_request(request)
+        timings.append(('look', time() - started))
+        cookies = []
+        started = time()
+        for i in range(count):
+            request = make_request(config.registry, factory)
+            write(request)
+            cookies.append(finish_request(request))
+        timings.append(('write', time() - started))
+        started = time()
+        for cookie in cookies:
+            request = make_request(config.registry, factory, cookie)
+            read(request)
+            finish_request(request)
+        timings.append(('read', time() - started))
+    finally:
+        testing.tearDown()
+    return timings, len(cookies[0]) if cookies else 0
+
+
+def benchmark_serializers(count):
+    """Dump and load the session data with a draft ``count`` times with
+    each available serializer.
+
+    Returns:
+        A list of tuples (``name``, ``size``, ``dump seconds``, ``load
+        seconds``)."""
+    data = {'add_entry_form': dict(DRAFT)}
+    results = []
+    try:
+        for name in sorted(SESSION_SERIALIZERS):
+            try:
+                configure_session_serializer(name)
+            except ValueError as e:
+                print('%s: %s' % (name, e))
+                continue
+            started = time()
+            for i in range(count):
+                payload = SessionData.dumps(data)
+            dumped = time()
+            for i in range(count):
+                SessionData.loads(payload)
+            results.append((name, len(payload), dumped - started,
+                            time() - dumped))
+    finally:
+        configure_session_serializer()
+    return results
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--requests', type='int', default=1000,
+                      help="Requests of each kind (default: %default)")
+    parser.add_option('-b', '--backends', default=','.join(BACKENDS),
+                      help="Comma separated backends (default: %default)")
+    parser.add_option('-s', '--serializers', action='store_true',
+                      default=False, help="Compare the serializers instead")
+    options, args = parser.parse_args(argv[1:])
+    if args:
+        parser.print_usage()
+        sys.exit(1)
+    if options.serializers:
+        print('%-8s %8s %10s %10s' % ('format', 'bytes', 'dump us',
+                                      'load us'))
+        for name, size, dump, load in benchmark_serializers(options.requests):
+            print('%-8s %8d %10.1f %10.1f' % (
+                name, size, dump * 1e6 / options.requests,
+                load * 1e6 / options.requests))
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        engine = make_engine({'sqlalchemy.url': 'sqlite:///%s/sessions.sqlite'
+                                                % directory})
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        print('%-8s %12s %12s %12s %8s' % ('backend', 'look/s', 'write/s',
+                                          'read/s', 'cookie'))
+        for backend in options.backends.split(','):
+            timings, cookie_size = benchmark(backend.strip(),
+                                             options.requests, directory)
+            print('%-8s %s %8d' % (backend, ' '.join(
+                '%12.0f' % (options.requests / max(seconds, 1e-6))
+                for kind, seconds in timings), cookie_size))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, Entry
+from optparse import OptionParser
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import select
+import codecs
+import json
+import os
+import re
+import sys
+
+
+usage = """%prog [options] <config_uri> <destination>
+
+Export all entries to a JSON Lines file (- for standard output) or, with
+--markdown, to a directory with one Markdown file per entry. Both can be
+imported again with import_miniblog_entries.
+(example: "%prog production.ini backup.jsonl")"""
+
+
+def iter_entries(connection, batch_size=500):
+    """Yield the rows (``id``, ``title``, ``text``, ``entry_time``,
+    ``category_name``) of all entries ordered by id.
+
+    The result is streamed from the database (with a server side cursor
+    where the driver supports it) and fetched ``batch_size`` rows at a
+    time, so memory use does not grow with the number of entries."""
+    entries = Entry.__table__
+    query = select([entries.c.id, entries.c.title, entries.c.text,
+                    entries.c.entry_time, entries.c.category_name])\
+        .order_by(entries.c.id)\
+        .execution_options(stream_results=True)
+    result = connection.execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def entry_record(row):
+    """Return the record of an entry as written to a JSON Lines file."""
+    id_, title, text, entry_time, category_name = row
+    return {'id': id_, 'title': title, 'text': text,
+            'entry_time': entry_time.isoformat(),
+            'category': category_name}
+
+
+def export_json_lines(rows, out):
+    """Write one JSON object per entry to the file ``out``.
+
+    Returns:
+        The number of entries written."""
+    count = 0
+    for row in rows:
+        out.write(json.dumps(entry_record(row), sort_keys=True))
+        out.write('\n')
+        count += 1
+    return count
+
+
+def markdown_filename(row):
+    """Return the name of the Markdown file of an entry, made from its id
+    and title, e.g. ``0012-my-first-entry.md``."""
+    slug = re.sub(r'[^a-z0-9]+', '-', row[1].lower()).strip('-')
+    return '%04d-%s.md' % (row[0], slug[:50] or 'entry')
+
+
+def export_markdown(rows, path):
+    """Write one Markdown file with front matter per entry into the
+    directory ``path``.
+
+    Returns:
+        The number of entries written."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    count = 0
+    for row in rows:
+        record = entry_record(row)
+        with codecs.open(os.path.join(path, markdown_filename(row)), 'w',
+                         encoding='utf-8') as f:
+            f.write(u'---\n')
+            f.write(u'title: %s\n' % record['title'])
+            if record['category']:
+                f.write(u'category: %s\n' % record['category'])
+            f.write(u'date: %s\n' % record['entry_time'])
+            f.write(u'---\n\n')
+            f.write(record['text'])
+        count += 1
+    return count
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-m', '--markdown', action='store_true', default=False,
+                      help="Write a directory of Markdown files")
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help="Entries fetched from the database at once "
+                           "(default: %default)")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.print_usage()
+        sys.exit(1)
+    config_uri, destination = args
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    with engine.connect() as connection:
+        rows = iter_entries(connection, options.batch_size)
+        if options.markdown:
+            count = export_markdown(rows, destination)
+        elif destination == '-':
+            count = export_json_lines(rows, sys.stdout)
+        else:
+            with open(destination, 'w') as out:
+                count = export_json_lines(rows, out)
+    sys.stderr.write("Exported %d entries\n" % count)
+
+if __name__ == '__main__':
+    main()
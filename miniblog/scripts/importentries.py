@@ -0,0 +1,263 @@
+from datetime import datetime
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, Entry, Category, RENDER_VERSION, \
+    render_markdown, make_excerpt, cache, bump_content_generation, \
+    repair_counters
+from miniblog.search import index_entries
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import select
+from time import time
+from zope.sqlalchemy import mark_changed
+import codecs
+import json
+import os
+import sys
+import transaction
+
+
+usage = """%prog [options] <config_uri> <source>
+
+Import entries from a directory of Markdown files or a JSON Lines file.
+
+Markdown files (*.md, *.markdown) may start with front matter:
+
+    ---
+    title: My first entry
+    category: News
+    date: 2013-03-01 12:00:00
+    ---
+
+Without a title the file name is used, without a date the time of the
+file. Each line of a JSON Lines file is an object with the keys "title",
+"text" and optionally "category" and "entry_time", as written by
+export_miniblog_entries.
+(example: "%prog production.ini posts/")"""
+
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d']
+"""Formats accepted for the date of an entry."""
+
+
+def parse_date(value):
+    """Return a :class:`datetime.datetime` for a date in one of the
+    :data:`DATE_FORMATS`. Raises :exc:`ValueError` otherwise."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            pass
+    raise ValueError("Unknown date format: %r" % value)
+
+
+def parse_front_matter(content):
+    """Split the front matter (simple ``key: value`` lines between two
+    ``---`` lines) from the markdown ``content``.
+
+    Returns:
+        A tuple (``metadata``, ``text``) where ``metadata`` is a dict with
+        lower case keys."""
+    lines = content.splitlines(True)
+    if not lines or lines[0].strip() != '---':
+        return {}, content
+    metadata = {}
+    for index, line in enumerate(lines[1:], 1):
+        if line.strip() == '---':
+            return metadata, ''.join(lines[index + 1:]).lstrip('\n')
+        if ':' in line:
+            key, value = line.split(':', 1)
+            metadata[key.strip().lower()] = value.strip()
+    return {}, content
+
+
+def read_markdown_directory(path):
+    """Yield an entry record (a dict as in a JSON Lines file) for each
+    Markdown file in the directory ``path``, sorted by file name."""
+    for name in sorted(os.listdir(path)):
+        base, extension = os.path.splitext(name)
+        if extension.lower() not in ('.md', '.markdown'):
+            continue
+        filename = os.path.join(path, name)
+        with codecs.open(filename, encoding='utf-8') as f:
+            metadata, text = parse_front_matter(f.read())
+        yield {'title': metadata.get('title') or base,
+               'text': text,
+               'category': metadata.get('category') or None,
+               'entry_time': metadata.get('date') or
+               datetime.fromtimestamp(os.path.getmtime(filename)).isoformat()}
+
+
+def read_json_lines(path):
+    """Yield an entry record for each line of the JSON Lines file ``path``
+    (``-`` for standard input)."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+MAX_IN_PARAMETERS = 500
+"""Values looked up with one ``IN`` clause by :func:`select_in`."""
+
+
+def prepare_entry(record):
+    """Turn an entry record into parameters for the insert statement of
+    :func:`import_entries`, including the rendered html. Runs inside the
+    worker processes."""
+    html = render_markdown(record['text'])
+    entry_time = record.get('entry_time')
+    return {'title': record['title'],
+            'text': record['text'],
+            'html': html,
+            'excerpt': make_excerpt(html),
+            'render_version': RENDER_VERSION,
+            'entry_time': parse_date(entry_time) if entry_time
+            else datetime.now(),
+            'category_name': record.get('category') or None}
+
+
+def batches(records, batch_size):
+    """Yield lists of at most ``batch_size`` items of ``records``."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def select_in(connection, columns, column, values):
+    """Return the rows of ``columns`` where ``column`` is one of ``values``.
+
+    Each value is a bound parameter and older SQLite versions allow only 999
+    of them in a statement, so they are looked up :data:`MAX_IN_PARAMETERS`
+    at a time, whatever the batch size."""
+    rows = []
+    for chunk in batches(values, MAX_IN_PARAMETERS):
+        rows.extend(connection.execute(select(columns)
+                                       .where(column.in_(chunk))))
+    return rows
+
+
+def import_entries(records, batch_size=500, processes=None,
+                   out=sys.stdout):
+    """Insert entries in batches of ``batch_size``, bypassing the ORM.
+
+    Each batch is rendered by a pool of ``processes`` workers (only in this
+    process if it is ``1``), then its missing categories and the entries
+    are inserted with one statement each and committed. Entries with a
+    title that already exists are skipped. Afterwards the counters are
+    recounted and a new :func:`content generation
+    <miniblog.models.content_generation>` is started.
+
+    Args:
+        ``records``: An iterable of entry records, e.g. from
+        :func:`read_json_lines`. It is only read one batch at a time.
+
+        ``batch_size``: Number of entries rendered and committed at once.
+
+        ``processes``: Number of worker processes. Default: number of CPUs.
+
+        ``out``: File to report progress and throughput to.
+
+    Returns:
+        The number of entries that were imported.
+    """
+    if processes is None:
+        processes = cpu_count()
+    pool = Pool(processes) if processes > 1 else None
+    entries = Entry.__table__
+    categories = Category.__table__
+    total = skipped = 0
+    started = time()
+    try:
+        for batch in batches(records, batch_size):
+            batch_started = time()
+            rows = pool.map(prepare_entry, batch) if pool \
+                else map(prepare_entry, batch)
+            with transaction.manager:
+                connection = DBSession.connection()
+                titles = [row['title'] for row in rows]
+                existing = set(title for title, in select_in(
+                    connection, [entries.c.title], entries.c.title, titles))
+                new_rows = []
+                for row in rows:
+                    if row['title'] in existing:
+                        skipped += 1
+                        out.write("Skipping existing entry %r\n"
+                                  % row['title'])
+                        continue
+                    existing.add(row['title'])
+                    new_rows.append(row)
+                if not new_rows:
+                    continue
+                names = set(row['category_name'] for row in new_rows
+                            if row['category_name'])
+                if names:
+                    names -= set(name for name, in select_in(
+                        connection, [categories.c.name], categories.c.name,
+                        names))
+                if names:
+                    connection.execute(categories.insert(),
+                                       [{'name': name, 'entry_count': 0}
+                                        for name in sorted(names)])
+                connection.execute(entries.insert(), new_rows)
+                index_entries(connection, select_in(
+                    connection,
+                    [entries.c.id, entries.c.title, entries.c.html],
+                    entries.c.title, [row['title'] for row in new_rows]))
+                mark_changed(DBSession())
+            total += len(new_rows)
+            out.write("Imported %d entries (%.1f entries/s)\n"
+                      % (len(new_rows),
+                         len(new_rows) / max(time() - batch_started, 1e-6)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if total:
+        with transaction.manager:
+            repair_counters()
+        bump_content_generation()
+    out.write("Done: imported %d entries, skipped %d in %.1fs "
+              "(%.1f entries/s)\n"
+              % (total, skipped, time() - started,
+                 total / max(time() - started, 1e-6)))
+    return total
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help="Entries rendered and committed at once "
+                           "(default: %default)")
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help="Number of worker processes (default: CPUs)")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.print_usage()
+        sys.exit(1)
+    config_uri, source = args
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    if 'dogpile.cache.backend' in settings:
+        cache.configure_from_config(settings, 'dogpile.cache.')
+    if os.path.isdir(source):
+        records = read_markdown_directory(source)
+    else:
+        records = read_json_lines(source)
+    import_entries(records, options.batch_size, options.processes)
+
+if __name__ == '__main__':
+    main()
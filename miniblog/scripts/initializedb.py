@@ -1,17 +1,187 @@
-from miniblog.models import DBSession, Base
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, Entry, Category, Counter, \
+    Session, SessionData, SessionMessage, repair_counters, \
+    recount_categories, configure_session_serializer
+from miniblog.search import create_search_index
 from pyramid.paster import get_appsettings, setup_logging
-from sqlalchemy import engine_from_config
+from sqlalchemy import inspect, Table, Column, Integer, LargeBinary, \
+    select, bindparam, type_coerce
 import os
 import sys
 import transaction
 
 
+schema_version = Table('schema_version', Base.metadata,
+                       Column('version', Integer, nullable=False))
+"""A table with a single row that holds the version of the database schema,
+i.e. the number of the last migration in :data:`MIGRATIONS` that was
+applied."""
 
 
+def add_columns(connection, table, *names):
+    """Add the columns ``names`` of ``table`` to the database if they are
+    missing."""
+    existing = set(column['name'] for column in
+                   inspect(connection).get_columns(table.name))
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+            table.name, column.name, column.type.compile(connection.dialect))
+        if column.server_default is not None:
+            compiler = connection.dialect.ddl_compiler(connection.dialect,
+                                                       None)
+            ddl += ' DEFAULT %s' % compiler.get_column_default_string(column)
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        connection.execute(ddl)
+
+
+def add_indexes(connection, table):
+    """Create all indexes of ``table`` that are missing in the database."""
+    existing = set(index['name'] for index in
+                   inspect(connection).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+def add_rendered_html(connection):
+    """Store the rendered html and excerpt of entries. Existing entries are
+    rendered when they are shown first or by ``rerender_miniblog_entries``.
+    """
+    add_columns(connection, Entry.__table__,
+                'html', 'excerpt', 'render_version')
+
+
+def add_listing_indexes(connection):
+    """Index the entries for listings by time, overall and per category."""
+    add_indexes(connection, Entry.__table__)
+
+
+def add_category_statistics(connection):
+    """Store the number of entries and the time of the last entry in each
+    category. They replace the per category counters."""
+    add_columns(connection, Category.__table__,
+                'entry_count', 'last_entry_time')
+    connection.execute(recount_categories())
+    counters = Counter.__table__
+    connection.execute(counters.delete()
+                       .where(counters.c.name.like('category:%')))
+
+
+def add_session_index(connection):
+    """Index the sessions by their creation time, so expired ones can be
+    found by ``sweep_miniblog_sessions``."""
+    add_indexes(connection, Session.__table__)
+
+
+def convert_session_data(connection, batch_size=500):
+    """Write the session data with the configured serializer instead of
+    pickle (see :class:`miniblog.models.SessionData`). Sessions that can't
+    be unpickled at all (e.g. truncated or of a class that is gone) are
+    deleted with their messages."""
+    table = Session.__table__
+    messages = SessionMessage.__table__
+    # the raw values, not loaded by the column type
+    payload = type_coerce(table.c.additional_data, LargeBinary)
+    update = table.update()\
+        .where(table.c.id == bindparam('session_id'))\
+        .values(additional_data=bindparam('payload', type_=LargeBinary))
+    prefix = SessionData.serializer.prefix
+    last_id = ''
+    while True:
+        rows = connection.execute(select([table.c.id, payload])
+                                  .where(table.c.id > last_id)
+                                  .order_by(table.c.id)
+                                  .limit(batch_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        invalid = []
+        for session_id, data in rows:
+            if data is None or str(data)[:1] == prefix:
+                continue
+            try:
+                data = SessionData.loads(data, allow_pickle=True)
+            except Exception:
+                invalid.append(session_id)
+                continue
+            try:
+                data = SessionData.dumps(data)
+            except (TypeError, ValueError):
+                # not serializable, it can still be read as it is
+                continue
+            updates.append({'session_id': session_id, 'payload': data})
+        if updates:
+            connection.execute(update, updates)
+        if invalid:
+            connection.execute(messages.delete()
+                               .where(messages.c.session_id.in_(invalid)))
+            connection.execute(table.delete().where(table.c.id.in_(invalid)))
+        last_id = rows[-1][0]
+
+
+MIGRATIONS = [
+    (1, add_rendered_html),
+    (2, add_listing_indexes),
+    (3, add_category_statistics),
+    (4, add_session_index),
+    (5, convert_session_data),
+]
+"""The steps to upgrade an existing database, as tuples (``version``,
+``function``) in ascending order. Each function is called with a
+connection inside a transaction and must not fail if it was (partially)
+applied before. Databases made from scratch start at the last version."""
+
+
+def get_schema_version(connection):
+    """Return the schema version of the database, ``0`` if it has none."""
+    version = connection.execute(schema_version.select()).scalar()
+    return version or 0
+
+
+def set_schema_version(connection, version):
+    """Store ``version`` as the schema version of the database."""
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def migrate(engine, out=sys.stdout):
+    """Create missing tables and bring an existing database up to the latest
+    schema version by running the missing steps of :data:`MIGRATIONS`, each
+    in its own transaction. Finally the search index is created if it is
+    missing (see :func:`miniblog.search.create_search_index`).
+
+    Returns:
+        The schema version of the database afterwards."""
+    new = not engine.has_table(Entry.__tablename__)
+    Base.metadata.create_all(engine)
+    latest = MIGRATIONS[-1][0]
+    with engine.begin() as connection:
+        if new:
+            set_schema_version(connection, latest)
+            version = latest
+        else:
+            version = get_schema_version(connection)
+    for step, migration in MIGRATIONS:
+        if step <= version:
+            continue
+        out.write("Migrating to schema version %d: %s\n"
+                  % (step, migration.__doc__.split('.')[0]))
+        with engine.begin() as connection:
+            migration(connection)
+            set_schema_version(connection, step)
+        version = step
+    create_search_index(engine)
+    return version
+
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
     print('usage: %s <config_uri>\n'
+          'Create the database or upgrade an existing one.\n'
           '(example: "%s development.ini")' % (cmd, cmd))
     sys.exit(1)
 
@@ -22,9 +192,12 @@ def main(argv=sys.argv):
     config_uri = argv[1]
     setup_logging(config_uri)
     settings = get_appsettings(config_uri)
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = make_engine(settings)
     DBSession.configure(bind=engine)
-    Base.metadata.create_all(engine)
+    configure_session_serializer(settings.get('session.serializer', 'json'))
+    migrate(engine)
+    with transaction.manager:
+        repair_counters()
 
 if __name__ == '__main__':
     main()
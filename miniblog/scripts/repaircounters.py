@@ -0,0 +1,42 @@
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, Counter, repair_counters, cache, \
+    bump_content_generation
+from pyramid.paster import get_appsettings, setup_logging
+import os
+import sys
+import transaction
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          'Count all entries and categories again and fix the stored '
+          'counters and category statistics.\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    if 'dogpile.cache.backend' in settings:
+        cache.configure_from_config(settings, 'dogpile.cache.')
+    with transaction.manager:
+        before = dict(DBSession.query(Counter.name, Counter.value))
+        repair_counters()
+        after = dict(DBSession.query(Counter.name, Counter.value))
+    changed = [name for name in sorted(set(before) | set(after))
+               if before.get(name) != after.get(name)]
+    for name in changed:
+        print('%s: %s -> %s' % (name, before.get(name), after.get(name)))
+    # the statistics of the categories may have changed as well
+    bump_content_generation()
+
+if __name__ == '__main__':
+    main()
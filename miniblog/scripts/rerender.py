@@ -0,0 +1,169 @@
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base, Entry, RENDER_VERSION, \
+    render_markdown, make_excerpt, cache, bump_content_generation
+from miniblog.search import index_entries
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import or_
+from sqlalchemy.sql.expression import bindparam
+from time import time
+from zope.sqlalchemy import mark_changed
+import os
+import sys
+import transaction
+
+
+usage = """%prog [options] <config_uri>
+
+Render the stored html of all entries again, e.g. after upgrading Markdown.
+(example: "%prog --processes 4 production.ini")"""
+
+
+def render_entry(row):
+    """Render a single ``(id, text)`` row. Runs inside the worker processes.
+
+    Returns:
+        A dict of parameters for the update statement built by
+        :func:`rerender`."""
+    id_, text = row
+    html = render_markdown(text)
+    return {'_id': id_, 'html': html, 'excerpt': make_excerpt(html),
+            'render_version': RENDER_VERSION}
+
+
+def read_checkpoint(checkpoint):
+    """Return the last entry id stored in the file ``checkpoint`` or ``0``
+    if there is none."""
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
+    return 0
+
+
+def write_checkpoint(checkpoint, last_id):
+    """Atomically store ``last_id`` in the file ``checkpoint``."""
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(str(last_id))
+    os.rename(tmp, checkpoint)
+
+
+def rerender(batch_size=500, processes=None, checkpoint=None,
+             everything=False, out=sys.stdout):
+    """Render entries again in batches of ``batch_size``.
+
+    Entries are read in the order of their id, one batch at a time, so memory
+    use is bounded by the batch size regardless of the size of the archive.
+    Each batch is rendered by a pool of ``processes`` workers (only in this
+    process if it is ``1``) and committed on its own, together with the
+    changes to the search index. Afterwards a new
+    :func:`content generation <miniblog.models.content_generation>` is
+    started so no outdated html is served from the cache.
+
+    Args:
+        ``batch_size``: Number of entries rendered and committed at once.
+
+        ``processes``: Number of worker processes. Default: number of CPUs.
+
+        ``checkpoint``: Optional filename. After each commit the last id is
+        stored there and a later run continues after it. It is removed once
+        all entries are done.
+
+        ``everything``: If ``True``, render all entries instead of only
+        those with an outdated :data:`RENDER_VERSION
+        <miniblog.models.RENDER_VERSION>`.
+
+        ``out``: File to report progress and throughput to.
+
+    Returns:
+        The number of entries that were rendered.
+    """
+    if processes is None:
+        processes = cpu_count()
+    pool = Pool(processes) if processes > 1 else None
+    table = Entry.__table__
+    update = table.update()\
+        .where(table.c.id == bindparam('_id'))\
+        .values(html=bindparam('html'), excerpt=bindparam('excerpt'),
+                render_version=bindparam('render_version'))
+    last_id = read_checkpoint(checkpoint)
+    if last_id:
+        out.write("Continuing after entry %d\n" % last_id)
+    total = 0
+    started = time()
+    try:
+        while True:
+            batch_started = time()
+            with transaction.manager:
+                query = DBSession.query(Entry.id, Entry._text, Entry.title)\
+                    .filter(Entry.id > last_id)
+                if not everything:
+                    query = query.filter(or_(
+                        Entry.render_version == None,
+                        Entry.render_version != RENDER_VERSION))
+                rows = query.order_by(Entry.id).limit(batch_size).all()
+                if not rows:
+                    break
+                texts = [(id_, text) for id_, text, title in rows]
+                if pool:
+                    params = pool.map(render_entry, texts)
+                else:
+                    params = map(render_entry, texts)
+                DBSession.execute(update, params)
+                index_entries(DBSession.connection(mapper=Entry),
+                              [(id_, title, param['html']) for
+                               (id_, text, title), param in zip(rows, params)])
+                mark_changed(DBSession())
+            last_id = rows[-1][0]
+            if checkpoint:
+                write_checkpoint(checkpoint, last_id)
+            total += len(rows)
+            out.write("Rendered %d entries up to id %d (%.1f entries/s)\n"
+                      % (len(rows), last_id,
+                         len(rows) / max(time() - batch_started, 1e-6)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    if total:
+        # the updates bypass the ORM, so cached pages are dropped here
+        bump_content_generation()
+    out.write("Done: rendered %d entries in %.1fs (%.1f entries/s)\n"
+              % (total, time() - started,
+                 total / max(time() - started, 1e-6)))
+    return total
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help="Entries rendered and committed at once "
+                           "(default: %default)")
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help="Number of worker processes (default: CPUs)")
+    parser.add_option('-c', '--checkpoint', default=None,
+                      help="File to store progress in, a later run "
+                           "continues from there")
+    parser.add_option('-a', '--all', dest='everything', action='store_true',
+                      default=False,
+                      help="Render all entries, not just outdated ones")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+    config_uri = args[0]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    if 'dogpile.cache.backend' in settings:
+        cache.configure_from_config(settings, 'dogpile.cache.')
+    rerender(options.batch_size, options.processes, options.checkpoint,
+             options.everything)
+
+if __name__ == '__main__':
+    main()
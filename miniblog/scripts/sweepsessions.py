@@ -0,0 +1,46 @@
+from miniblog.database import make_engine
+from miniblog.models import DBSession, Base
+from miniblog.sessions import sweep_sessions, make_session_store
+from optparse import OptionParser
+from pyramid.paster import get_appsettings, setup_logging
+import sys
+
+
+usage = """%prog [options] <config_uri>
+
+Delete the sessions in the database that expired (session.duration seconds
+after they were created) and their flash messages, in small batches. With
+session.backend = dbm, the expired sessions in the dbm file are deleted.
+(example: "%prog production.ini")"""
+
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help="Sessions deleted in one transaction "
+                           "(default: %default)")
+    parser.add_option('-p', '--pause', type='float', default=0,
+                      help="Seconds to wait between batches "
+                           "(default: %default)")
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+    config_uri = args[0]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    if settings.get('session.backend', 'sql') != 'sql':
+        sessions = make_session_store(settings).sweep(options.batch_size,
+                                                      options.pause)
+        print('Purged %d sessions' % sessions)
+        return
+    engine = make_engine(settings)
+    DBSession.configure(bind=engine)
+    Base.metadata.bind = engine
+    sessions, messages = sweep_sessions(
+        int(settings.get('session.duration', 3600)), options.batch_size,
+        options.pause)
+    print('Purged %d sessions and %d messages' % (sessions, messages))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+from HTMLParser import HTMLParser
+from miniblog.models import DBSession, Entry, query_entries
+from sqlalchemy import or_, select, func
+from sqlalchemy.event import listen
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session as SASession
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql import text
+from sqlalchemy.sql.expression import desc
+from webhelpers.html import HTML, escape, literal
+import logging
+import re
+import weakref
+
+
+log = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'entry_search'
+"""Name of the SQLite FTS5 table that indexes the title and the text of all
+entries. Its ``rowid`` is the id of the entry."""
+
+MAX_TERMS = 10
+"""Only this many words of a search are used."""
+
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+HIGHLIGHT_START, HIGHLIGHT_END = u'\x02', u'\x03'
+
+search_index_engines = weakref.WeakKeyDictionary()
+"""Whether the database of an engine has a search index, see
+:func:`has_search_index`."""
+
+
+def plain_text(html):
+    """Return the text of ``html`` without tags and with entities resolved,
+    as it is stored in the search index."""
+    text = HTMLParser().unescape(TAG_PATTERN.sub(u' ', html or u''))
+    return u' '.join(text.split())
+
+
+def search_terms(query):
+    """Return the words of the search ``query`` (at most
+    :data:`MAX_TERMS`). Everything else is dropped, so users can't use the
+    query syntax of the index or patterns of ``LIKE``."""
+    return TERM_PATTERN.findall(query)[:MAX_TERMS]
+
+
+def match_expression(terms):
+    """Return an FTS5 ``MATCH`` expression that finds entries containing all
+    ``terms``, the last one may also just be the start of a word."""
+    quoted = [u'"%s"' % term for term in terms]
+    quoted[-1] += u'*'
+    return u' '.join(quoted)
+
+
+def like_pattern(term):
+    """Return a ``LIKE`` pattern that finds ``term`` anywhere, with ``%``,
+    ``_`` and ``\\`` escaped (use with ``escape='\\\\'``)."""
+    term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return u'%%%s%%' % term
+
+
+def has_search_index(bind):
+    """Whether the database behind ``bind`` (an engine or a connection) has
+    a search index. Only SQLite databases with FTS5 have one. The answer is
+    remembered for each engine."""
+    engine = getattr(bind, 'engine', bind)
+    if engine not in search_index_engines:
+        search_index_engines[engine] = engine.dialect.name == 'sqlite' and \
+            engine.has_table(SEARCH_TABLE)
+    return search_index_engines[engine]
+
+
+def create_search_index(bind):
+    """Create the search index if the database supports it and fill it with
+    all entries if it did not exist yet. Other databases are searched with
+    ``LIKE`` instead.
+
+    Returns:
+        Whether the database has a search index now."""
+    engine = getattr(bind, 'engine', bind)
+    search_index_engines.pop(engine, None)
+    if engine.dialect.name != 'sqlite' or has_search_index(bind):
+        return has_search_index(bind)
+    try:
+        bind.execute("CREATE VIRTUAL TABLE %s USING fts5(title, body, "
+                     "tokenize='porter unicode61')" % SEARCH_TABLE)
+    except OperationalError:
+        log.warning("SQLite has no FTS5, searching with LIKE instead")
+        search_index_engines[engine] = False
+        return False
+    search_index_engines[engine] = True
+    rebuild_search_index(bind)
+    return True
+
+
+def rebuild_search_index(bind, batch_size=500):
+    """Fill the search index from the entry table again, e.g. after entries
+    were changed without the ORM. Entries without rendered html (e.g. right
+    after migrating an old database) are indexed with their markdown text.
+    """
+    if not has_search_index(bind):
+        return
+    table = Entry.__table__
+    bind.execute("DELETE FROM %s" % SEARCH_TABLE)
+    last_id = 0
+    while True:
+        rows = bind.execute(select([table.c.id, table.c.title,
+                                    func.coalesce(table.c.html,
+                                                  table.c.text)])
+                            .where(table.c.id > last_id)
+                            .order_by(table.c.id)
+                            .limit(batch_size)).fetchall()
+        if not rows:
+            break
+        index_entries(bind, rows)
+        last_id = rows[-1][0]
+
+
+def index_entries(bind, rows):
+    """Add entries to the search index or replace them there, e.g. after
+    inserting them without the ORM. ``rows`` are tuples (``id``,
+    ``title``, ``html``)."""
+    if rows and has_search_index(bind):
+        bind.execute(text("DELETE FROM %s WHERE rowid = :id" % SEARCH_TABLE),
+                     [{'id': id_} for id_, title, html in rows])
+        bind.execute(text("INSERT INTO %s (rowid, title, body) "
+                          "VALUES (:id, :title, :body)" % SEARCH_TABLE),
+                     [{'id': id_, 'title': title, 'body': plain_text(html)}
+                      for id_, title, html in rows])
+
+
+def index_content_changes(session, flush_context):
+    """Update the search index for the entries that were just added,
+    deleted or changed. Listens to the ``after_flush`` event so the index
+    changes with the same transaction."""
+    if not has_search_index(session.get_bind(Entry)):
+        return
+    removed = set()
+    indexed = []
+    for instance in session.deleted:
+        if isinstance(instance, Entry):
+            removed.add(instance.id)
+    for instance in session.new:
+        if isinstance(instance, Entry):
+            indexed.append(instance)
+    for instance in session.dirty:
+        if isinstance(instance, Entry) and instance not in session.deleted:
+            if any(get_history(instance, name).has_changes()
+                   for name in ('title', '_html')):
+                removed.add(instance.id)
+                indexed.append(instance)
+    if removed:
+        session.execute(text("DELETE FROM %s WHERE rowid = :id"
+                             % SEARCH_TABLE),
+                        [{'id': id_} for id_ in removed], mapper=Entry)
+    if indexed:
+        session.execute(text("INSERT INTO %s (rowid, title, body) "
+                             "VALUES (:id, :title, :body)" % SEARCH_TABLE),
+                        [{'id': entry.id, 'title': entry.title,
+                          'body': plain_text(entry._html)}
+                         for entry in indexed], mapper=Entry)
+
+listen(SASession, 'after_flush', index_content_changes)
+
+
+def highlight(snippet):
+    """Escape a snippet from the search index and turn the markers around
+    matches into ``<mark>`` tags."""
+    return literal(escape(snippet)
+                   .replace(HIGHLIGHT_START, literal('<mark>'))
+                   .replace(HIGHLIGHT_END, literal('</mark>')))
+
+
+class SearchResults(object):
+    """A page of entries matching a search, best matches first.
+
+    With a search index (see :func:`create_search_index`) the entries are
+    ranked by ``bm25`` with matches in the title counting ten times as much
+    as in the text, and each one comes with a snippet of its text with the
+    matches highlighted. Without one, titles and texts are searched with an
+    escaped ``LIKE``, newest entries first, and the excerpt is used instead.
+    Only one page plus one row is read, no ``COUNT``.
+
+    Args:
+        ``query``: The search as entered by the user, see
+        :func:`search_terms`.
+
+        ``url``: A function that returns the url of the search. It is
+        called with a ``_query`` argument as in :meth:`route_url
+        <pyramid.request.Request.route_url>`.
+
+        ``page``: The number of the page, starting at 1.
+
+        ``items_per_page``: Number of entries on a page.
+
+    Attrs:
+        ``items``: A list of tuples (``entry``, ``snippet``).
+
+        ``has_previous``: Whether there is a page before this one.
+
+        ``has_next``: Whether there are more results.
+    """
+
+    def __init__(self, query, url, page=1, items_per_page=10):
+        self.query = query
+        self.url = url
+        self.page = page
+        self.items = []
+        self.has_previous = page > 1
+        self.has_next = False
+        terms = search_terms(query)
+        if not terms:
+            return
+        offset = (page - 1) * items_per_page
+        if has_search_index(DBSession.get_bind(Entry)):
+            rows = DBSession.execute(
+                text("SELECT rowid, snippet(%(table)s, 1, :start, :end, "
+                     ":ellipsis, 32) FROM %(table)s "
+                     "WHERE %(table)s MATCH :match "
+                     "ORDER BY bm25(%(table)s, 10.0, 1.0) "
+                     "LIMIT :limit OFFSET :offset" % {'table': SEARCH_TABLE}),
+                {'start': HIGHLIGHT_START, 'end': HIGHLIGHT_END,
+                 'ellipsis': u'\u2026', 'match': match_expression(terms),
+                 'limit': items_per_page + 1, 'offset': offset},
+                mapper=Entry).fetchall()
+            self.has_next = len(rows) > items_per_page
+            rows = rows[:items_per_page]
+            entries = {}
+            if rows:
+                entries = dict((entry.id, entry) for entry in
+                               query_entries('listing')
+                               .filter(Entry.id.in_([id_ for id_, _ in rows])))
+            self.items = [(entries[id_], highlight(snippet))
+                          for id_, snippet in rows if id_ in entries]
+        else:
+            matches = query_entries('listing')
+            for term in terms:
+                pattern = like_pattern(term)
+                matches = matches.filter(or_(
+                    Entry.title.like(pattern, escape='\\'),
+                    Entry._text.like(pattern, escape='\\')))
+            entries = matches\
+                .order_by(desc(Entry.entry_time), desc(Entry.id))\
+                .offset(offset).limit(items_per_page + 1).all()
+            self.has_next = len(entries) > items_per_page
+            self.items = [(entry, literal(entry.trimmed_text))
+                          for entry in entries[:items_per_page]]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def pager(self):
+        """Return html links to the previous and the next page."""
+        links = []
+        if self.items and self.has_previous:
+            href = self.url(_query={'search': self.query,
+                                    'page': self.page - 1})
+            links.append(HTML.a(literal('&laquo; Previous results'),
+                                href=href, class_='pager_link'))
+        if self.items and self.has_next:
+            href = self.url(_query={'search': self.query,
+                                    'page': self.page + 1})
+            links.append(HTML.a(literal('More results &raquo;'), href=href,
+                                class_='pager_link'))
+        return literal(' ').join(links)
@@ -0,0 +1,502 @@
+from abc import ABCMeta, abstractmethod
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+from miniblog.models import DBSession, Session, SessionMessage, get_session, \
+    calc_digest, get_cookie_settings
+from pyramid.interfaces import ISession
+from repoze.lru import ExpiringLRUCache
+from sqlalchemy import select
+from time import time, sleep
+from zope.interface import implements
+from zope.sqlalchemy import mark_changed
+import json
+import logging
+import os
+import threading
+import transaction
+
+
+log = logging.getLogger(__name__)
+
+MAX_COOKIE_SIZE = 4096
+"""Browsers only keep cookies whose ``name=value`` is up to 4 KiB."""
+
+
+def mutates(func):
+    """Mark a :class:`StoredSession` as changed after ``func``, a method of
+    :class:`dict`."""
+    def mutate(session, *args, **kwargs):
+        ret = func(session, *args, **kwargs)
+        session.changed()
+        return ret
+    mutate.__name__ = func.__name__
+    mutate.__doc__ = func.__doc__
+    return mutate
+
+
+class StoredSession(dict):
+    """A session that keeps its data in a :class:`SessionStore` instead of
+    the database.
+
+    It has the same API as :class:`miniblog.models.Session`: It is a dict of
+    the session data and implements the
+    :class:`pyramid.interfaces.ISession` interface. All of it is loaded at
+    once and only saved if it was changed, a new session only once something
+    was written to it.
+
+    Args:
+        ``state``: The state of the session as returned by :meth:`state`,
+        ``None`` for a new session.
+
+        ``created``: A unix timestamp of when the session was created.
+
+    Attrs:
+        ``id``: The session id, a 20 byte hex string.
+
+        ``messages``: A list of tuples (``queue``, ``message``) of flash
+        messages.
+
+        ``new``: Whether this is a new session.
+
+        ``dirty``: Whether the session was changed and has to be saved.
+
+        ``invalidated``: Whether :meth:`invalidate` was called.
+    """
+    implements(ISession)
+
+    def __init__(self, state=None, created=None):
+        self.new = state is None
+        state = state or {}
+        dict.__init__(self, state.get('data') or {})
+        self.id = str(state.get('id') or os.urandom(20).encode('hex'))
+        self.created = created or int(time())
+        self.csrf_token = state.get('csrf_token') or \
+            os.urandom(20).encode('hex')
+        self.messages = [tuple(message)
+                         for message in state.get('messages') or ()]
+        self.dirty = False
+        self.invalidated = False
+
+    def state(self):
+        """Return the state of the session as a dict of JSON types."""
+        return {'id': self.id,
+                'csrf_token': self.csrf_token,
+                'data': dict(self),
+                'messages': [list(message) for message in self.messages]}
+
+    def changed(self):
+        """Mark the session as changed, e.g. after a value in it was
+        mutated."""
+        self.dirty = True
+
+    def invalidate(self):
+        """Drop all data of the session. It is deleted from the store and
+        the cookie is deleted at the end of the request."""
+        dict.clear(self)
+        self.messages = []
+        self.invalidated = True
+
+    def new_csrf_token(self):
+        """Generate and store a new CSRF token."""
+        self.csrf_token = os.urandom(20).encode('hex')
+        self.changed()
+        return self.csrf_token
+
+    def get_csrf_token(self):
+        """Return the current CSRF token. A new session is saved, the token
+        must still be known when the form is submitted."""
+        if self.new:
+            self.changed()
+        return self.csrf_token
+
+    def flash(self, msg, queue='', allow_duplicate=True):
+        """Store a message in the flash queue, see
+        :meth:`miniblog.models.Session.flash`."""
+        if not allow_duplicate and (queue, msg) in self.messages:
+            return
+        self.messages.append((queue, msg))
+        self.changed()
+
+    def pop_flash(self, queue=''):
+        """Return and remove the messages of ``queue``."""
+        messages = self.peek_flash(queue)
+        if messages:
+            self.messages = [message for message in self.messages
+                             if message[0] != queue]
+            self.changed()
+        return messages
+
+    def peek_flash(self, queue=''):
+        """Same as :meth:`pop_flash` but does not remove the messages."""
+        return [msg for msg_queue, msg in self.messages if msg_queue == queue]
+
+    __setitem__ = mutates(dict.__setitem__)
+    __delitem__ = mutates(dict.__delitem__)
+    clear = mutates(dict.clear)
+    update = mutates(dict.update)
+    setdefault = mutates(dict.setdefault)
+    pop = mutates(dict.pop)
+    popitem = mutates(dict.popitem)
+
+
+class SessionStore(object):
+    """Where the state of :class:`StoredSession` objects is kept.
+
+    The cookie holds a value returned by :meth:`save` and signed with the
+    ``session.secret``, usually the id of the session.
+
+    Subclasses implement :meth:`load`, :meth:`save` and :meth:`delete`.
+
+    Args:
+        ``duration``: Seconds a session is valid after it was created.
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, duration):
+        self.duration = duration
+
+    @abstractmethod
+    def load(self, value):
+        """Return the state saved for the cookie ``value`` or ``None``."""
+
+    @abstractmethod
+    def save(self, session):
+        """Save the state of ``session``.
+
+        Returns:
+            The value for the cookie."""
+
+    @abstractmethod
+    def delete(self, value):
+        """Delete the state saved for the cookie ``value``."""
+
+    def sweep(self, batch_size=500, pause=0, now=None):
+        """Delete the sessions that expired, like :func:`sweep_sessions`.
+        Only needed by stores that don't drop them on their own.
+
+        Returns:
+            The number of deleted sessions."""
+        return 0
+
+
+class MemoryStore(SessionStore):
+    """Keeps at most ``size`` sessions in the memory of the process. Fast,
+    but each process has its own sessions and they are lost on a restart.
+
+    .. code-block:: ini
+
+        session.backend = memory
+        session.memory.size = 10000
+    """
+
+    def __init__(self, duration, size=10000):
+        super(MemoryStore, self).__init__(duration)
+        self.sessions = ExpiringLRUCache(size, duration)
+
+    def load(self, value):
+        state = self.sessions.get(value)
+        return json.loads(state) if state is not None else None
+
+    def save(self, session):
+        # a copy, so later changes to the session are not shared
+        self.sessions.put(session.id, json.dumps(session.state(),
+                                                 separators=(',', ':')))
+        return session.id
+
+    def delete(self, value):
+        self.sessions.invalidate(value)
+
+
+class RegionStore(SessionStore):
+    """Keeps sessions in a :mod:`dogpile.cache` ``region``, e.g. one with the
+    :class:`miniblog.caching.JSONDBMBackend` in a file shared by all
+    processes:
+
+    .. code-block:: ini
+
+        session.backend = dbm
+        session.dbm.filename = %(here)s/sessions.dbm
+
+    Sessions are only deleted when their client comes back after they
+    expired, the others are deleted by :meth:`sweep`.
+    """
+
+    def __init__(self, duration, region):
+        super(RegionStore, self).__init__(duration)
+        self.region = region
+
+    def load(self, value):
+        state = self.region.get(value, expiration_time=self.duration)
+        return state if state is not NO_VALUE else None
+
+    def save(self, session):
+        self.region.set(session.id, session.state())
+        return session.id
+
+    def delete(self, value):
+        self.region.delete(value)
+
+    def sweep(self, batch_size=500, pause=0, now=None):
+        """Delete the sessions that expired if the backend of the region
+        supports it, like :meth:`JSONDBMBackend.delete_expired
+        <miniblog.caching.JSONDBMBackend.delete_expired>`."""
+        delete_expired = getattr(self.region.backend, 'delete_expired', None)
+        if delete_expired is None:
+            return 0
+        return delete_expired(self.duration, batch_size, pause, now)
+
+
+class CookieStore(SessionStore):
+    """Keeps the whole session in its cookie, nothing is stored on the
+    server. The cookie is signed, but not encrypted, and it is sent with
+    every request, so keep sessions small. A session that does not fit into
+    :data:`MAX_COOKIE_SIZE` is saved without its data (e.g. a long draft)
+    and a warning is logged: It is saved after the transaction was
+    committed, so raising an error would only lose the response. If even
+    that is too large, the flash messages are dropped as well.
+
+    .. code-block:: ini
+
+        session.backend = cookie
+    """
+
+    def load(self, value):
+        try:
+            value = str(value)
+            state = json.loads(urlsafe_b64decode(
+                value + '=' * (-len(value) % 4)))
+        except (TypeError, ValueError, UnicodeError):
+            return None
+        return state if isinstance(state, dict) else None
+
+    def encode(self, state):
+        """Return the cookie value for ``state``."""
+        return urlsafe_b64encode(json.dumps(state, separators=(',', ':')))\
+            .rstrip('=')
+
+    def __init__(self, duration, cookie_name='session'):
+        super(CookieStore, self).__init__(duration)
+        self.cookie_name = cookie_name
+
+    def save(self, session):
+        # the whole cookie is "name=digest:value:created", see load_session
+        size = len('%s=%s::%d' % (self.cookie_name, calc_digest('', '', 0),
+                                  session.created))
+        state = session.state()
+        value = self.encode(state)
+        for dropped in ('data', 'messages'):
+            if size + len(value) <= MAX_COOKIE_SIZE:
+                break
+            log.warning("Session %s is too large for a cookie (%d bytes), "
+                        "dropping its %s" % (session.id, size + len(value),
+                                             dropped))
+            state[dropped] = type(state[dropped])()
+            value = self.encode(state)
+        return value
+
+    def delete(self, value):
+        pass
+
+
+def make_session_store(settings):
+    """Create the :class:`SessionStore` selected by the ``session.backend``
+    setting: ``memory``, ``dbm`` or ``cookie``."""
+    backend = settings.get('session.backend', 'sql')
+    duration = int(settings.get('session.duration', 3600))
+    if backend == 'memory':
+        return MemoryStore(duration,
+                           int(settings.get('session.memory.size', 10000)))
+    if backend == 'dbm':
+        region = make_region().configure(
+            'miniblog.json_dbm',
+            arguments={'filename': settings['session.dbm.filename']})
+        return RegionStore(duration, region)
+    if backend == 'cookie':
+        return CookieStore(duration,
+                           settings.get('session.cookie_name', 'session'))
+    raise ValueError("Unknown session backend %r, use one of sql, memory, "
+                     "dbm, cookie" % backend)
+
+
+def make_session_factory(settings):
+    """Return the session factory for the ``session.backend`` setting.
+
+    ``sql`` (the default) is :func:`miniblog.models.get_session` with
+    sessions in the database. All others use a :class:`StoredSession` in
+    the store made by :func:`make_session_store` and the same cookie
+    settings. Both behave the same, e.g. flash messages are returned as
+    strings and only new or changed sessions set a cookie.
+
+    Usage:
+
+    .. code-block:: python
+
+        config = Configurator(session_factory=make_session_factory(settings))
+    """
+    if settings.get('session.backend', 'sql') == 'sql':
+        return get_session
+    store = make_session_store(settings)
+
+    def session_factory(request):
+        return load_session(store, request)
+    return session_factory
+
+
+def load_session(store, request):
+    """Load the :class:`StoredSession` of ``request`` from ``store`` or
+    create a new one, and register a response callback that saves it."""
+    on_exception, secure, httponly, path, name, secret, \
+        duration, max_age, domain = get_cookie_settings(request)
+    cookie = request.cookies.get(name)
+    session = value = None
+    if cookie:
+        try:
+            hash_, value, timestamp = cookie.strip('"').split(':')
+            timestamp = int(timestamp)
+            if hash_ != calc_digest(secret, value, timestamp):
+                raise ValueError("Invalid session hash!")
+            if timestamp + store.duration < time():
+                store.delete(value)
+                raise ValueError("Session expired!")
+            state = store.load(value)
+            if state is None:
+                raise ValueError("No session in store!")
+            session = StoredSession(state, timestamp)
+        except ValueError as e:
+            log.debug("The exception message was: %s" % e)
+    if session is None:
+        session = StoredSession()
+
+    def save_session(request, response):
+        if not on_exception and getattr(request, 'exception', None):
+            return
+        if session.invalidated:
+            if value is not None:
+                store.delete(value)
+            if cookie:
+                response.delete_cookie(name, path=path, domain=domain)
+        elif session.dirty:
+            new_value = store.save(session)
+            response.set_cookie(
+                name, ':'.join([calc_digest(secret, new_value,
+                                            session.created),
+                                new_value, str(session.created)]),
+                max_age=max_age, path=path, domain=domain, secure=secure,
+                httponly=httponly)
+        elif cookie and session.new:
+            # unknown or expired session
+            response.delete_cookie(name, path=path, domain=domain)
+    request.add_response_callback(save_session)
+    return session
+
+
+def sweep_sessions(duration, batch_size=500, pause=0, now=None):
+    """Delete the database sessions that expired ``duration`` seconds after
+    they were created, and their messages.
+
+    Expired sessions are found by the index on ``created`` and deleted in
+    batches of at most ``batch_size``, each in its own transaction, so the
+    database is never locked for long. Requests can write in between,
+    ``pause`` seconds if it is set.
+
+    Returns:
+        A tuple (``sessions``, ``messages``) with the number of deleted
+        rows.
+    """
+    cutoff = datetime.fromtimestamp((now or time()) - duration)
+    sessions = Session.__table__
+    messages = SessionMessage.__table__
+    deleted_sessions = deleted_messages = 0
+    while True:
+        with transaction.manager:
+            ids = [id_ for id_, in DBSession.execute(
+                select([sessions.c.id])
+                .where(sessions.c.created < cutoff)
+                .limit(batch_size), mapper=Session)]
+            if ids:
+                deleted_messages += DBSession.execute(
+                    messages.delete().where(messages.c.session_id.in_(ids)),
+                    mapper=Session).rowcount
+                deleted_sessions += DBSession.execute(
+                    sessions.delete().where(sessions.c.id.in_(ids)),
+                    mapper=Session).rowcount
+                mark_changed(DBSession())
+        if len(ids) < batch_size:
+            break
+        if pause:
+            sleep(pause)
+    log.debug("Purged %d expired sessions and %d messages"
+              % (deleted_sessions, deleted_messages))
+    return deleted_sessions, deleted_messages
+
+
+class SessionSweeper(threading.Thread):
+    """A daemon thread that calls :func:`sweep_sessions` every ``interval``
+    seconds, or :meth:`SessionStore.sweep` of ``store`` if it is given.
+    Started by :func:`start_session_sweeper`.
+
+    The thread has its own database session, each sweep is logged at info
+    level and errors are logged, but don't stop the thread."""
+
+    def __init__(self, interval, duration, batch_size=500, store=None):
+        super(SessionSweeper, self).__init__(name='session-sweeper')
+        self.daemon = True
+        self.interval = interval
+        self.duration = duration
+        self.batch_size = batch_size
+        self.store = store
+        self.stopped = threading.Event()
+
+    def sweep(self):
+        """Delete the expired sessions once.
+
+        Returns:
+            A tuple (``sessions``, ``messages``) with the number of deleted
+            sessions and messages."""
+        if self.store is not None:
+            return self.store.sweep(self.batch_size), 0
+        return sweep_sessions(self.duration, self.batch_size)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                sessions, messages = self.sweep()
+                if sessions:
+                    log.info("Purged %d expired sessions and %d messages"
+                             % (sessions, messages))
+            except Exception:
+                log.exception("Sweeping expired sessions failed")
+            finally:
+                transaction.abort()
+                DBSession.remove()
+
+    def stop(self):
+        """Stop the thread after the current sweep."""
+        self.stopped.set()
+
+
+def start_session_sweeper(settings):
+    """Start a :class:`SessionSweeper` if the ``session.sweep_interval``
+    setting is more than 0 seconds and sessions are kept in the database or
+    a dbm file. The other stores drop expired sessions on their own.
+    Instead, ``sweep_miniblog_sessions`` can be run, e.g. by cron.
+
+    .. code-block:: ini
+
+        session.sweep_interval = 3600
+        session.sweep_batch_size = 500
+
+    Returns:
+        The thread or ``None``."""
+    interval = float(settings.get('session.sweep_interval') or 0)
+    backend = settings.get('session.backend', 'sql')
+    if interval <= 0 or backend not in ('sql', 'dbm'):
+        return None
+    sweeper = SessionSweeper(
+        interval, int(settings.get('session.duration', 3600)),
+        int(settings.get('session.sweep_batch_size', 500)),
+        make_session_store(settings) if backend == 'dbm' else None)
+    sweeper.start()
+    return sweeper
@@ -2,16 +2,20 @@
 <%block name="body">
 <% from miniblog.models import pretty_date %>
 <ul>
-% for index, (category, last_entry) in enumerate(categories, 1):
+% for index, category in enumerate(categories, 1):
     <li class="
     % if index == 1:
     first
-    % elif index == len(view.categories):
+    % elif index == len(categories.items):
     last
     % endif
     ">
         <a href="${view.request.route_url('view_category', id_=category.name)}">${category.name}</a>
-        <span class="date">(Last post: ${pretty_date(last_entry) if last_entry else 'No posts made yet'})</span>
+        % if category.last_entry_time:
+        <span class="date">(${category.entry_count} ${'post' if category.entry_count == 1 else 'posts'}, last post: ${pretty_date(category.last_entry_time)})</span>
+        % else:
+        <span class="date">(No posts made yet)</span>
+        % endif
     </li>
 % endfor
 </ul>
@@ -15,7 +15,7 @@
         <li class="category_list
         % if index == 1:
 		    first
-		% elif index == len(view.categories):
+		% elif index == len(categories):
 		    last
 		% endif
         ">
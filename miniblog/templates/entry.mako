@@ -1,5 +1,5 @@
 <%inherit file="layout.mako" />
-<%def name="display_entry(entry, trim=True)">
+<%def name="display_entry(entry, trim=True, snippet=None)">
 <% from pyramid.security import has_permission %>
 	<h1>
 	    <a href="${view.request.route_url('view_entry', id_=entry.id)}">${entry.title}</a>
@@ -12,9 +12,16 @@
         </a>
         % endif
     </h1>
-	<span class="date header-date">Posted on: ${entry.entry_time.strftime('%Y-%m-%d %H:%M:%S')}</span>
+	<span class="date header-date">Posted on: ${entry.entry_time.strftime('%Y-%m-%d %H:%M:%S')}
+	% if entry.category:
+	    in <a href="${view.request.route_url('view_category', id_=entry.category.name)}">${entry.category.name}</a>
+	% endif
+	</span>
 	<div class="entry-wrap">
-        % if trim:
+        % if snippet is not None:
+            <p>${snippet|n}</p>
+            <a href="${view.request.route_url('view_entry', id_=entry.id)}">Read more...</a>
+        % elif trim:
             ${entry.trimmed_text|n}
             <a href="${view.request.route_url('view_entry', id_=entry.id)}">Read more...</a>
         % else:
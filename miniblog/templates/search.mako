@@ -3,9 +3,11 @@
 <%namespace name="entry_file" file="entry.mako" />
 <%block name="body">
 % if results:
-	% for entry in results:
-		${entry_file.display_entry(entry)}
+	% for entry, snippet in results:
+		${entry_file.display_entry(entry, snippet=snippet)}
 	% endfor
+
+${results.pager()}
 % else:
 	Nothing found... Sorry!
 % endif
@@ -0,0 +1,62 @@
+    <div id="sidebar2">
+        <h3>
+		    Categories
+	    </h3>
+    % if categories:
+	    <ul>
+	    % for index, category in enumerate(categories, 1):
+		    <li class="
+		    % if index == 1:
+		    first
+		    % elif index == len(categories):
+		    last
+		    % endif
+		    ">
+			    <a href="${request.route_url('view_category', id_=category.name)}">
+				    ${category.name}
+			    </a>
+		    </li>
+	    % endfor
+	    </ul>
+    % else:
+        <p>No categories have been added yet.</p>
+			        % endif
+    </div>
+    <div id="sidebar1">
+	    <h3>
+		    About
+	    </h3>
+	    <p>
+		    This blog is about posting some interesting, mostly technical stuff.
+	    </p>
+    </div>
+    <div id="sidebar12">
+	    <h3>
+		    Recent posts
+	    </h3>
+	    % if recent:
+	    <ul>
+	    % for index, entry in enumerate(recent, 1):
+		    <li class="recent 
+		    % if index == 1:
+		    first
+		    % elif index == len(recent):
+		    last
+		    % endif
+		    ">
+			    <a href="${request.route_url('view_entry', id_=entry.id)}" title="${entry.title}">
+			    % if len(entry.title) > 31:
+			        ${entry.title[:28] + "..."}
+			    % else:
+				    ${entry.title}
+			    % endif
+			    </a>
+			    <span class="date">&nbsp;(${entry.pretty_date})</span>
+		    </li>
+	    % endfor
+	    </ul>
+	    % else:
+	        No posts have been made yet.
+	    % endif
+	    
+    </div>
@@ -1,11 +1,25 @@
 from miniblog.models import DBSession
 from pyramid import testing
+from StringIO import StringIO
+import os
 import transaction
 import unittest
 
 
 
 
+def configure_cache():
+    """Configure the cache region once for all tests."""
+    from miniblog.models import cache
+    from tempfile import mktemp
+    try:
+        cache.configure_from_config({'cache.backend': 'dogpile.cache.dbm',
+                     'cache.arguments.filename': mktemp()},
+                    'cache.')
+    except Exception:
+        pass
+
+
 """class TestMyView(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -72,14 +86,8 @@ class TestModels(unittest.TestCase):
         self.config = testing.setUp()
         from sqlalchemy import create_engine
         engine = create_engine('sqlite://')
-        from miniblog.models import Category, Base, DBSession, cache
-        from tempfile import mktemp
-        try:
-            cache.configure_from_config({'cache.backend': 'dogpile.cache.dbm',
-                         'cache.arguments.filename': mktemp()},
-                        'cache.')
-        except Exception:
-            pass
+        from miniblog.models import Category, Base, DBSession
+        configure_cache()
         DBSession.configure(bind=engine)
         Base.metadata.create_all(engine)
         with transaction.manager:
@@ -236,6 +244,130 @@ class TestModels(unittest.TestCase):
         get_recent_posts.invalidate()
         self.assertEqual(len(get_recent_posts()), 7)
 
+    def test_get_recent_posts_records(self):
+        from miniblog.models import get_recent_posts, Entry, RecentPost
+        entry = Entry('Title', 'A long text ' * 100)
+        DBSession.add(entry)
+        DBSession.flush()
+        get_recent_posts.invalidate()
+        recent, = get_recent_posts()
+        self.assertIsInstance(recent, RecentPost)
+        self.assertEqual(recent.id, entry.id)
+        self.assertEqual(recent.title, 'Title')
+        self.assertEqual(recent.pretty_date, "just now")
+
+    def test_invalidation_on_commit(self):
+        from miniblog.models import get_recent_posts, get_categories, \
+            content_generation, Entry, Category
+        generation = content_generation()
+        self.assertEqual(len(get_recent_posts()), 0)
+
+        # uncommitted and rolled back changes don't invalidate
+        DBSession.add(Entry('Title 1', 'Text 1'))
+        DBSession.flush()
+        self.assertEqual(len(get_recent_posts()), 0)
+        transaction.abort()
+        self.assertEqual(content_generation(), generation)
+
+        # a commit does
+        with transaction.manager:
+            DBSession.add(Entry('Title 1', 'Text 1'))
+        self.assertNotEqual(content_generation(), generation)
+        self.assertEqual(len(get_recent_posts()), 1)
+
+        # so do deleted categories and bulk changes
+        self.assertEqual(len(get_categories()), 3)
+        with transaction.manager:
+            DBSession.delete(DBSession.query(Category).first())
+        self.assertEqual(len(get_categories()), 2)
+        with transaction.manager:
+            DBSession.query(Entry).delete()
+        self.assertEqual(len(get_recent_posts()), 0)
+
+        # other objects don't invalidate
+        generation = content_generation()
+        with transaction.manager:
+            from miniblog.models import SessionMessage
+            DBSession.add(SessionMessage("Message"))
+        self.assertEqual(content_generation(), generation)
+
+    def test_counters(self):
+        from miniblog.models import Entry, Category, Counter, get_count, \
+            repair_counters, CATEGORY_COUNTER
+        from zope.sqlalchemy import mark_changed
+        from datetime import datetime
+        def counts():
+            DBSession.expire_all()
+            categories = DBSession.query(Category)\
+                .filter(Category.name.in_(['Category 0', 'Category 1']))\
+                .order_by(Category.name)
+            return tuple(category.entry_count for category in categories)
+        def last_entry_time(name):
+            return DBSession.query(Category).get(name).last_entry_time
+        self.assertEqual(get_count(CATEGORY_COUNTER), 3)
+        with transaction.manager:
+            for i in range(3):
+                entry = Entry('Title %d' % i, '...', 'Category 0')
+                entry.entry_time = datetime(2013, 3, 1 + i)
+                DBSession.add(entry)
+            DBSession.add(Entry('Title 3', '...'))
+        self.assertEqual(counts(), (3, 0))
+        self.assertEqual(last_entry_time('Category 0'), datetime(2013, 3, 3))
+        self.assertIsNone(last_entry_time('Category 1'))
+
+        # moving between categories
+        with transaction.manager:
+            entry = DBSession.query(Entry).filter_by(title='Title 2').one()
+            entry.category = DBSession.query(Category).get('Category 1')
+        self.assertEqual(counts(), (2, 1))
+        self.assertEqual(last_entry_time('Category 0'), datetime(2013, 3, 2))
+        self.assertEqual(last_entry_time('Category 1'), datetime(2013, 3, 3))
+
+        # loaded categories are up to date after a flush
+        category = DBSession.query(Category).get('Category 0')
+        entry = DBSession.query(Entry).filter_by(title='Title 1').one()
+        entry.entry_time = datetime(2013, 2, 1)
+        DBSession.flush()
+        self.assertEqual(category.last_entry_time, datetime(2013, 3, 1))
+        transaction.abort()
+        self.assertEqual(last_entry_time('Category 0'), datetime(2013, 3, 2))
+
+        # deleting, also when the category was changed before
+        with transaction.manager:
+            entry = DBSession.query(Entry).filter_by(title='Title 1').one()
+            entry.category_name = 'Category 1'
+            DBSession.flush()
+            DBSession.delete(entry)
+        self.assertEqual(counts(), (1, 1))
+        self.assertEqual(last_entry_time('Category 1'), datetime(2013, 3, 3))
+
+        # deleted categories are counted
+        with transaction.manager:
+            DBSession.delete(DBSession.query(Category).get('Category 2'))
+        self.assertEqual(get_count(CATEGORY_COUNTER), 2)
+
+        # bulk changes bypass the counters until they are repaired
+        with transaction.manager:
+            DBSession.query(Entry).filter(Entry.category_name != None)\
+                .delete()
+        self.assertEqual(counts(), (1, 1))
+        with transaction.manager:
+            DBSession.execute(Category.__table__.insert()
+                              .values(name='Category 3'))
+            mark_changed(DBSession())
+        self.assertEqual(get_count(CATEGORY_COUNTER), 2)
+        with transaction.manager:
+            repair_counters()
+        self.assertEqual(counts(), (0, 0))
+        self.assertEqual(get_count(CATEGORY_COUNTER), 3)
+        self.assertIsNone(last_entry_time('Category 1'))
+
+        # missing counters are created with the real count once they change
+        with transaction.manager:
+            DBSession.query(Counter).delete()
+            DBSession.add(Category('Category 4'))
+        self.assertEqual(get_count(CATEGORY_COUNTER), 4)
+
     def test_userfinder(self):
         from miniblog.models import userfinder
         request = testing.DummyRequest()
@@ -263,6 +395,107 @@ class TestModels(unittest.TestCase):
         entry = Entry('Title', text)
         self.assertEqual(entry.text, expected)
 
+    def test_Entry_rendered_html(self):
+        from miniblog import models
+        from miniblog.models import Entry, RENDER_VERSION
+
+        # html is rendered once and stored with the renderer version
+        entry = Entry('Title', 'Some *text*')
+        self.assertEqual(entry._html, "<p>Some <em>text</em></p>")
+        self.assertEqual(entry.render_version, RENDER_VERSION)
+
+        # accessing the text does not render again
+        entry._html = "<p>Stored</p>"
+        self.assertEqual(entry.text, "<p>Stored</p>")
+        entry.text = 'Some *text*'
+        self.assertEqual(entry.text, "<p>Stored</p>")
+
+        # changing the source renders again
+        entry.text = 'Other text'
+        self.assertEqual(entry.text, "<p>Other text</p>")
+
+        # an outdated renderer version renders again
+        entry._html = "<p>Stored</p>"
+        entry.render_version = RENDER_VERSION - 1
+        self.assertEqual(entry.text, "<p>Other text</p>")
+        self.assertEqual(entry.render_version, models.RENDER_VERSION)
+
+    def test_RenderCache(self):
+        from miniblog.models import RenderCache, cache
+        render_cache = RenderCache(size=2)
+        self.assertEqual(render_cache.render('*One*'), '<p><em>One</em></p>')
+        self.assertEqual(render_cache.render('*One*'), '<p><em>One</em></p>')
+        stats = render_cache.stats()
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['local_misses'], 1)
+
+        # the shared region answers once the local cache evicted a text
+        cache.delete(render_cache.key('Two'))
+        render_cache.render('Two')
+        render_cache.render('Three')
+        render_cache.render('*One*')
+        stats = render_cache.stats()
+        self.assertGreater(stats['local_evictions'], 0)
+        self.assertEqual(stats['hits'], 1)
+
+        # renderings in the shared region expire
+        from dogpile.cache.api import CachedValue
+        from time import time
+        render_cache = RenderCache(size=2, expiration_time=60)
+        render_cache.render('Four')
+        key = render_cache.key('Four')
+        value = cache.backend.get(key)
+        cache.backend.set(key, CachedValue(
+            value.payload, dict(value.metadata, ct=time() - 61)))
+        render_cache.local.clear()
+        render_cache.render('Four')
+        self.assertEqual(render_cache.stats()['misses'], 2)
+        self.assertGreater(cache.backend.get(key).metadata['ct'], time() - 60)
+
+        # the renderer version is part of the key
+        from miniblog import models
+        key = render_cache.key('Two')
+        models.RENDER_VERSION += 1
+        try:
+            self.assertNotEqual(render_cache.key('Two'), key)
+        finally:
+            models.RENDER_VERSION -= 1
+
+    def test_rerender(self):
+        from miniblog.models import Entry, RENDER_VERSION
+        from miniblog.scripts.rerender import rerender
+        from StringIO import StringIO
+        from tempfile import mktemp
+        with transaction.manager:
+            for i in range(5):
+                entry = Entry('Title %d' % i, 'Text *%d*' % i)
+                entry._html = entry._excerpt = 'stale'
+                entry.render_version = RENDER_VERSION - 1
+                DBSession.add(entry)
+            entry = Entry('Current', 'Current text')
+            entry._html = 'current'
+            DBSession.add(entry)
+
+        checkpoint = mktemp()
+        out = StringIO()
+        self.assertEqual(rerender(batch_size=2, processes=1,
+                                  checkpoint=checkpoint, out=out), 5)
+        self.assertIn("Done: rendered 5 entries", out.getvalue())
+        self.assertFalse(os.path.exists(checkpoint))
+        entries = DBSession.query(Entry).order_by(Entry.id).all()
+        for i, entry in enumerate(entries[:5]):
+            self.assertEqual(entry._html, '<p>Text <em>%d</em></p>' % i)
+            self.assertEqual(entry._excerpt, entry._html)
+            self.assertEqual(entry.render_version, RENDER_VERSION)
+        self.assertEqual(entries[5]._html, 'current')
+
+        # a checkpoint skips everything up to the stored id
+        with open(checkpoint, 'w') as f:
+            f.write(str(entries[5].id))
+        self.assertEqual(rerender(processes=1, checkpoint=checkpoint,
+                                  everything=True, out=out), 0)
+        self.assertEqual(rerender(processes=1, everything=True, out=out), 6)
+
     def test_Entry_trimmed_text(self):
         from miniblog.models import Entry
         text = ("First paragraph\n"
@@ -272,6 +505,69 @@ class TestModels(unittest.TestCase):
                 "Third paragraph\n")
         entry = Entry('Title', text)
         self.assertNotIn("Third paragraph", entry.trimmed_text)
+        self.assertEqual(entry._excerpt, entry.trimmed_text)
+
+        # listings only load the excerpt, not the full text
+        from miniblog.models import query_entries
+        entry.category_name = 'Category 0'
+        DBSession.add(entry)
+        DBSession.flush()
+        DBSession.expunge_all()
+        entry = query_entries('listing')\
+            .filter(Entry.title == 'Title').one()
+        self.assertEqual(entry.trimmed_text,
+                         "<p>First paragraph</p><p>Second paragraph</p>")
+        self.assertNotIn('_text', entry.__dict__)
+        self.assertNotIn('_html', entry.__dict__)
+        self.assertEqual(entry.__dict__['category'].name, 'Category 0')
+
+        # details load the full text but no excerpt
+        DBSession.expunge_all()
+        entry = query_entries('detail')\
+            .filter(Entry.title == 'Title').one()
+        self.assertIn('_text', entry.__dict__)
+        self.assertIn('_html', entry.__dict__)
+        self.assertNotIn('_excerpt', entry.__dict__)
+        self.assertEqual(entry.__dict__['category'].name, 'Category 0')
+
+    def test_Entry_listing_columns(self):
+        from miniblog.models import Entry, query_entries
+        from miniblog.querylog import record_queries
+        DBSession.add(Entry('Title', 'First\n\nSecond\n\nThird'))
+        DBSession.flush()
+        DBSession.expunge_all()
+        with record_queries() as queries:
+            entry = query_entries('listing')\
+                .filter(Entry.title == 'Title').one()
+            self.assertEqual(entry.trimmed_text,
+                             "<p>First</p><p>Second</p>")
+        (statement, duration), = queries.statements
+        self.assertIn('entry.excerpt', statement)
+        self.assertNotIn('entry.text', statement)
+        self.assertNotIn('entry.html', statement)
+
+        # the stored excerpt follows edits of the text
+        entry.text = 'Changed'
+        DBSession.flush()
+        DBSession.expunge_all()
+        entry = query_entries('listing').filter(Entry.title == 'Title').one()
+        self.assertEqual(entry.trimmed_text, "<p>Changed</p>")
+        self.assertNotIn('_text', entry.__dict__)
+
+    def test_loading_profiles_category(self):
+        from miniblog.models import Entry, LOADING_PROFILES, query_entries
+        from miniblog.querylog import record_queries
+        DBSession.add(Entry('Title', '...', 'Category 0'))
+        DBSession.add(Entry('Uncategorized', '...'))
+        DBSession.flush()
+        for profile in sorted(LOADING_PROFILES):
+            DBSession.expunge_all()
+            with record_queries() as queries:
+                entries = query_entries(profile).order_by(Entry.title).all()
+                self.assertEqual([entry.category and entry.category.name
+                                  for entry in entries],
+                                 ['Category 0', None])
+            self.assertEqual(queries.count, 1, profile)
 
     def test_Entry_pretty_date(self):
         from miniblog.models import Entry
@@ -354,4 +650,1318 @@ class TestModels(unittest.TestCase):
                 (Allow, 'administrator', 'edit') ]
         self.assertEqual(fac.__acl__, acl)
 
-# TODO: Session tests
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from miniblog.models import Base
+        self.config = testing.setUp(settings={'session.secret': 'secret'})
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        transaction.abort()
+        DBSession.remove()
+        testing.tearDown()
+
+    def request(self, cookie=None, factory=None):
+        from miniblog.models import get_session
+        from pyramid.request import Request
+        request = Request.blank('/')
+        if cookie:
+            request.headers['Cookie'] = cookie
+        request.registry = self.config.registry
+        request.session = (factory or get_session)(request)
+        return request
+
+    def respond(self, request):
+        from pyramid.response import Response
+        response = Response()
+        request._process_response_callbacks(response)
+        transaction.commit()
+        return response.headers.get('Set-Cookie')
+
+    def test_lazy_session(self):
+        from miniblog.models import Session
+        request = self.request()
+        self.assertEqual(request.session.peek_flash(), [])
+        self.assertEqual(request.session.pop_flash(), [])
+        self.assertIsNone(request.session.get('form'))
+        self.assertNotIn(request.session, DBSession.new)
+        self.assertIsNone(self.respond(request))
+        self.assertEqual(DBSession.query(Session).count(), 0)
+
+        request = self.request()
+        request.session.flash('Message')
+        cookie = self.respond(request).split(';')[0]
+        self.assertEqual(DBSession.query(Session).count(), 1)
+        request = self.request(cookie)
+        self.assertFalse(request.session.new)
+        self.assertEqual(request.session.pop_flash(), [u'Message'])
+        self.respond(request)
+
+        # form data and CSRF tokens are written, too
+        request = self.request()
+        request.session['form'] = {'title': 'Title'}
+        self.assertTrue(self.respond(request))
+        request = self.request()
+        token = request.session.get_csrf_token()
+        cookie = self.respond(request).split(';')[0]
+        self.assertEqual(self.request(cookie).session.get_csrf_token(), token)
+        self.assertEqual(DBSession.query(Session).count(), 3)
+
+    def test_invalid_cookie(self):
+        from miniblog.models import Session
+        request = self.request('session=abc:def:0')
+        self.assertIn('Max-Age=0', self.respond(request))
+        request = self.request()
+        request.session.invalidate()
+        self.assertIn('Max-Age=0', self.respond(request))
+        self.assertEqual(DBSession.query(Session).count(), 0)
+
+    def test_no_net_change(self):
+        from miniblog.querylog import record_queries
+        request = self.request()
+        request.session['form'] = {'title': u'Title'}
+        request.session.flash(u'Message')
+        cookie = self.respond(request).split(';')[0]
+        request = self.request(cookie)
+        with record_queries() as queries:
+            request.session['form'] = {'title': u'Title'}
+            request.session['other'] = 1
+            del request.session['other']
+            self.assertIn('form', request.session)
+            self.assertEqual(len(request.session.pop_flash()), 1)
+            self.respond(request)
+        self.assertEqual([statement.split()[0] for statement, duration
+                          in queries.statements], ['DELETE'])
+        request = self.request(cookie)
+        self.assertEqual(request.session['form'], {'title': u'Title'})
+        self.assertEqual(request.session.peek_flash(), [])
+        request.session['form'] = {'title': u'Other'}
+        token = request.session.new_csrf_token()
+        self.respond(request)
+        request = self.request(cookie)
+        self.assertEqual(request.session['form'], {'title': u'Other'})
+        self.assertEqual(request.session.get_csrf_token(), token)
+        self.respond(request)
+
+    def test_serializers(self):
+        from miniblog.models import SessionData, SESSION_SERIALIZERS, \
+            MutableDict, Session, configure_session_serializer
+        from sqlalchemy import select, type_coerce, LargeBinary
+        import cPickle as pickle
+        data = {'add_entry_form': {'title': u'T\xedtle', 'text': u'Text',
+                                   'category': None, 'submit': False}}
+        self.addCleanup(configure_session_serializer)
+        payloads = {}
+        for name in sorted(SESSION_SERIALIZERS):
+            try:
+                configure_session_serializer(name)
+            except ValueError:
+                continue  # msgpack is optional
+            payloads[name] = SessionData.dumps(data)
+            self.assertEqual(SessionData.loads(payloads[name]), data)
+        self.assertRaises(ValueError, configure_session_serializer, 'yaml')
+
+        # values of other serializers are still read, pickles only if
+        # they are allowed
+        configure_session_serializer('json')
+        for name, payload in payloads.items():
+            if name == 'pickle':
+                self.assertRaises(ValueError, SessionData.loads, payload)
+                payload = SessionData.loads(payload, allow_pickle=True)
+                self.assertEqual(payload, data)
+            else:
+                self.assertEqual(SessionData.loads(payload), data)
+        for protocol in (0, 2):
+            legacy = pickle.dumps(MutableDict(data), protocol)
+            self.assertRaises(ValueError, SessionData.loads, legacy)
+            self.assertEqual(SessionData.loads(legacy, allow_pickle=True),
+                             data)
+            self.assertEqual(pickle.loads(legacy), data)
+        configure_session_serializer('json', allow_pickle=True)
+        self.assertEqual(SessionData.loads(legacy), data)
+        configure_session_serializer('json')
+
+        request = self.request()
+        request.session['add_entry_form'] = data['add_entry_form']
+        cookie = self.respond(request).split(';')[0]
+        table = Session.__table__
+        payload, = DBSession.execute(select([type_coerce(
+            table.c.additional_data, LargeBinary)])).fetchone()
+        self.assertEqual(str(payload), payloads['json'])
+        self.assertEqual(self.request(cookie).session['add_entry_form'],
+                         data['add_entry_form'])
+        self.respond(request)
+
+        # a session with a pickle is invalid
+        from zope.sqlalchemy import mark_changed
+        DBSession.execute(table.update().values(additional_data=type_coerce(
+            buffer(legacy), LargeBinary)), mapper=Session)
+        mark_changed(DBSession())
+        transaction.commit()
+        request = self.request(cookie)
+        self.assertTrue(request.session.new)
+        self.assertNotIn('add_entry_form', request.session)
+        self.assertIn('Max-Age=0', self.respond(request))
+
+    def add_sessions(self, count, age):
+        from miniblog.models import Session, SessionMessage
+        from datetime import datetime, timedelta
+        with transaction.manager:
+            for i in range(count):
+                session = Session(None)
+                session._created = datetime.now() - timedelta(seconds=age)
+                session.message_queue.append(SessionMessage(u'Message'))
+                DBSession.add(session)
+
+    def test_sweep_sessions(self):
+        from miniblog.models import Session, SessionMessage
+        from miniblog.sessions import sweep_sessions
+        self.add_sessions(5, 7200)
+        self.add_sessions(2, 60)
+        self.assertEqual(sweep_sessions(3600, batch_size=2), (5, 5))
+        self.assertEqual(DBSession.query(Session).count(), 2)
+        self.assertEqual(DBSession.query(SessionMessage).count(), 2)
+        self.assertEqual(sweep_sessions(3600), (0, 0))
+        self.assertEqual(sweep_sessions(30), (2, 2))
+
+    def test_session_sweeper(self):
+        from miniblog.models import Base, Session
+        from miniblog.sessions import start_session_sweeper
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import StaticPool
+        import time
+        self.assertIsNone(start_session_sweeper({}))
+        self.assertIsNone(start_session_sweeper({
+            'session.sweep_interval': '1', 'session.backend': 'memory'}))
+        # shared by the threads
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        DBSession.remove()
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        self.add_sessions(3, 7200)
+        sweeper = start_session_sweeper({'session.sweep_interval': '0.01'})
+        try:
+            for i in range(100):
+                if not DBSession.query(Session).count():
+                    break
+                transaction.abort()
+                time.sleep(0.05)
+            self.assertEqual(DBSession.query(Session).count(), 0)
+        finally:
+            sweeper.stop()
+            sweeper.join()
+
+    def test_session_backends(self):
+        """The same behaviour with every ``session.backend``."""
+        from miniblog.sessions import make_session_factory
+        from pyramid.interfaces import ISession
+        from functools import partial
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for backend in ('sql', 'memory', 'dbm', 'cookie'):
+            factory = make_session_factory({
+                'session.backend': backend,
+                'session.dbm.filename': os.path.join(directory, 'dbm')})
+            request = partial(self.request, factory=factory)
+
+            # nothing is stored for read-only requests
+            req = request()
+            self.assertTrue(ISession.providedBy(req.session))
+            self.assertEqual(req.session.pop_flash(), [])
+            self.assertIsNone(self.respond(req))
+
+            req = request()
+            req.session.flash(u'Message')
+            req.session.flash(u'Message', allow_duplicate=False)
+            req.session['form'] = {'title': u'Title'}
+            token = req.session.get_csrf_token()
+            cookie = self.respond(req).split(';')[0]
+
+            req = request(cookie)
+            self.assertFalse(req.session.new)
+            self.assertEqual(req.session['form'], {'title': u'Title'})
+            self.assertEqual(req.session.get_csrf_token(), token)
+            self.assertEqual(req.session.peek_flash(), [u'Message'])
+            message, = req.session.pop_flash()
+            self.assertIsInstance(message, unicode)
+            del req.session['form']
+            # only the cookie backend has to send a changed cookie
+            cookie = (self.respond(req) or cookie).split(';')[0]
+
+            req = request(cookie)
+            self.assertEqual(req.session.peek_flash(), [])
+            self.assertNotIn('form', req.session)
+            self.assertIsNone(self.respond(req))
+
+            # tampered and invalidated sessions
+            name, value = cookie.split('=', 1)
+            hash_, data, timestamp = value.split(':')
+            tampered = '%s=%s:%s:%s' % (name, hash_, data[:-1] + 'x',
+                                        timestamp)
+            req = request(tampered)
+            self.assertTrue(req.session.new)
+            self.assertIn('Max-Age=0', self.respond(req))
+            req = request(cookie)
+            req.session.invalidate()
+            self.assertIn('Max-Age=0', self.respond(req))
+            if backend != 'cookie':
+                self.assertTrue(request(cookie).session.new)
+
+    def test_sweep_dbm_sessions(self):
+        from miniblog.sessions import make_session_store, SessionSweeper, \
+            StoredSession, RegionStore, start_session_sweeper
+        from time import time
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings = {'session.backend': 'dbm', 'session.duration': '60',
+                    'session.dbm.filename': os.path.join(directory, 'dbm')}
+        store = make_session_store(settings)
+        values = [store.save(StoredSession()) for i in range(3)]
+        self.assertEqual(store.sweep(batch_size=2), 0)
+        self.assertEqual(store.sweep(batch_size=2, now=time() + 61), 3)
+        self.assertEqual([store.load(value) for value in values],
+                         [None] * 3)
+        # the sweeper thread of the dbm backend
+        store.save(StoredSession())
+        sweeper = SessionSweeper(3600, 0, store=store)
+        self.assertEqual(sweeper.sweep(), (0, 0))
+        store.duration = -1
+        self.assertEqual(sweeper.sweep(), (1, 0))
+        sweeper = start_session_sweeper(dict(
+            settings, **{'session.sweep_interval': '3600'}))
+        sweeper.stop()
+        sweeper.join()
+        self.assertIsInstance(sweeper.store, RegionStore)
+
+    def test_cookie_store_too_large(self):
+        from miniblog.sessions import make_session_factory, MAX_COOKIE_SIZE
+        factory = make_session_factory({'session.backend': 'cookie'})
+        req = self.request(factory=factory)
+        # a failed submission of the add form with a long text
+        req.session['add_entry_form'] = {'title': u'', 'text': u'Text ' * 700}
+        req.session.flash(u'Field "title" has the following error')
+        cookie = self.respond(req).split(';')[0]
+        self.assertLessEqual(len(cookie), MAX_COOKIE_SIZE)
+        req = self.request(cookie, factory=factory)
+        self.assertNotIn('add_entry_form', req.session)
+        self.assertEqual(req.session.pop_flash(),
+                         [u'Field "title" has the following error'])
+
+        # too many messages for a cookie
+        for i in range(200):
+            req.session.flash(u'Message %d' % i)
+        cookie = self.respond(req).split(';')[0]
+        self.assertLessEqual(len(cookie), MAX_COOKIE_SIZE)
+        req = self.request(cookie, factory=factory)
+        self.assertEqual(req.session.peek_flash(), [])
+
+        # the longest draft that is kept, the whole cookie counts
+        def save(length):
+            req = self.request(factory=factory)
+            req.session['add_entry_form'] = {'text': u'x' * length}
+            cookie = self.respond(req).split(';')[0]
+            kept = 'add_entry_form' in self.request(cookie,
+                                                    factory=factory).session
+            return cookie, kept
+        low, high = 1000, 4000
+        while high - low > 1:
+            middle = (low + high) // 2
+            if save(middle)[1]:
+                low = middle
+            else:
+                high = middle
+        cookie, kept = save(low)
+        self.assertTrue(kept)
+        self.assertLessEqual(len(cookie), MAX_COOKIE_SIZE)
+        self.assertGreater(len(cookie), MAX_COOKIE_SIZE - 8)
+        cookie, kept = save(high)
+        self.assertFalse(kept)
+        self.assertLessEqual(len(cookie), MAX_COOKIE_SIZE)
+
+
+class TestCaching(unittest.TestCase):
+
+    def setUp(self):
+        from miniblog.models import cache, GENERATION_KEY
+        self.config = testing.setUp(settings={'session.secret': 'secret'})
+        configure_cache()
+        cache.delete(GENERATION_KEY)
+        self.calls = 0
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+
+    def view(self, context, request):
+        from pyramid.response import Response
+        self.calls += 1
+        return Response(u'Page %d' % self.calls)
+
+    def request(self, **kw):
+        request = testing.DummyRequest(**kw)
+        request.matched_route = testing.DummyResource(name='home')
+        request.matchdict = {}
+        return request
+
+    def test_cache_page(self):
+        from miniblog.caching import cache_page, invalidate_content
+        view = cache_page(self.view)
+        self.assertEqual(view(None, self.request()).text, u'Page 1')
+        self.assertEqual(view(None, self.request()).text, u'Page 1')
+
+        # query string and route are part of the key
+        self.assertEqual(view(None, self.request(params={'page': '2'}))
+                         .text, u'Page 2')
+        self.assertEqual(view(None, self.request(params={'page': '2'}))
+                         .text, u'Page 2')
+
+        # invalidation only happens once the transaction is committed
+        invalidate_content()
+        self.assertEqual(view(None, self.request()).text, u'Page 1')
+        transaction.commit()
+        self.assertEqual(view(None, self.request()).text, u'Page 3')
+
+        invalidate_content()
+        transaction.abort()
+        self.assertEqual(view(None, self.request()).text, u'Page 3')
+
+    def test_cache_page_bypass(self):
+        from miniblog.caching import cache_page
+        view = cache_page(self.view)
+        view(None, self.request())
+
+        # POST requests are never cached
+        self.assertEqual(view(None, self.request(post={'a': 'b'})).text,
+                         u'Page 2')
+
+        # neither are pages with flash messages
+        request = self.request(cookies={'session': 'abc'})
+        request.session.flash('Message')
+        self.assertEqual(view(None, request).text, u'Page 3')
+
+        # or for logged in users
+        self.config.testing_securitypolicy(userid='admin@example.com')
+        self.assertEqual(view(None, self.request()).text, u'Page 4')
+
+    def test_cache_fragment(self):
+        from miniblog.caching import cache_fragment, invalidate_content
+        def creator():
+            self.calls += 1
+            return u'Fragment %d' % self.calls
+        request = self.request()
+        self.assertEqual(cache_fragment(request, 'sidebar', creator),
+                         u'Fragment 1')
+        self.assertEqual(cache_fragment(request, 'sidebar', creator),
+                         u'Fragment 1')
+        self.assertEqual(cache_fragment(request, 'other', creator),
+                         u'Fragment 2')
+        invalidate_content()
+        transaction.commit()
+        self.assertEqual(cache_fragment(request, 'sidebar', creator),
+                         u'Fragment 3')
+
+    def test_JSONDBMBackend(self):
+        from dogpile.cache import make_region
+        from tempfile import mktemp
+        region = make_region().configure(
+            'miniblog.json_dbm', arguments={'filename': mktemp()})
+        region.set('key', [(1, u'Title', 1.5)])
+        self.assertEqual(region.get('key'), [[1, u'Title', 1.5]])
+        self.assertEqual(region.get('missing').__class__.__name__,
+                         'NoValue')
+        with region.backend._dbm_file(False) as dbm:
+            self.assertTrue(dbm['key'].startswith('[[[1,"Title",1.5]],'))
+
+    def test_conditional_get(self):
+        from miniblog.caching import conditional_get, invalidate_content
+        from pyramid.request import Request
+        view = conditional_get(self.view)
+        def request(**headers):
+            request = Request.blank('/', headers=headers)
+            request.registry = self.config.registry
+            return request
+
+        response = view(None, request())
+        self.assertEqual(response.text, u'Page 1')
+        etag = response.etag
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag)
+
+        # matching validators don't call the view
+        response = view(None, request(**{'If-None-Match': '"%s"' % etag}))
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.etag, etag)
+        response = view(None, request(**{'If-Modified-Since':
+                                         last_modified}))
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(self.calls, 1)
+
+        # a logged in user gets a different page
+        self.config.testing_securitypolicy(userid='admin@example.com')
+        response = view(None, request(**{'If-None-Match': '"%s"' % etag}))
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.etag, etag)
+
+        # new content changes the validators
+        self.config.testing_securitypolicy(userid=None)
+        invalidate_content()
+        transaction.commit()
+        response = view(None, request(**{'If-None-Match': '"%s"' % etag}))
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.etag, etag)
+
+    def test_TieredBackend(self):
+        from dogpile.cache import make_region
+        from miniblog.models import GENERATION_KEY
+        from tempfile import mktemp
+        shared = {}
+        marker = mktemp()
+        def region():
+            return make_region().configure('miniblog.tiered', arguments={
+                'backend': 'dogpile.cache.memory',
+                'backend.cache_dict': shared,
+                'marker': marker})
+        one, two = region(), region()
+        one.set('key', 'value')
+        self.assertEqual(two.get('key'), 'value')
+
+        # the second process answers from memory
+        shared.clear()
+        self.assertEqual(two.get('key'), 'value')
+
+        # until a new generation replaces the marker
+        one.set(GENERATION_KEY, 'new')
+        self.assertEqual(two.get(GENERATION_KEY), 'new')
+        self.assertEqual(two.get('key').__class__.__name__, 'NoValue')
+
+    def test_refresh_in_background(self):
+        from miniblog.caching import refresh_in_background
+        from miniblog.models import cache
+        released = []
+        class Mutex(object):
+            def release(self):
+                released.append(True)
+        def creator():
+            return 'refreshed'
+        thread = refresh_in_background(cache, 'refresh', creator, Mutex())
+        thread.join()
+        self.assertEqual(cache.get('refresh'), 'refreshed')
+        self.assertEqual(released, [True])
+
+
+class TestPaginate(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine
+        engine = create_engine('sqlite://')
+        from miniblog.models import Base, Entry
+        from datetime import datetime, timedelta
+        configure_cache()
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        start = datetime(2013, 3, 1, 12)
+        with transaction.manager:
+            for i in range(12):
+                entry = Entry('Entry %d' % i, '...')
+                # entries 4 to 7 share the same time
+                entry.entry_time = start + timedelta(hours=min(i, 4) if i < 8 else i)
+                DBSession.add(entry)
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def url(self, _query):
+        return '/?%s=%s' % _query.items()[0]
+
+    def page(self, **kw):
+        from miniblog.models import Entry
+        from miniblog.paginate import KeysetPage
+        page = KeysetPage(DBSession.query(Entry), self.url, 5, **kw)
+        return page, [entry.title for entry in page]
+
+    def test_KeysetPage(self):
+        from miniblog.paginate import make_cursor
+        page, titles = self.page()
+        self.assertEqual(titles, ['Entry 11', 'Entry 10', 'Entry 9',
+                                  'Entry 8', 'Entry 7'])
+        self.assertFalse(page.has_newer)
+        self.assertTrue(page.has_older)
+
+        # walk all pages, entries with the same time are neither skipped
+        # nor repeated
+        seen = titles
+        while page.has_older:
+            page, titles = self.page(after=make_cursor(page.items[-1]))
+            seen.extend(titles)
+        self.assertEqual(seen, ['Entry %d' % i for i in range(11, -1, -1)])
+        self.assertEqual(len(page), 2)
+        self.assertTrue(page.has_newer)
+
+        # and back again
+        page, titles = self.page(before=make_cursor(page.items[0]))
+        self.assertEqual(titles, ['Entry 6', 'Entry 5', 'Entry 4',
+                                  'Entry 3', 'Entry 2'])
+        self.assertTrue(page.has_newer)
+        page, titles = self.page(before=make_cursor(page.items[0]))
+        self.assertEqual(titles, ['Entry 11', 'Entry 10', 'Entry 9',
+                                  'Entry 8', 'Entry 7'])
+        self.assertFalse(page.has_newer)
+
+    def test_KeysetPage_offset(self):
+        page, titles = self.page(offset=5)
+        self.assertEqual(titles, ['Entry 6', 'Entry 5', 'Entry 4',
+                                  'Entry 3', 'Entry 2'])
+        self.assertTrue(page.has_newer)
+        self.assertTrue(page.has_older)
+
+    def test_KeysetPage_pager(self):
+        page, titles = self.page()
+        self.assertEqual(page.pager(),
+            '<a class="pager_link" href="/?after=20130301160000000000-8">'
+            'Older posts &raquo;</a>')
+        page, titles = self.page(offset=10)
+        self.assertIn('before=20130301130000000000-2', page.pager())
+        self.assertNotIn('after', page.pager())
+
+    def test_parse_cursor(self):
+        from miniblog.paginate import parse_cursor
+        from datetime import datetime
+        self.assertEqual(parse_cursor('20130301120000000000-3'),
+                         (datetime(2013, 3, 1, 12), 3))
+        for cursor in ['', '2013-3', '20130301120000000000-x', 'a-b-c']:
+            self.assertRaises(ValueError, parse_cursor, cursor)
+
+
+class TestInitializeDB(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        self.engine = create_engine('sqlite://')
+        self.out = StringIO()
+
+    def indexes(self, table='entry'):
+        from sqlalchemy import inspect
+        return sorted(index['name'] for index in
+                      inspect(self.engine).get_indexes(table))
+
+    def test_migrate_new(self):
+        from miniblog.scripts.initializedb import migrate, MIGRATIONS, \
+            get_schema_version
+        self.assertEqual(migrate(self.engine, self.out), MIGRATIONS[-1][0])
+        self.assertEqual(self.out.getvalue(), '')
+        self.assertEqual(get_schema_version(self.engine.connect()),
+                         MIGRATIONS[-1][0])
+        self.assertEqual(self.indexes(),
+                         ['ix_entry_category_name_entry_time_id',
+                          'ix_entry_entry_time_id'])
+
+    def test_migrate_existing(self):
+        from miniblog.scripts.initializedb import migrate, MIGRATIONS
+        # the schema before versioning
+        self.engine.execute("CREATE TABLE category (name TEXT PRIMARY KEY)")
+        self.engine.execute("CREATE TABLE entry (id INTEGER PRIMARY KEY, "
+                            "title TEXT UNIQUE NOT NULL, text TEXT NOT NULL, "
+                            "entry_time DATETIME NOT NULL, category_name "
+                            "TEXT REFERENCES category (name))")
+        self.engine.execute("CREATE TABLE session (id TEXT PRIMARY KEY, "
+                            "created DATETIME NOT NULL, csrf_token TEXT NOT "
+                            "NULL, additional_data BLOB)")
+        self.engine.execute("INSERT INTO category VALUES ('Category')")
+        self.engine.execute("INSERT INTO entry VALUES (1, 'Title', '*Text*', "
+                            "'2013-03-01 12:00:00', 'Category')")
+        from miniblog.models import MutableDict
+        import cPickle as pickle
+        self.engine.execute("INSERT INTO session VALUES ('id', '2013-03-01 "
+                            "12:00:00', 'token', ?)", buffer(pickle.dumps(
+                                MutableDict({'form': {'title': u'Title'}}),
+                                2)))
+        # pickles that can't be loaded anymore
+        for session_id, payload in [
+                ('truncated', pickle.dumps(MutableDict({'a': 1}), 2)[:-3]),
+                ('gone', 'cmiss1ng_module\nThing\n(tR.')]:
+            self.engine.execute("INSERT INTO session VALUES (?, '2013-03-01 "
+                                "12:00:00', 'token', ?)", session_id,
+                                buffer(payload))
+        self.assertEqual(migrate(self.engine, self.out), MIGRATIONS[-1][0])
+        self.assertEqual([(str(session_id), str(data)) for session_id, data
+                          in self.engine.execute("SELECT id, additional_data "
+                                                 "FROM session")],
+                         [('id', 'j{"form":{"title":"Title"}}')])
+        self.assertEqual(self.out.getvalue().count('Migrating'),
+                         len(MIGRATIONS))
+        self.assertEqual(self.indexes(),
+                         ['ix_entry_category_name_entry_time_id',
+                          'ix_entry_entry_time_id'])
+        self.assertEqual(self.indexes('session'), ['ix_session_created'])
+
+        from miniblog.models import Entry, Category
+        from datetime import datetime
+        configure_cache()
+        DBSession.configure(bind=self.engine)
+        try:
+            self.assertEqual(DBSession.query(Entry).one().text,
+                             '<p><em>Text</em></p>')
+            category = DBSession.query(Category).one()
+            self.assertEqual(category.entry_count, 1)
+            self.assertEqual(category.last_entry_time,
+                             datetime(2013, 3, 1, 12))
+        finally:
+            DBSession.remove()
+
+        # running it again does nothing
+        self.assertEqual(migrate(self.engine, self.out), MIGRATIONS[-1][0])
+        self.assertEqual(self.out.getvalue().count('Migrating'),
+                         len(MIGRATIONS))
+
+    def test_migrate_rerender_search(self):
+        from miniblog.scripts.initializedb import migrate
+        from miniblog.scripts.rerender import rerender
+        from miniblog.search import SearchResults, has_search_index, \
+            SEARCH_TABLE
+        self.engine.execute("CREATE TABLE category (name TEXT PRIMARY KEY)")
+        self.engine.execute("CREATE TABLE entry (id INTEGER PRIMARY KEY, "
+                            "title TEXT UNIQUE NOT NULL, text TEXT NOT NULL, "
+                            "entry_time DATETIME NOT NULL, category_name "
+                            "TEXT REFERENCES category (name))")
+        self.engine.execute("INSERT INTO entry VALUES (1, 'Title', "
+                            "'About *bananas*', '2013-03-01 12:00:00', "
+                            "NULL)")
+        migrate(self.engine, self.out)
+        if not has_search_index(self.engine):
+            self.skipTest("SQLite has no FTS5")
+        configure_cache()
+        DBSession.configure(bind=self.engine)
+
+        def search(query):
+            return [entry.id for entry, snippet in
+                    SearchResults(query, lambda _query: '/search')]
+        try:
+            # indexed with the markdown text until it is rendered
+            self.assertEqual(search(u'bananas'), [1])
+            self.assertEqual(rerender(processes=1, out=StringIO()), 1)
+            self.assertEqual(self.engine.execute(
+                "SELECT rowid, title, body FROM %s" % SEARCH_TABLE)
+                .fetchall(), [(1, u'Title', u'About bananas')])
+            self.assertEqual(search(u'bananas'), [1])
+        finally:
+            DBSession.remove()
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.settings = {'sqlalchemy.url': 'sqlite:///%s/test.sqlite'
+                                           % self.dir,
+                         'sqlite.busy_timeout': '5000'}
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def test_sqlite_pragmas(self):
+        from miniblog.database import sqlite_pragmas
+        self.assertEqual(sqlite_pragmas({}),
+                         [('journal_mode', 'wal'), ('busy_timeout', '5000'),
+                          ('synchronous', 'normal'), ('cache_size', '-16000'),
+                          ('mmap_size', '268435456')])
+        pragmas = sqlite_pragmas({'sqlite.journal_mode': 'DELETE',
+                                  'sqlite.mmap_size': ''})
+        self.assertIn(('journal_mode', 'delete'), pragmas)
+        self.assertNotIn('mmap_size', dict(pragmas))
+        self.assertRaises(ValueError, sqlite_pragmas,
+                          {'sqlite.journal_mode': 'wal; DROP TABLE entry'})
+        self.assertRaises(ValueError, sqlite_pragmas,
+                          {'sqlite.busy_timeout': 'long'})
+
+    def test_make_engine(self):
+        from miniblog.database import make_engine
+        from sqlalchemy.pool import QueuePool, SingletonThreadPool
+        engine = make_engine(self.settings)
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                         'wal')
+        self.assertEqual(engine.execute('PRAGMA busy_timeout').scalar(),
+                         5000)
+        self.assertEqual(engine.execute('PRAGMA synchronous').scalar(), 1)
+        engine = make_engine({'sqlalchemy.url': 'sqlite://'})
+        self.assertIsInstance(engine.pool, SingletonThreadPool)
+
+    def test_make_engine_concurrency(self):
+        from miniblog.database import make_engine
+        import threading
+        import time
+        engine = make_engine(self.settings)
+        engine.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, thread TEXT)')
+        errors = []
+
+        # a slow write transaction neither blocks readers nor makes other
+        # writers fail, they wait for it
+        writer = engine.connect()
+        trans = writer.begin()
+        writer.execute("INSERT INTO t (thread) VALUES ('slow')")
+        def commit_later():
+            time.sleep(0.3)
+            trans.commit()
+            writer.close()
+        committer = threading.Thread(target=commit_later)
+        committer.start()
+        self.assertEqual(engine.execute('SELECT count(*) FROM t').scalar(), 0)
+
+        def work(name):
+            try:
+                for i in range(20):
+                    with engine.begin() as connection:
+                        connection.execute("INSERT INTO t (thread) VALUES "
+                                           "('%s')" % name)
+                    engine.execute('SELECT count(*) FROM t').scalar()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(str(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads + [committer]:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(engine.execute('SELECT count(*) FROM t').scalar(),
+                         81)
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine
+        from miniblog.models import Base, Entry
+        from miniblog.search import create_search_index
+        self.engine = create_engine('sqlite://')
+        configure_cache()
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        with transaction.manager:
+            DBSession.add(Entry('Existing entry', 'Written *before* the '
+                                'index was created'))
+        self.assertTrue(create_search_index(self.engine))
+        with transaction.manager:
+            DBSession.add(Entry('Running fast', 'About running & jogging'))
+            DBSession.add(Entry('100% safe_word', 'Not about running at all'))
+            DBSession.add(Entry('Jogging', 'Slow *running* is <still> '
+                                'running, Running or jogging.'))
+
+    def tearDown(self):
+        DBSession.remove()
+        testing.tearDown()
+
+    def url(self, _query):
+        return '/search?page=%(page)s' % _query
+
+    def titles(self, query, **kw):
+        from miniblog.search import SearchResults
+        results = SearchResults(query, self.url, items_per_page=2, **kw)
+        return results, [entry.title for entry, snippet in results]
+
+    def test_search_terms(self):
+        from miniblog.search import search_terms, match_expression, \
+            like_pattern
+        self.assertEqual(search_terms(u'"run*" OR (title:x) -%_'),
+                         [u'run', u'OR', u'title', u'x', u'_'])
+        self.assertEqual(match_expression([u'fast', u'run']),
+                         u'"fast" "run"*')
+        self.assertEqual(like_pattern(u'100%_\\'), u'%100\\%\\_\\\\%')
+
+    def test_SearchResults(self):
+        results, titles = self.titles(u'running')
+        # matches in the title rank first, stemming finds "run"
+        self.assertEqual(titles, ['Running fast', 'Jogging'])
+        self.assertTrue(results.has_next)
+        self.assertIn('page=2', results.pager())
+        results, titles = self.titles(u'running', page=2)
+        self.assertEqual(titles, ['100% safe_word'])
+        self.assertFalse(results.has_next)
+        self.assertIn('page=1', results.pager())
+
+        # the snippet is escaped text with the matches highlighted
+        results, titles = self.titles(u'jog slow')
+        entry, snippet = results.items[0]
+        self.assertEqual(snippet, u'<mark>Slow</mark> running is &lt;still&gt; '
+                                  u'running, Running or <mark>jogging</mark>.')
+
+        # all terms must match, the query syntax and patterns are ignored
+        self.assertEqual(self.titles(u'running before')[1], [])
+        self.assertEqual(self.titles(u'created')[1], ['Existing entry'])
+        self.assertEqual(self.titles(u'%')[1], [])
+        self.assertEqual(self.titles(u'title:jogging OR')[1], [])
+
+    def test_search_index_sync(self):
+        from miniblog.models import Entry
+        with transaction.manager:
+            entry = DBSession.query(Entry).filter_by(title='Jogging').one()
+            entry.title = 'Walking'
+            entry.text = 'Only walking'
+        self.assertEqual(self.titles(u'jogging')[1], ['Running fast'])
+        self.assertEqual(self.titles(u'walking')[1], ['Walking'])
+        with transaction.manager:
+            DBSession.delete(DBSession.query(Entry)
+                             .filter_by(title='Running fast').one())
+        self.assertEqual(self.titles(u'jogging')[1], [])
+
+        # rolled back changes don't stay in the index
+        DBSession.add(Entry('Jogging again', '...'))
+        DBSession.flush()
+        self.assertEqual(self.titles(u'jogging')[1], ['Jogging again'])
+        transaction.abort()
+        self.assertEqual(self.titles(u'jogging')[1], [])
+
+    def test_SearchResults_like(self):
+        from miniblog.search import search_index_engines
+        search_index_engines[self.engine] = False
+        results, titles = self.titles(u'running')
+        self.assertEqual(titles, ['Jogging', '100% safe_word'])
+        self.assertTrue(results.has_next)
+        self.assertEqual(self.titles(u'100%')[1], ['100% safe_word'])
+        self.assertEqual(self.titles(u'safe_word')[1], ['100% safe_word'])
+        self.assertEqual(self.titles(u'%')[1], [])
+
+
+class TestQueryBudget(unittest.TestCase):
+    """Every view must stay within its number of SQL statements. The first
+    request of each test also renders the sidebar (2 statements)."""
+
+    def setUp(self, **settings):
+        from miniblog import main
+        from miniblog.models import Entry, Category
+        DBSession.remove()
+        configure_cache()
+        settings = dict({'sqlalchemy.url': 'sqlite://',
+                         'mako.directories': 'miniblog:templates',
+                         'title': 'Title', 'auth_secret': 'secret',
+                         'session.secret': 'secret',
+                         'admin_email': 'admin@example.com',
+                         'disqus_shortname': 'disqus',
+                         'persona_verifier_url': 'http://localhost/verify',
+                         'page_cache.enabled': 'false',
+                         'pyramid.includes': 'pyramid_tm'}, **settings)
+        self.app = main({}, **settings)
+        with transaction.manager:
+            for name in ('Cat', 'Dog'):
+                DBSession.add(Category(name))
+            for i in range(12):
+                DBSession.add(Entry('Title %d' % i, 'Text %d\n\nMore' % i,
+                                    ('Cat', 'Dog')[i % 2]))
+
+    def tearDown(self):
+        DBSession.remove()
+
+    def get(self, path, admin=False, status=200, **kw):
+        from miniblog.querylog import record_queries
+        from pyramid.request import Request
+        from pyramid.security import remember
+        request = Request.blank(path, **kw)
+        if admin:
+            login = Request.blank('/')
+            login.registry = self.app.registry
+            request.headers['Cookie'] = '; '.join(
+                value.split(';')[0] for name, value
+                in remember(login, 'admin@example.com'))
+        with record_queries() as queries:
+            response = request.get_response(self.app)
+        self.assertEqual(response.status_int, status)
+        return queries
+
+    def assertBudget(self, path, budget, admin=False, **kw):
+        queries = self.get(path, admin, **kw)
+        self.assertLessEqual(queries.count, budget,
+                             "%s ran %d statements:\n%s" % (
+                                 path, queries.count,
+                                 '\n'.join(s for s, d in queries.statements)))
+        self.assertEqual(queries.repeated(), [])
+
+    def test_home(self):
+        self.assertBudget('/', 3)
+        self.assertBudget('/', 1)
+
+    def writes(self, path, cookie, **kw):
+        from miniblog.querylog import record_queries
+        from pyramid.request import Request
+        request = Request.blank(path, **kw)
+        request.headers['Cookie'] = cookie
+        with record_queries() as queries:
+            response = request.get_response(self.app)
+        return response, [' '.join(statement.split()[:3]) for statement, d
+                          in queries.statements
+                          if not statement.startswith('SELECT')]
+
+    def test_session_writes(self):
+        from pyramid.request import Request
+        from pyramid.security import remember
+        login = Request.blank('/')
+        login.registry = self.app.registry
+        admin = '; '.join(value.split(';')[0] for name, value
+                          in remember(login, 'admin@example.com'))
+        # a failed submission stores the draft and a message for each error
+        post = {'title': '', 'text': '', 'submit': 'Save'}
+        response, writes = self.writes('/add', admin, POST=post)
+        self.assertEqual(response.status_int, 302)
+        cookie = '%s; %s' % (admin, response.headers['Set-Cookie']
+                             .split(';')[0])
+        # all messages are deleted at once, the draft is only read
+        response, messages = self.writes('/add', cookie)
+        count = response.body.count('has the following error')
+        self.assertGreater(count, 1)
+        self.assertEqual(writes, ['INSERT INTO session'] +
+                         ['INSERT INTO session_message'] * count)
+        self.assertEqual(messages, ['DELETE FROM session_message'])
+        response, writes = self.writes('/add', cookie)
+        self.assertEqual(writes, [])
+        response, writes = self.writes('/entry/3', cookie)
+        self.assertEqual(writes, [])
+
+    def test_anonymous_writes_nothing(self):
+        from miniblog.querylog import record_queries
+        from pyramid.request import Request
+        with record_queries() as queries:
+            response = Request.blank('/entry/3').get_response(self.app)
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertEqual([s for s, d in queries.statements
+                          if not s.startswith('SELECT')], [])
+
+    def test_home_paged(self):
+        self.assertBudget('/page/2', 3)
+
+    def test_view_entry(self):
+        self.assertBudget('/entry/3', 3)
+
+    def test_view_category(self):
+        self.assertBudget('/category/Cat', 3)
+
+    def test_view_categories(self):
+        self.assertBudget('/categories', 4)
+
+    def test_search(self):
+        self.assertBudget('/search?search=text', 4)
+
+    def test_add_entry(self):
+        self.assertBudget('/add', 3, admin=True)
+
+    def test_edit_entry(self):
+        self.assertBudget('/entry/3/edit', 4, admin=True)
+
+    def test_manage_categories(self):
+        self.assertBudget('/edit_categories', 3, admin=True)
+
+    def test_delete_entry(self):
+        self.assertBudget('/entry/3/delete', 5, admin=True, status=302)
+
+    def test_delete_category(self):
+        from miniblog.models import Category
+        with transaction.manager:
+            DBSession.add(Category('Empty'))
+        self.assertBudget('/categories/delete/Empty', 5, admin=True,
+                          status=302)
+
+    def test_login(self):
+        from miniblog import views
+        import json
+
+        class Verified(object):
+            ok = True
+            content = json.dumps({'email': 'admin@example.com',
+                                  'status': 'okay'})
+        post = views.requests.post
+        views.requests.post = lambda url, data, verify: Verified()
+        try:
+            self.assertBudget('/login', 0, POST={'assertion': 'assertion'})
+        finally:
+            views.requests.post = post
+
+    def test_logout(self):
+        self.assertBudget('/logout', 0, admin=True)
+
+    def test_page_cache(self):
+        self.setUp(**{'page_cache.enabled': 'true'})
+        self.get('/')
+        self.assertBudget('/', 0)
+
+    def test_strict_budget(self):
+        from miniblog.querylog import QueryBudgetExceeded
+        self.setUp(**{'query_budget': '10', 'query_budget.home': '1',
+                      'query_budget.strict': 'true'})
+        self.assertRaises(QueryBudgetExceeded, self.get, '/')
+        self.get('/category/Cat')
+
+    def test_repeated(self):
+        from miniblog.querylog import record_queries
+        from miniblog.models import Entry
+        with record_queries() as outer:
+            with record_queries() as queries:
+                for entry in DBSession.query(Entry):
+                    entry.category.name
+            DBSession.query(Entry).first()
+        self.assertEqual(queries.count, 3)
+        self.assertEqual(outer.count, 4)
+        statement, count = queries.repeated(2)[0]
+        self.assertIn('FROM category', statement)
+        self.assertEqual(count, 2)
+        self.assertEqual(queries.repeated(), [])
+
+    def test_failed_statement(self):
+        from miniblog.querylog import record_queries
+        from sqlalchemy.exc import OperationalError
+        connection = DBSession.connection()
+        with record_queries() as queries:
+            self.assertRaises(OperationalError, connection.execute,
+                              "SELECT * FROM missing")
+            self.assertEqual(connection.info.get('query_started'), [])
+            connection.execute("SELECT 1")
+        self.assertEqual([s for s, d in queries.statements],
+                         ["SELECT * FROM missing", "SELECT 1"])
+
+
+class TestReplica(unittest.TestCase):
+    """Two SQLite files stand in for the primary and the replica. They are
+    not replicated, the entries in the replica have other titles."""
+
+    def setUp(self, **settings):
+        from miniblog import main
+        from miniblog.database import make_engine
+        from miniblog.models import Base, Entry
+        from miniblog.search import create_search_index
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        DBSession.remove()
+        configure_cache()
+        self.replica = make_engine({'sqlalchemy.url': 'sqlite:///%s/replica'
+                                                      '.sqlite' % self.dir})
+        Base.metadata.create_all(self.replica)
+        create_search_index(self.replica)
+        DBSession.configure(bind=self.replica)
+        with transaction.manager:
+            for i in range(3):
+                DBSession.add(Entry('Replica %d' % i, 'Text'))
+        DBSession.remove()
+        self.app = main({}, **dict({
+            'sqlalchemy.url': 'sqlite:///%s/primary.sqlite' % self.dir,
+            'replica.sqlalchemy.url': 'sqlite:///%s/replica.sqlite'
+                                      % self.dir,
+            'mako.directories': 'miniblog:templates',
+            'title': 'Title', 'auth_secret': 'secret',
+            'session.secret': 'secret', 'admin_email': 'admin@example.com',
+            'disqus_shortname': 'disqus',
+            'persona_verifier_url': 'http://localhost/verify',
+            'page_cache.enabled': 'false',
+            'pyramid.includes': 'pyramid_tm'}, **settings))
+        self.primary = DBSession().bind
+        with transaction.manager:
+            for i in range(3):
+                DBSession.add(Entry('Primary %d' % i, 'Text'))
+        self.age_generation()
+
+    def age_generation(self):
+        """Start a generation that is older than the sticky seconds, as if
+        the replica had caught up by now."""
+        from miniblog.models import cache, GENERATION_KEY
+        from time import time
+        cache.set(GENERATION_KEY, repr(time() - 60))
+
+    def tearDown(self):
+        import shutil
+        DBSession.remove()
+        DBSession.configure(replica=None)
+        shutil.rmtree(self.dir)
+
+    def get(self, path, admin=False, cookies=()):
+        from pyramid.request import Request
+        from pyramid.security import remember
+        request = Request.blank(path)
+        cookies = list(cookies)
+        if admin:
+            login = Request.blank('/')
+            login.registry = self.app.registry
+            cookies.extend(value.split(';')[0] for name, value
+                           in remember(login, 'admin@example.com'))
+        if cookies:
+            request.headers['Cookie'] = '; '.join(cookies)
+        return request.get_response(self.app)
+
+    def test_routing(self):
+        from miniblog.models import Entry, Session
+        self.assertEqual(DBSession.query(Entry).get(1).title, 'Replica 0')
+        self.assertIs(DBSession.get_bind(Session), self.primary)
+        self.assertEqual(DBSession.get_bind(Entry).url, self.replica.url)
+        with transaction.manager:
+            DBSession.add(Entry('Primary 3', 'Text'))
+            DBSession.flush()
+            # read your own writes until the transaction ends
+            self.assertEqual(DBSession.query(Entry).count(), 4)
+        self.assertEqual(DBSession.query(Entry).count(), 3)
+        self.assertFalse(DBSession().wrote)
+        DBSession().use_primary = True
+        self.assertEqual(DBSession.query(Entry).count(), 4)
+
+    def test_sticky(self):
+        response = self.get('/entry/1')
+        self.assertIn('Replica 0', response.body)
+        self.assertNotIn('use_primary', response.headers.get('Set-Cookie', ''))
+        response = self.get('/entry/3/delete', admin=True)
+        self.assertEqual(response.status_int, 302)
+        cookie = [value.split(';')[0] for name, value in response.headerlist
+                  if name == 'Set-Cookie' and value.startswith('use_primary')]
+        self.assertEqual(len(cookie), 1)
+        # only the cookie, see test_stale_replica_not_cached
+        self.age_generation()
+        response = self.get('/entry/1', cookies=cookie)
+        self.assertIn('Primary 0', response.body)
+        self.assertNotIn('Primary 2', self.get('/entry/3', cookies=cookie).body)
+        self.assertIn('Replica 0', self.get('/entry/1').body)
+        expired = ['use_primary=1.0']
+        self.assertIn('Replica 0', self.get('/entry/1', cookies=expired).body)
+
+    def test_admin_reads_primary(self):
+        self.assertIn('Primary 1', self.get('/entry/2/edit', admin=True).body)
+
+    def test_stale_replica_not_cached(self):
+        self.tearDown()
+        self.setUp(**{'page_cache.enabled': 'true'})
+        self.assertIn('Replica 0', self.get('/entry/1').body)
+        self.assertEqual(self.get('/entry/3/delete', admin=True).status_int,
+                         302)
+        # a visitor without the cookie fills the cache from the primary
+        # while the replica may still be behind
+        for i in range(2):
+            body = self.get('/entry/1').body
+            self.assertIn('Primary 0', body)
+            self.assertNotIn('Replica', body)
+        # once the replica had time to catch up, it is used again
+        self.age_generation()
+        self.assertIn('Replica 0', self.get('/entry/1').body)
+
+
+class TestImportExport(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from sqlalchemy import create_engine
+        from miniblog.models import Base, Category
+        from miniblog.search import create_search_index
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite://')
+        configure_cache()
+        DBSession.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+        create_search_index(self.engine)
+        with transaction.manager:
+            DBSession.add(Category('News'))
+
+    def tearDown(self):
+        import shutil
+        DBSession.remove()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir, name), 'w') as f:
+            f.write(content)
+
+    def test_parse_front_matter(self):
+        from miniblog.scripts.importentries import parse_front_matter
+        self.assertEqual(parse_front_matter(u'---\nTitle: A: B\n---\n\nText'),
+                         ({u'title': u'A: B'}, u'Text'))
+        self.assertEqual(parse_front_matter(u'Text\n---\n'),
+                         ({}, u'Text\n---\n'))
+        self.assertEqual(parse_front_matter(u'---\nno end'),
+                         ({}, u'---\nno end'))
+
+    def test_import_export(self):
+        from miniblog.models import Entry, Category, get_count, \
+            CATEGORY_COUNTER
+        from miniblog.scripts.importentries import import_entries, \
+            read_markdown_directory, read_json_lines
+        from miniblog.scripts.exportentries import iter_entries, \
+            export_json_lines, export_markdown
+        from miniblog.search import SearchResults
+        from datetime import datetime
+        self.write('first.md', '---\ntitle: First\ncategory: News\n'
+                               'date: 2013-03-01 12:00\n---\n\n*Hello*')
+        self.write('second.markdown', '---\ncategory: Other\n---\nWorld')
+        self.write('third.md', 'No front matter')
+        self.write('notes.txt', 'Ignored')
+        out = StringIO()
+        records = read_markdown_directory(self.dir)
+        self.assertEqual(import_entries(records, batch_size=2, processes=1,
+                                        out=out), 3)
+        self.assertIn('imported 3 entries', out.getvalue())
+        entry = DBSession.query(Entry).filter_by(title='First').one()
+        self.assertEqual(entry.text, '<p><em>Hello</em></p>')
+        self.assertEqual(entry.entry_time, datetime(2013, 3, 1, 12))
+        self.assertEqual(sorted(DBSession.query(Entry.title,
+                                                Entry.category_name)),
+                         [('First', 'News'), ('second', 'Other'),
+                          ('third', None)])
+        self.assertEqual(get_count(CATEGORY_COUNTER), 2)
+        self.assertEqual(DBSession.query(Category).get('Other').entry_count,
+                         1)
+        results = SearchResults(u'world', lambda _query: '')
+        self.assertEqual([e.title for e, snippet in results], ['second'])
+
+        # export and import into another database
+        jsonl = os.path.join(self.dir, 'entries.jsonl')
+        with open(jsonl, 'w') as f:
+            self.assertEqual(export_json_lines(
+                iter_entries(self.engine.connect(), 2), f), 3)
+        markdown = os.path.join(self.dir, 'export')
+        self.assertEqual(export_markdown(
+            iter_entries(self.engine.connect()), markdown), 3)
+        exported = sorted(os.listdir(markdown))
+        self.assertEqual(exported[0], '0001-first.md')
+        self.assertEqual(len(exported), 3)
+
+        # existing titles are skipped
+        out = StringIO()
+        self.assertEqual(import_entries(read_json_lines(jsonl), processes=1,
+                                        out=out), 0)
+        self.assertIn('skipped 3', out.getvalue())
+
+        # batches larger than the IN lookups
+        from miniblog.scripts import importentries
+        records = [{'title': u'Batch %d' % i, 'text': u'Text',
+                    'category': u'Category %d' % (i % 3)} for i in range(5)]
+        importentries.MAX_IN_PARAMETERS = 2
+        try:
+            from miniblog.querylog import record_queries
+            with record_queries() as queries:
+                self.assertEqual(import_entries(records, batch_size=10,
+                                                processes=1, out=out), 5)
+            self.assertEqual(max(statement.count('?') for statement, d
+                                 in queries.statements
+                                 if ' IN (' in statement), 2)
+            self.assertEqual(import_entries(records[3:] + [
+                {'title': u'Batch 5', 'text': u'Text'}], batch_size=10,
+                processes=1, out=out), 1)
+        finally:
+            importentries.MAX_IN_PARAMETERS = 500
+        self.assertEqual(DBSession.query(Category).get('Category 2')
+                         .entry_count, 1)
+        results = SearchResults(u'batch', lambda _query: '',
+                                items_per_page=10)
+        self.assertEqual(len(results), 6)
+
+        DBSession.query(Entry).delete()
+        transaction.commit()
+        self.assertEqual(import_entries(read_markdown_directory(markdown),
+                                        processes=1, out=out), 3)
+        entry = DBSession.query(Entry).filter_by(title='First').one()
+        self.assertEqual(entry._text, '*Hello*')
+        self.assertEqual(entry.entry_time, datetime(2013, 3, 1, 12))
+        self.assertEqual(entry.category_name, 'News')
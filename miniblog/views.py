@@ -1,19 +1,21 @@
 from functools import partial
+from miniblog.caching import cache_page, cache_fragment, conditional_get
 from miniblog.forms import EntryForm, CategoryForm
-from miniblog.models import DBSession, Entry, Category, get_recent_posts, \
-    get_categories
+from miniblog.models import DBSession, Entry, Category, CATEGORY_COUNTER, \
+    get_recent_posts, get_categories, get_count, query_entries
+from miniblog.paginate import KeysetPage
+from miniblog.search import SearchResults
 from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPFound, HTTPBadRequest, \
     HTTPInternalServerError, HTTPNotFound
+from pyramid.renderers import render
 from pyramid.response import Response
 from pyramid.security import remember, forget, authenticated_userid
 from pyramid.view import view_config, notfound_view_config
 from sqlalchemy import func
 from sqlalchemy.exc import DBAPIError
-from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import exists
-from sqlalchemy.sql.expression import desc
 from webhelpers.paginate import Page, PageURL_WebOb
 from webob.multidict import MultiDict
 import json
@@ -46,67 +48,89 @@ class BaseView(object):
         recent_entries = get_recent_posts()
         return recent_entries
 
-    @view_config(route_name='home', renderer='entries.mako')
-    @view_config(route_name='home_paged', renderer='entries.mako')
+    @reify
+    def sidebar(self):
+        """The html of the sidebar with :attr:`categories` and :attr:`recent`
+        posts. It is the same on every page and cached as a whole with
+        :func:`miniblog.caching.cache_fragment`."""
+        def render_sidebar():
+            return render('sidebar.mako', {'categories': self.categories,
+                                           'recent': self.recent},
+                          request=self.request)
+        return cache_fragment(self.request, 'sidebar', render_sidebar)
+
+    def paginate(self, query, url, items_per_page=5):
+        """Return a :class:`miniblog.paginate.KeysetPage` of the entries in
+        ``query`` for the ``after`` or ``before`` cursor in the query string.
+
+        Numbered pages (as in ``/page/{page}``) are still supported by
+        turning them into an offset."""
+        try:
+            page = max(int(self.request.matchdict.get('page', 1)), 1)
+            return KeysetPage(query, url, items_per_page,
+                              after=self.request.GET.get('after'),
+                              before=self.request.GET.get('before'),
+                              offset=(page - 1) * items_per_page)
+        except ValueError:
+            raise HTTPBadRequest("Invalid page requested.")
+
+    @view_config(route_name='home', renderer='entries.mako',
+                 decorator=(conditional_get, cache_page))
+    @view_config(route_name='home_paged', renderer='entries.mako',
+                 decorator=(conditional_get, cache_page))
     def home(self):
-        current_page = int(self.request.matchdict.get('page', 1))
-        all_entries = DBSession.query(Entry)\
-            .order_by(desc(Entry.entry_time))
-        page_url = partial(self.request.route_url, 'home_paged')
-        page = Page(all_entries, page=current_page, items_per_page=5,
-             item_count=all_entries.count(),
-             url=page_url)
-        return {'entries': page}
-
-    @view_config(route_name='view_entry', renderer='entry.mako')
+        all_entries = query_entries('listing')
+        page_url = partial(self.request.route_url, 'home')
+        return {'entries': self.paginate(all_entries, page_url)}
+
+    @view_config(route_name='view_entry', renderer='entry.mako',
+                 decorator=(conditional_get, cache_page))
     def view_entry(self):
         id_ = self.request.matchdict['id_']
         try:
-            entry = DBSession.query(Entry).filter(Entry.id == id_).one()
+            entry = query_entries('detail').filter(Entry.id == id_).one()
         except NoResultFound:
             raise HTTPNotFound("Blog post not found. This blogpost was "
                                "possibly deleted.")
         return {'entry': entry}
 
-    @view_config(route_name='view_category', renderer='entries.mako')
+    @view_config(route_name='view_category', renderer='entries.mako',
+                 decorator=(conditional_get, cache_page))
     def view_category(self):
-        current_page = int(self.request.matchdict.get('page', 1))
         id_ = self.request.matchdict['id_']
-        page_url = partial(self.request.route_url, 'view_category')
-        entries = DBSession.query(Entry).\
-            filter(Entry.category_name == id_).\
-            order_by(desc(Entry.entry_time))
-        page = Page(entries, page=current_page, items_per_page=5,
-             item_count=entries.count(),
-             url=page_url)
-        return {'entries': page}
-
-    @view_config(route_name='about', renderer='about.mako')
+        page_url = partial(self.request.route_url, 'view_category', id_=id_)
+        entries = query_entries('listing').\
+            filter(Entry.category_name == id_)
+        return {'entries': self.paginate(entries, page_url)}
+
+    @view_config(route_name='about', renderer='about.mako',
+                 decorator=(conditional_get, cache_page))
     def about(self):
         return {}
 
-    @view_config(route_name='view_categories', renderer='categories.mako')
+    @view_config(route_name='view_categories', renderer='categories.mako',
+                 decorator=(conditional_get, cache_page))
     def view_categories(self):
         current_page = int(self.request.GET.get('page', 1))
-        last_entry = DBSession.query(Entry.entry_time).\
-                    filter(Entry.category_name == Category.name).\
-                    order_by(desc(Entry.entry_time)).\
-                    limit(1).\
-                    as_scalar()
-        categories = DBSession.query(Category, last_entry)
+        categories = DBSession.query(Category).order_by(Category.name)
 
         page_url = partial(self.request.route_url, 'view_categories')
         page = Page(categories, page=current_page, items_per_page=20,
-                    item_count=categories.count(),
+                    item_count=get_count(CATEGORY_COUNTER),
                     url=page_url)
         return {'categories': page}
 
 
-    @view_config(route_name='search', renderer='search.mako')
+    @view_config(route_name='search', renderer='search.mako',
+                 decorator=conditional_get)
     def search(self):
-        results = DBSession.query(Entry)\
-            .filter(Entry.title.like('%%%s%%' % (self.request.GET['search'])))\
-            .all()
+        try:
+            page = max(int(self.request.GET.get('page', 1)), 1)
+        except ValueError:
+            raise HTTPBadRequest("Invalid page requested.")
+        page_url = partial(self.request.route_url, 'search')
+        results = SearchResults(self.request.GET.get('search', ''), page_url,
+                                page)
         return {'results': results}
 
     @view_config(route_name='login')
@@ -156,15 +180,20 @@ class AdminView(BaseView):
         @view_config(route_name='...', permission='edit')
         def do_admin_stuff(self):
             ...
+
+    Administrators always read from the primary database, never from a
+    replica that might not have their latest changes yet.
     """
 
+    def __init__(self, request):
+        super(AdminView, self).__init__(request)
+        DBSession().use_primary = True
+
     @view_config(route_name='delete_entry', permission='edit')
     def delete_entry(self):
         entry_id = self.request.matchdict["id_"]
-        entry = DBSession.query(Entry).filter(Entry.id == entry_id).one()
+        entry = query_entries('listing').filter(Entry.id == entry_id).one()
         DBSession.delete(entry)
-        get_categories.invalidate()
-        get_recent_posts.invalidate()
         return HTTPFound(location=self.request.route_url('home'))
 
     @view_config(route_name='manage_categories',
@@ -175,7 +204,6 @@ class AdminView(BaseView):
         if self.request.method == 'POST':
             category = Category(form.data['name'])
             DBSession.add(category)
-            get_categories.invalidate()
             return HTTPFound(location=self.request.route_url('manage_categories'))
         categories = DBSession.query(Category).all()
         return {'form': form, 'categories': categories}
@@ -187,7 +215,8 @@ class AdminView(BaseView):
     def add_entry(self):
         entry_id = self.request.matchdict.get("id_", 0)
         if entry_id:
-            entry = DBSession.query(Entry).filter(Entry.id == entry_id).one()
+            entry = query_entries('detail')\
+                .filter(Entry.id == entry_id).one()
             form_data = MultiDict({'title': entry.title, 'text': entry._text,
                                    'category': entry.category_name})
             form_data.update(self.request.session.get("edit_entry_%i_form" % entry.id, {}))
@@ -226,24 +255,25 @@ class AdminView(BaseView):
                             % entry.id in self.request.session:
                         del self.request.session["edit_entry_%i_form"
                                                  % entry.id]
-                    entry._text = form.data["text"]
+                    entry.text = form.data["text"]
                     entry.title = form.data["title"]
                     entry.category = category
                 DBSession.flush()
-                get_categories.invalidate()
-                get_recent_posts.invalidate()
                 return HTTPFound(location=self.request.route_url('view_entry', id_=entry.id))
             if form.preview.data:
-                preview = entry
+                preview = Entry(form.data["title"], form.data["text"])
+                if entry:
+                    preview.id = entry.id
         return {'form': form, 'preview': preview}
 
     @view_config(route_name='delete_category', permission='edit')
     def delete_category(self):
         category = DBSession.query(Category)\
-            .options(subqueryload(Category.entries))\
             .filter(Category.name == self.request.matchdict["name_"])\
             .one()
-        if category.entries:
+        has_entries = DBSession.query(
+            exists().where(Entry.category_name == category.name)).scalar()
+        if has_entries:
             self.request.session.flash(
                 'There are still entries in category %s, cannot delete!'
                 % category.name)
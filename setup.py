@@ -19,6 +19,7 @@ requires = [
     'MarkupSafe',
     'webhelpers',
     'dogpile.cache',
+    'repoze.lru',
     'wtforms',
     ]
 
@@ -41,10 +42,20 @@ setup(name='miniblog',
       zip_safe=False,
       test_suite='miniblog',
       install_requires=requires,
+      extras_require={
+          # raw=False to read strings as unicode needs 0.5.2
+          'msgpack': ['msgpack >= 0.5.2'],
+          },
       entry_points="""\
       [paste.app_factory]
       main = miniblog:main
       [console_scripts]
       initialize_miniblog_db = miniblog.scripts.initializedb:main
+      rerender_miniblog_entries = miniblog.scripts.rerender:main
+      repair_miniblog_counters = miniblog.scripts.repaircounters:main
+      import_miniblog_entries = miniblog.scripts.importentries:main
+      export_miniblog_entries = miniblog.scripts.exportentries:main
+      benchmark_miniblog_sessions = miniblog.scripts.benchmarksessions:main
+      sweep_miniblog_sessions = miniblog.scripts.sweepsessions:main
       """,
       )